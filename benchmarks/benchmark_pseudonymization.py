@@ -0,0 +1,245 @@
+#!/usr/bin/env python3
+"""
+Description: Measure stage 2 (stream_pseudonymization.process_fhir_bundle) for each engine and mode on synthetic bundles
+stderr: for logs
+
+Usage: benchmarks/benchmark_pseudonymization.py --patients 2000 --payload 64 --output tmp/bench-0.2.1.json [--compare tmp/bench-0.2.0.json]
+Explainer: The bundle comes from fhir_bundle_generator.py (same options, same bundle). Each case (engine, workers, mode)
+runs in a fresh python process, so the peak RSS is that run's alone. The cost per resource type is measured by running
+the case again on bundles with only that type's entries. Results are printed and (optionally) written as JSON, which
+--compare reads to show the change against an earlier run. The 'vs sax' column compares each case with the sax engine
+in the same mode, on the same bundle (eg `--engines sax xslt` for the XSLT engine side by side with SAX).
+Modes: 'store' (the default setup, pseudonym store and TSV), 'tsv' (TSV mapping only), 'delta' (store and delta manifest)
+--src measures another version's src directory (eg a checkout of an older release) with this harness. Versions whose
+process_fhir_bundle has no engine/workers options only run the sax engine with 1 worker, the other cases are skipped,
+and they ignore the store and delta settings, so all modes measure the TSV mapping there.
+"""
+
+## Import built-ins
+import datetime
+import inspect
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+
+## Import third party libraries
+import logging
+from pydantic_settings import BaseSettings
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from fhir_bundle_generator import RESOURCE_TYPES, generate_bundle
+
+## ---------------- ##
+## Create  settings ##
+## ---------------- ##
+class Settings(BaseSettings):
+    """ The variables defined here will be taken from env vars if available and matching the type hint """
+    log_level: str = "WARNING"
+    log_format: str = "[%(asctime)s] {%(name)s/%(module)s:%(lineno)d (%(funcName)s)} %(levelname)s - %(message)s"
+settings = Settings()
+
+## Load logger for this file/script
+formatter = logging.Formatter(settings.log_format)
+logging.basicConfig(format=settings.log_format)
+## Set app's logger level and format...
+logger = logging.getLogger(__name__)
+logger.setLevel(settings.log_level)
+
+projectRoot = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sourceDir = os.path.join(projectRoot, 'src')
+MODES:list[str] = ["store", "tsv", "delta"]
+BENCHMARK_SALT:str = "benchmark-secret-key"
+
+def _peak_rss_mb(who) -> None|float:
+    """ Peak resident memory (MB) of this process or its (finished) children, None where unsupported (windows) """
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(who(resource)).ru_maxrss
+    ## kB on linux, bytes on macOS
+    return peak / (1 << 20) if sys.platform == "darwin" else peak / 1024
+
+def run_case(case:dict) -> dict:
+    """ (In a fresh process) pseudonymize case['input'] once, returns the timing and memory """
+    workdir = case['workdir']
+    os.environ['user_mapping_filename'] = os.path.join(workdir, 'psn-cache.tsv')
+    os.environ['user_mapping_store'] = "" if case['mode'] == 'tsv' else os.path.join(workdir, 'psn-cache.sqlite')
+    os.environ['delta_manifest'] = os.path.join(workdir, 'delta-manifest.sqlite') if case['mode'] == 'delta' else ""
+    os.environ['pseudonymization_progress'] = "false"
+    for stale in ['psn-cache.tsv', 'psn-cache.sqlite', 'psn-cache.sqlite-wal', 'psn-cache.sqlite-shm', 'delta-manifest.sqlite']:
+        if os.path.exists(os.path.join(workdir, stale)):
+            os.remove(os.path.join(workdir, stale))
+    ## Import after setting the env vars, settings are read on import
+    from i2b2_upload_client.logic import stream_pseudonymization
+    ## Older versions only have process_fhir_bundle(in_file, out_file, salt), with the sax engine
+    options = {"engine": case['engine'], "workers": case['workers']}
+    if not set(options) <= set(inspect.signature(stream_pseudonymization.process_fhir_bundle).parameters):
+        if case['engine'] != 'sax' or case['workers'] > 1:
+            return {"skipped": "this version only has the sax engine with 1 worker"}
+        options = {}
+    started = time.perf_counter()
+    success = stream_pseudonymization.process_fhir_bundle(case['input'], os.path.join(workdir, 'out.xml'), BENCHMARK_SALT, **options)
+    seconds = time.perf_counter() - started
+    return {
+        "success": success,
+        "seconds": seconds,
+        "peak_rss_mb": _peak_rss_mb(lambda resource: resource.RUSAGE_SELF),
+        "workers_peak_rss_mb": _peak_rss_mb(lambda resource: resource.RUSAGE_CHILDREN) if case['workers'] > 1 else None,
+    }
+
+def _run_case_process(case:dict) -> dict:
+    """ run_case in a new python process, importing the client from sourceDir """
+    env = {**os.environ, "PYTHONPATH": os.pathsep.join(filter(None, [sourceDir, os.environ.get("PYTHONPATH")]))}
+    proc = subprocess.run([sys.executable, os.path.abspath(__file__), '--run-case', json.dumps(case)], capture_output=True, text=True, env=env)
+    if proc.returncode != 0:
+        raise RuntimeError(f"Benchmark case {case} failed:\n{proc.stderr}")
+    return json.loads(proc.stdout.strip().splitlines()[-1])
+
+def _best_of(case:dict, repeat:int) -> dict:
+    """ Fastest of repeat runs (and the highest memory seen) """
+    runs = [_run_case_process(case) for _ in range(repeat)]
+    if "skipped" in runs[0]:
+        return runs[0]
+    best = min(runs, key=lambda run: run['seconds'])
+    for key in ['peak_rss_mb', 'workers_peak_rss_mb']:
+        values = [run[key] for run in runs if run[key] is not None]
+        best[key] = max(values) if values else None
+    return best
+
+def _version() -> dict:
+    """ Which version of the client was measured """
+    version = {"version": None, "git": None}
+    try:
+        import tomllib
+        with open(os.path.join(sourceDir, "..", "pyproject.toml"), "rb") as pyproject_f:
+            version["version"] = tomllib.load(pyproject_f)['project']['version']
+    except (OSError, KeyError, ImportError):
+        pass
+    try:
+        version["git"] = subprocess.run(['git', 'describe', '--always', '--dirty'], cwd=sourceDir, capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        pass
+    return version
+
+def run_benchmarks(workdir:str, bundle_options:dict, engines:list[str], modes:list[str], workers:list[int], repeat:int = 1, per_type:bool = True) -> dict:
+    """ Generate the bundles and measure every case, returns the results (as written to JSON) """
+    bundles = {}
+    with open(os.path.join(workdir, 'bundle.xml'), 'wb') as bundle_f:
+        entries = generate_bundle(bundle_f, **bundle_options)
+    bundles[None] = (os.path.join(workdir, 'bundle.xml'), sum(entries.values()))
+    if per_type:
+        for resourceType in RESOURCE_TYPES:
+            path = os.path.join(workdir, f'bundle-{resourceType}.xml')
+            with open(path, 'wb') as bundle_f:
+                bundles[resourceType] = (path, generate_bundle(bundle_f, **bundle_options, resource_types=[resourceType])[resourceType])
+    size = os.path.getsize(bundles[None][0])
+
+    cases = [{"engine": engine, "workers": 1, "mode": mode} for engine in engines for mode in modes]
+    cases += [{"engine": "passthrough", "workers": count, "mode": "store"} for count in workers if count > 1]
+    results = []
+    for case in cases:
+        print(f"Running {case}...", file=sys.stderr)
+        measured = _best_of({**case, "input": bundles[None][0], "workdir": workdir}, repeat)
+        if "skipped" in measured:
+            print(f"Skipped {case}: {measured['skipped']}", file=sys.stderr)
+            continue
+        result = {**case,
+            "seconds": measured['seconds'],
+            "entries_per_second": bundles[None][1] / measured['seconds'],
+            "mb_per_second": size / 1e6 / measured['seconds'],
+            "peak_rss_mb": measured['peak_rss_mb'],
+            "workers_peak_rss_mb": measured['workers_peak_rss_mb'],
+            "us_per_entry": {},
+        }
+        for resourceType in RESOURCE_TYPES if per_type else []:
+            path, count = bundles[resourceType]
+            if count:
+                typeSeconds = _best_of({**case, "input": path, "workdir": workdir}, repeat)['seconds']
+                result["us_per_entry"][resourceType] = typeSeconds / count * 1e6
+        results.append(result)
+    return {
+        "created": datetime.datetime.now().isoformat(timespec='seconds'),
+        "client": _version(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "bundle": {**bundle_options, "bytes": size, "entries": entries},
+        "repeat": repeat,
+        "results": results,
+    }
+
+def _case_key(result:dict) -> tuple:
+    return result['engine'], result['workers'], result['mode']
+
+def print_results(report:dict, previous:None|dict = None):
+    """ Table of the results, with the change in entries/s against previous (if given) """
+    from prettytable import PrettyTable
+    earlier = {} if previous is None else {_case_key(result): result for result in previous['results']}
+    sax = {result['mode']: result for result in report['results'] if result['engine'] == 'sax' and result['workers'] == 1}
+    headers = ["engine", "workers", "mode", "seconds", "entries/s", "MB/s", "peak RSS MB"] + [f"µs/{resourceType}" for resourceType in RESOURCE_TYPES] + ["vs sax"]
+    if previous is not None:
+        headers.append(f"vs {previous['client'].get('git') or previous['client'].get('version')}")
+    myTable = PrettyTable(headers)
+    myTable.align = "r"
+    for result in report['results']:
+        rss = "" if result['peak_rss_mb'] is None else f"{result['peak_rss_mb']:.0f}"
+        if result['workers_peak_rss_mb'] is not None:
+            rss += f" (+{result['workers_peak_rss_mb']:.0f}/worker)"
+        row = [result['engine'], result['workers'], result['mode'], f"{result['seconds']:.2f}", f"{result['entries_per_second']:,.0f}", f"{result['mb_per_second']:.1f}", rss]
+        row += [f"{result['us_per_entry'][resourceType]:.0f}" if resourceType in result['us_per_entry'] else "" for resourceType in RESOURCE_TYPES]
+        row.append(f"{result['entries_per_second'] / sax[result['mode']]['entries_per_second']:.1f}x" if result['mode'] in sax else "")
+        if previous is not None:
+            before = earlier.get(_case_key(result))
+            row.append("" if before is None else f"{result['entries_per_second'] / before['entries_per_second'] - 1:+.0%}")
+        myTable.add_row(row)
+    bundle = report['bundle']
+    print(f"Bundle: {bundle['patients']} patients x {bundle['encounters']} encounters x {bundle['observations']} observations, payload {bundle['payload']}: {sum(bundle['entries'].values()):,} entries, {bundle['bytes'] / 1e6:.1f} MB")
+    print(myTable)
+
+## When called as script (not run if imported as module):
+if __name__ == "__main__":
+    import argparse
+    ## A case process must not import the client before run_case has set its env vars (settings are read on import)
+    if len(sys.argv) == 3 and sys.argv[1] == '--run-case':
+        print(json.dumps(run_case(json.loads(sys.argv[2]))))
+        sys.exit(0)
+    try:
+        from i2b2_upload_client.logic.stream_pseudonymization import ENGINES
+    except ImportError:
+        ENGINES = {"sax": None}
+    parser = argparse.ArgumentParser(description="Benchmark stage 2 pseudonymization on synthetic bundles.")
+    parser.add_argument('--patients', type=int, default=1000, help='Number of patients.')
+    parser.add_argument('--encounters', type=int, default=2, help='Encounters per patient.')
+    parser.add_argument('--observations', type=int, default=5, help='Observations per encounter.')
+    parser.add_argument('--payload', type=int, default=0, help='Characters of free text per observation.')
+    parser.add_argument('--seed', type=int, default=1, help='Random seed for the bundle.')
+    parser.add_argument('--engines', nargs='+', choices=list(ENGINES), default=list(ENGINES), help='Engines to measure (default all).')
+    parser.add_argument('--modes', nargs='+', choices=MODES, default=MODES, help='Modes to measure each engine in (default all).')
+    parser.add_argument('--workers', type=int, nargs='+', default=[os.cpu_count() or 1], help='Worker counts (over 1) to measure the parallel passthrough engine with.')
+    parser.add_argument('--repeat', type=int, default=1, help='Runs per case, the fastest is reported.')
+    parser.add_argument('--no-per-type', action='store_true', help='Skip measuring the cost per resource type.')
+    parser.add_argument('--output', help='Write the results to this JSON file.')
+    parser.add_argument('--compare', help='Results (JSON) of an earlier run to compare with.')
+    parser.add_argument('--src', default=sourceDir, help='The src directory of the client version to measure (default this one\'s).')
+    args = parser.parse_args()
+
+    sourceDir = os.path.abspath(args.src)
+    if not os.path.isfile(os.path.join(sourceDir, "i2b2_upload_client", "logic", "stream_pseudonymization.py")):
+        parser.error(f"'{args.src}' is not the src directory of the client")
+    bundle_options = {"patients": args.patients, "encounters": args.encounters, "observations": args.observations, "payload": args.payload, "seed": args.seed}
+    with tempfile.TemporaryDirectory(prefix="i2b2-bench-") as workdir:
+        report = run_benchmarks(workdir, bundle_options, args.engines, args.modes, args.workers, args.repeat, not args.no_per_type)
+    previous = None
+    if args.compare:
+        with open(args.compare) as previous_f:
+            previous = json.load(previous_f)
+    print_results(report, previous)
+    if args.output:
+        with open(args.output, 'w') as output_f:
+            json.dump(report, output_f, indent=2)
+        print(f"Results written to '{args.output}'")
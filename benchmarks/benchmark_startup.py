@@ -0,0 +1,172 @@
+#!/usr/bin/env python3
+"""
+Description: Measure how long the client's entry points and modules take to start (import), to keep startup fast
+stderr: for logs
+
+Usage: benchmarks/benchmark_startup.py --output tmp/startup-0.2.1.json [--compare tmp/startup-0.2.0.json] [--repeat 5]
+Explainer: Each target runs in a fresh python process (repeat times, the fastest is reported): its wall time, the total
+of `python -X importtime` (self time of every module imported) and the slowest imports. The dwh_cli targets also
+check that Qt (PySide6) was never imported. The GUI (dwh_client) is only imported, not shown, and skipped if PySide6
+is not installed. Results are printed and (optionally) written as JSON, which --compare reads to show the change.
+"""
+
+## Import built-ins
+import datetime
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+
+## Import third party libraries
+import logging
+from pydantic_settings import BaseSettings
+
+## ---------------- ##
+## Create  settings ##
+## ---------------- ##
+class Settings(BaseSettings):
+    """ The variables defined here will be taken from env vars if available and matching the type hint """
+    log_level: str = "WARNING"
+    log_format: str = "[%(asctime)s] {%(name)s/%(module)s:%(lineno)d (%(funcName)s)} %(levelname)s - %(message)s"
+settings = Settings()
+
+## Load logger for this file/script
+formatter = logging.Formatter(settings.log_format)
+logging.basicConfig(format=settings.log_format)
+## Set app's logger level and format...
+logger = logging.getLogger(__name__)
+logger.setLevel(settings.log_level)
+
+projectRoot = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+projectSrc = os.path.join(projectRoot, 'src')
+## Slowest imports listed per target
+TOP_IMPORTS:int = 5
+## Printed by the target once done, with the modules it loaded
+LOADED_MARKER:str = "startup-benchmark-loaded:"
+
+## name: python code run in the fresh process (sys.argv set for the CLI targets)
+TARGETS:dict[str, str] = {
+    "dwh_cli --help": "import sys; sys.argv = ['dwh_cli', '--help']; from i2b2_upload_client.cli import main; main()",
+    "dwh_cli version": "import sys; sys.argv = ['dwh_cli', 'version']; from i2b2_upload_client.cli import main; main()",
+    "dwh_cli api --help": "import sys; sys.argv = ['dwh_cli', 'api', '--help']\nfrom i2b2_upload_client.cli import main\ntry: main()\nexcept SystemExit: pass",
+    "dwh_cli pipeline --help": "import sys; sys.argv = ['dwh_cli', 'pipeline', '--help']\nfrom i2b2_upload_client.cli import main\ntry: main()\nexcept SystemExit: pass",
+    "import api_processing": "from i2b2_upload_client.logic import api_processing",
+    "import stream_pseudonymization": "from i2b2_upload_client.logic import stream_pseudonymization",
+    "import pipeline": "from i2b2_upload_client.logic import pipeline",
+    "import source_scanner": "from i2b2_upload_client.logic import source_scanner",
+    "import dwh_client (GUI)": "import dwh_client",
+}
+
+def _parse_importtime(stderr:str) -> list[tuple[str, int]]:
+    """ (module, self µs) of every import in `python -X importtime` output """
+    imports = []
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_us, _, name = line[len("import time:"):].split("|", 2)
+        imports.append((name.strip(), int(self_us)))
+    return imports
+
+def run_target(code:str) -> dict:
+    """ Run code once in a fresh python process, returns its wall time, import time and whether it loaded Qt """
+    code += f"\nimport sys as _sys; print({LOADED_MARKER!r} + ','.join(_sys.modules))"
+    env = {**os.environ, "PYTHONPATH": os.pathsep.join(filter(None, [projectSrc, os.environ.get("PYTHONPATH")])), "PYTHONDONTWRITEBYTECODE": "1"}
+    started = time.perf_counter()
+    proc = subprocess.run([sys.executable, "-X", "importtime", "-c", code], capture_output=True, text=True, env=env, cwd=projectRoot)
+    seconds = time.perf_counter() - started
+    if proc.returncode != 0:
+        raise RuntimeError(f"Startup benchmark target failed:\n{proc.stderr[-2000:]}")
+    loaded = next((line[len(LOADED_MARKER):].split(",") for line in proc.stdout.splitlines() if line.startswith(LOADED_MARKER)), [])
+    imports = _parse_importtime(proc.stderr)
+    return {
+        "seconds": seconds,
+        "import_seconds": sum(self_us for _, self_us in imports) / 1e6,
+        "modules": len(loaded),
+        "qt_loaded": any(module.split(".")[0] == "PySide6" for module in loaded),
+        "top_imports": [[name, self_us / 1e6] for name, self_us in sorted(imports, key=lambda item: -item[1])[:TOP_IMPORTS]],
+    }
+
+def _have_qt() -> bool:
+    import importlib.util
+    return importlib.util.find_spec("PySide6") is not None
+
+def _version() -> dict:
+    """ Which version of the client was measured """
+    version = {"version": None, "git": None}
+    try:
+        sys.path.insert(0, projectSrc)
+        from i2b2_upload_client._version import __version__
+        version["version"] = __version__
+    except ImportError:
+        pass
+    try:
+        version["git"] = subprocess.run(['git', 'describe', '--always', '--dirty'], cwd=projectRoot, capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        pass
+    return version
+
+def run_benchmarks(targets:list[str], repeat:int = 3) -> dict:
+    """ Measure every target (fastest of repeat runs), returns the results (as written to JSON) """
+    results = []
+    for name in targets:
+        if name.startswith("import dwh_client") and not _have_qt():
+            logger.warning("PySide6 is not installed, skipping '%s'", name)
+            continue
+        print(f"Running '{name}'...", file=sys.stderr)
+        runs = [run_target(TARGETS[name]) for _ in range(repeat)]
+        best = min(runs, key=lambda run: run['seconds'])
+        results.append({"target": name, **best})
+        if name.startswith("dwh_cli") and best['qt_loaded']:
+            logger.error("'%s' imported Qt (PySide6)", name)
+    return {
+        "created": datetime.datetime.now().isoformat(timespec='seconds'),
+        "client": _version(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "repeat": repeat,
+        "results": results,
+    }
+
+def print_results(report:dict, previous:None|dict = None):
+    """ Table of the results, with the change in wall time against previous (if given) """
+    from prettytable import PrettyTable
+    earlier = {} if previous is None else {result['target']: result for result in previous['results']}
+    headers = ["target", "seconds", "import s", "modules", "Qt", "slowest imports (s)"]
+    if previous is not None:
+        headers.append(f"vs {previous['client'].get('git') or previous['client'].get('version')}")
+    myTable = PrettyTable(headers)
+    myTable.align = "r"
+    myTable.align["target"] = myTable.align["slowest imports (s)"] = "l"
+    for result in report['results']:
+        row = [result['target'], f"{result['seconds']:.3f}", f"{result['import_seconds']:.3f}", result['modules'], "yes" if result['qt_loaded'] else "no",
+            "\n".join(f"{name} {seconds:.3f}" for name, seconds in result['top_imports'])]
+        if previous is not None:
+            before = earlier.get(result['target'])
+            row.append("" if before is None else f"{result['seconds'] / before['seconds'] - 1:+.0%}")
+        myTable.add_row(row)
+    print(myTable)
+
+## When called as script (not run if imported as module):
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Benchmark the startup (import) time of the client's entry points and modules.")
+    parser.add_argument('--targets', nargs='+', choices=list(TARGETS), default=list(TARGETS), metavar='TARGET', help=f'Targets to measure (default all): {", ".join(TARGETS)}.')
+    parser.add_argument('--repeat', type=int, default=3, help='Runs per target, the fastest is reported.')
+    parser.add_argument('--output', help='Write the results to this JSON file.')
+    parser.add_argument('--compare', help='Results (JSON) of an earlier run to compare with.')
+    args = parser.parse_args()
+
+    report = run_benchmarks(args.targets, args.repeat)
+    previous = None
+    if args.compare:
+        with open(args.compare) as previous_f:
+            previous = json.load(previous_f)
+    print_results(report, previous)
+    if args.output:
+        with open(args.output, 'w') as output_f:
+            json.dump(report, output_f, indent=2)
+        print(f"Results written to '{args.output}'")
+    if any(result['qt_loaded'] for result in report['results'] if result['target'].startswith("dwh_cli")):
+        sys.exit(1)
@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+"""
+Description: Write a synthetic (but realistic looking) fhir bundle, the same every time for the same options
+stderr: for logs
+
+Usage: benchmarks/fhir_bundle_generator.py --patients 1000 --encounters 2 --observations 5 --payload 64 -o tmp/bench-bundle.xml
+Explainer: Patients, their encounters and each encounter's observations are written in the order ExportFHIR
+produces them. Names include non-ascii characters and xml escapes, every 50th patient has a second name
+(as real data does). The payload adds free text of the given size to each observation.
+"""
+
+## Import built-ins
+import random
+import sys
+
+## Import third party libraries
+import logging
+from pydantic_settings import BaseSettings
+
+## ---------------- ##
+## Create  settings ##
+## ---------------- ##
+class Settings(BaseSettings):
+    """ The variables defined here will be taken from env vars if available and matching the type hint """
+    log_level: str = "WARNING"
+    log_format: str = "[%(asctime)s] {%(name)s/%(module)s:%(lineno)d (%(funcName)s)} %(levelname)s - %(message)s"
+settings = Settings()
+
+## Load logger for this file/script
+formatter = logging.Formatter(settings.log_format)
+logging.basicConfig(format=settings.log_format)
+## Set app's logger level and format...
+logger = logging.getLogger(__name__)
+logger.setLevel(settings.log_level)
+
+RESOURCE_TYPES:list[str] = ["Patient", "Encounter", "Observation"]
+_GIVEN_NAMES:list[str] = ["Hans", "Jörg", "Anna-Lena", "Zoë", "Mehmet", "Olga", "Jean &amp; Luc", "Ingrid"]
+_SURNAMES:list[str] = ["Müller", "Schmidt", "O'Brien", "Nowak", "Yılmaz", "Weiß", "&quot;Smith&quot;", "Fischer"]
+## No xml escapes here, the payload text is cut to size
+_WORDS:list[str] = ["pain", "stable", "follow-up", "normal", "elevated", "below 5", "reviewed", "ß-test", "no change", "see notes"]
+
+def _patient(rng:random.Random, number:int) -> str:
+    """ One Patient entry """
+    names = f'\t\t\t\t<name>\n\t\t\t\t\t<family value="{rng.choice(_SURNAMES)}{number}"/>\n\t\t\t\t\t<given value="{rng.choice(_GIVEN_NAMES)}"/>\n\t\t\t\t</name>\n'
+    if number % 50 == 0:
+        names += f'\t\t\t\t<name>\n\t\t\t\t\t<family value="{rng.choice(_SURNAMES)}"/>\n\t\t\t\t</name>\n'
+    return (f'\t<entry>\n\t\t<fullUrl value="urn:uuid:patient-{number}"/>\n\t\t<resource>\n\t\t\t<Patient>\n'
+        f'\t\t\t\t<id value="P{number}"/>\n\t\t\t\t<identifier>\n\t\t\t\t\t<system value="http://example.org/pid"/>\n\t\t\t\t\t<value value="P{number}"/>\n\t\t\t\t</identifier>\n'
+        f'{names}\t\t\t\t<gender value="{rng.choice(["male", "female", "other", "unknown"])}"/>\n'
+        f'\t\t\t\t<birthDate value="{rng.randint(1920, 2020)}-{rng.randint(1, 12):02d}-{rng.randint(1, 28):02d}"/>\n'
+        '\t\t\t</Patient>\n\t\t</resource>\n\t</entry>\n')
+
+def _encounter(rng:random.Random, patient:int, number:int) -> str:
+    """ One Encounter entry """
+    return (f'\t<entry>\n\t\t<fullUrl value="urn:uuid:encounter-{patient}-{number}"/>\n\t\t<resource>\n\t\t\t<Encounter>\n'
+        f'\t\t\t\t<id value="E{patient}_{number}"/>\n\t\t\t\t<identifier>\n\t\t\t\t\t<value value="visit-{rng.randint(1, 10**9)}"/>\n\t\t\t\t</identifier>\n'
+        f'\t\t\t\t<status value="finished"/>\n\t\t\t\t<subject>\n\t\t\t\t\t<reference value="Patient/P{patient}"/>\n\t\t\t\t</subject>\n'
+        f'\t\t\t\t<period>\n\t\t\t\t\t<start value="20{rng.randint(10, 24)}-{rng.randint(1, 12):02d}-{rng.randint(1, 28):02d}T{rng.randint(0, 23):02d}:00:00+01:00"/>\n\t\t\t\t</period>\n'
+        '\t\t\t</Encounter>\n\t\t</resource>\n\t</entry>\n')
+
+def _observation(rng:random.Random, patient:int, encounter:int, number:int, payload:int) -> str:
+    """ One Observation entry, with payload characters of free text """
+    note = ""
+    if payload > 0:
+        text = ""
+        while len(text) < payload:
+            text += rng.choice(_WORDS) + " "
+        note = f'\t\t\t\t<note>\n\t\t\t\t\t<text value="{text[:payload].rstrip()}"/>\n\t\t\t\t</note>\n'
+    return (f'\t<entry>\n\t\t<fullUrl value="urn:uuid:observation-{patient}-{encounter}-{number}"/>\n\t\t<resource>\n\t\t\t<Observation>\n'
+        f'\t\t\t\t<id value="O{patient}_{encounter}_{number}"/>\n\t\t\t\t<status value="final"/>\n'
+        f'\t\t\t\t<code>\n\t\t\t\t\t<coding>\n\t\t\t\t\t\t<system value="http://loinc.org"/>\n\t\t\t\t\t\t<code value="{rng.randint(1000, 99999)}-{rng.randint(0, 9)}"/>\n\t\t\t\t\t</coding>\n\t\t\t\t</code>\n'
+        f'\t\t\t\t<subject>\n\t\t\t\t\t<reference value="Patient/P{patient}"/>\n\t\t\t\t</subject>\n\t\t\t\t<encounter>\n\t\t\t\t\t<reference value="Encounter/E{patient}_{encounter}"/>\n\t\t\t\t</encounter>\n'
+        f'\t\t\t\t<valueQuantity>\n\t\t\t\t\t<value value="{rng.uniform(0, 500):.2f}"/>\n\t\t\t\t\t<unit value="mg/dL"/>\n\t\t\t\t</valueQuantity>\n'
+        f'{note}\t\t\t</Observation>\n\t\t</resource>\n\t</entry>\n')
+
+def generate_bundle(out_f, patients:int, encounters:int = 2, observations:int = 5, payload:int = 0, seed:int = 1, resource_types:None|list[str] = None) -> dict:
+    """ Write the bundle (as UTF-8) to the binary file object out_f, returns the number of entries per resource type
+    resource_types: only write entries of these types (eg to measure the cost of one type), the others are still
+        generated so the entries are identical to the full bundle
+    """
+    rng = random.Random(seed)
+    counts:dict = {resourceType: 0 for resourceType in RESOURCE_TYPES}
+    def write(resourceType:str, entry:str):
+        if resource_types is None or resourceType in resource_types:
+            out_f.write(entry.encode('UTF-8'))
+            counts[resourceType] += 1
+    out_f.write(b'<?xml version="1.0" encoding="UTF-8"?>\n<Bundle xmlns="http://hl7.org/fhir">\n\t<type value="collection"/>\n')
+    for patient in range(patients):
+        write("Patient", _patient(rng, patient))
+        for encounter in range(encounters):
+            write("Encounter", _encounter(rng, patient, encounter))
+            for observation in range(observations):
+                write("Observation", _observation(rng, patient, encounter, observation, payload))
+    out_f.write(b'</Bundle>\n')
+    return counts
+
+## When called as script (not run if imported as module):
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Write a deterministic synthetic fhir bundle (for benchmarks).")
+    parser.add_argument('--patients', type=int, default=1000, help='Number of patients.')
+    parser.add_argument('--encounters', type=int, default=2, help='Encounters per patient.')
+    parser.add_argument('--observations', type=int, default=5, help='Observations per encounter.')
+    parser.add_argument('--payload', type=int, default=0, help='Characters of free text per observation.')
+    parser.add_argument('--seed', type=int, default=1, help='Random seed, the same seed gives the same bundle.')
+    parser.add_argument('--resource-types', nargs='+', choices=RESOURCE_TYPES, help='Only write entries of these types.')
+    parser.add_argument('-o', '--output', help='File to write (default stdout).')
+    args = parser.parse_args()
+
+    out_f = open(args.output, 'wb') if args.output else sys.stdout.buffer
+    counts = generate_bundle(out_f, args.patients, args.encounters, args.observations, args.payload, args.seed, args.resource_types)
+    if args.output:
+        out_f.close()
+    logger.info("Entries written: %s", counts)
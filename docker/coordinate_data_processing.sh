@@ -25,22 +25,17 @@ case $log_verbosity in
 esac
 
 ## Scan /datasources/ which is a mounted directory of the users local datasources
-## For each source, check if there are output files and compare the dates to the config and source files
+## For each source, the config, source files and outputs are compared with what was recorded when it was last processed
+scanner="-m i2b2_upload_client.logic.source_scanner"
 function scan_local_sources {
-    ## Check which local sources are available and when they were updated locally and remotely
-    # for dir in /datasources/*/; do
-    for dir in $(ls -1 /datasources/); do
-        if [ ! -d ${dir}/client-output ] ; then
-            echo "Source '${dir}' has not yet been processed"
-        else
-            echo "Source '${dir}' is also available"
-            ## TODO: Check dates...
-            ## Check modify dates of source files (datasource.xml and any <url> references inside it)
-            # source_date=
-            # output_date
-            # echo "Source '${dir}' was last updated on '' and last processed on ''"
-        fi
-    done
+    ## Check which local sources are new or changed since they were processed (sizes, dates and content hashes)
+    python3 ${scanner} --root /datasources --list
+}
+
+function process_stale_sources {
+    ## Process the new and changed sources, scan_workers (default 2) at once
+    log_debug "Processing stale sources..."
+    python3 ${scanner} --root /datasources
 }
 
 
@@ -50,7 +45,7 @@ function initial_options {
     select opt in "${base_options[@]}" exit; do
     ## Use option indicies so code looks neater
     case $REPLY in
-            1) echo "Sorry, this function is not yet implemented!" ;;
+            1) process_stale_sources ;;
             2) process_local_source ;;
             3) api_options ;;
             $((${#base_options[@]}+1))) echo "exiting"
@@ -66,14 +61,8 @@ function process_local_source {
     read -p 'Please provide a source name (the directory name): ' sn
     if [[ "$(cd /datasources && echo */ )" =~ "${sn}/" && ${sn} != "" ]] ; then
         echo "Source exists ($sn)! Processing..."
-        cd /datasources/${sn}
-        mkdir -p client-output
-        rm client-output/*
-        /upload-client/fhir-transform/process_data.sh datasource.xml > client-output/fhir-bundle-raw.xml
-        export input_fn=client-output/fhir-bundle-raw.xml
-        export output_fn=client-output/fhir-bundle-dwh.xml
-        /upload-client/pseudonym/src/process-pid.py
-        return 0
+        python3 ${scanner} --root /datasources --only ${sn} --force
+        return $?
     else
         echo "Dir not found: $sn"
         return 1
@@ -34,7 +34,7 @@ if [[ ! -n $secret_key || $secret_key = "ChangeMe" ]] ; then
 fi
 export secret_key=${secret_key}
 ## use $1 and $2 as in/out file references. Py script will prompt for secret key
-cat $1 | python ${client_basedir}/src/stream_pseudonymization.py > $2
+cat $1 | python ${client_basedir}/src/i2b2_upload_client/logic/stream_pseudonymization.py > $2
 
 ## Deactivate pyhon venv if its there
 [[ -d "${client_basedir}/.venv" ]] && deactivate
@@ -80,13 +80,17 @@ def convert_icon():
     subprocess.run(["magick", os.path.join(project_resources, "DzlLogoSymmetric.webp"), "-resize x64", "-gravity center", "-crop 64x64+0+0", "-flatten", "-colors 256", "-background transparent", os.path.join(project_resources, "DzlLogoSymmetric.ico")], check=True)
 
 def update_version_file():
-    """ For the system binary, we need access to a version file. """
+    """ For the system binary, we need access to a version file. The package gets it as a module, so startup doesn't read pyproject.toml """
     print("Updating version file for system binary usage")
-    import toml
-    my_pyproject = toml.load(os.path.join(project_root, 'pyproject.toml'))
-    version = my_pyproject['project']['version']
+    import tomllib
+    with open(os.path.join(project_root, 'pyproject.toml'), 'rb') as pyproject_f:
+        version = tomllib.load(pyproject_f)['project']['version']
     print('Setting version: ', version)
+    os.path.exists(project_build) or os.makedirs(project_build)
     open(os.path.join(project_build, 'version.txt'), 'w').write(version)
+    open(os.path.join(project_src, 'i2b2_upload_client', '_version.py'), 'w').write(
+        "## Written by src/build_executables.py (update_version_file) from pyproject.toml, don't edit\n"
+        f"__version__ = {version!r}\n")
 
 def main():
     """ Run through all the functions to build up each component. """
@@ -9,11 +9,11 @@ Explainer: See which sources you have, trigger processing, delete them, update t
 
 ## Import built-ins
 import gzip
+import multiprocessing
 import os
 import re
-import subprocess
 import sys
-import time
+import tempfile
 
 ## Import third party libraries
 import datetime
@@ -21,9 +21,8 @@ import logging
 from pydantic_settings import BaseSettings
 ## Bad practice, loading .ui file in code: https://doc.qt.io/qtforpython-6.2/PySide6/QtUiTools/loadUiType.html
 # from PySide6 import uic
-from PySide6.QtCore import QFile
-from PySide6.QtUiTools import loadUiType, QUiLoader
-from PySide6.QtWidgets import QApplication, QWidget, QMainWindow, QFileDialog, QTableWidgetItem, QMessageBox
+from PySide6.QtCore import QFile, QTimer
+from PySide6.QtWidgets import QApplication, QWidget, QMainWindow, QFileDialog, QTableWidgetItem, QMessageBox, QProgressBar, QPushButton
 import PySide6.QtGui
 
 class AppMeta():
@@ -45,6 +44,8 @@ class Settings(BaseSettings):
     DWH_API_ENDPOINT: str = "https://data.dzl.de/api"
     dwh_api_key: str = "ChangeMe"
     compatible_java: str = "java"
+    ## Where API responses are kept between sessions (unless api_cache_filename is set for api_processing), empty to not keep them
+    api_cache_filename: str = "api-cache.json"
 settings = Settings()
 
 ## Load logger for this file/script
@@ -58,24 +59,25 @@ logger.warning("Logging loaded with default configuration")
 
 ## Use "binary" root if available, else python __file__
 projectRoot = os.path.abspath(getattr(sys, '_MEIPASS', os.path.join(os.path.dirname(__file__), '..')))
+from i2b2_upload_client.gui import workers
 from i2b2_upload_client.logic import api_processing
-from i2b2_upload_client.logic import stream_pseudonymization
+## The stage 1/2 modules (pipeline, stage1_scheduler, stream_pseudonymization) are imported when first used, so the window shows sooner
 
 def get_version():
-    """ Get version dynamically from pyprojects.toml if possible and update static file. 
-    Else, read from static file. Else 'unknown' """
+    """ Get version written at build time (i2b2_upload_client/_version.py, see build_executables.py), else from
+    the static file. Else 'unknown' """
     version = "Unknown"
     version_file = os.path.join(projectRoot, "build", "version.txt")
     version_file_built = os.path.join(projectRoot, "version.txt")
-    pyproject_file = os.path.join(projectRoot, "pyproject.toml")
     logger.debug("Checking version...")
 
-    if os.path.isfile(pyproject_file):
-        logger.error("Attempting to read toml file directly")
-        import toml
-        my_pyproject = toml.load(pyproject_file)
-        version = my_pyproject['project']['version']
-    elif os.path.exists(version_file) and os.path.isfile(version_file):
+    try:
+        from i2b2_upload_client._version import __version__ as version
+        logger.info("Setting version: %s", version)
+        return version
+    except ImportError:
+        pass
+    if os.path.exists(version_file) and os.path.isfile(version_file):
         with open(version_file, "r") as version_file:
             version = version_file.read()
     elif os.path.exists(version_file_built) and os.path.isfile(version_file_built):
@@ -87,7 +89,7 @@ def get_version():
     logger.info("Setting version: %s", version)
     return version
 
-## Populate app_version from pyproject.toml
+## Populate app_version (from pyproject.toml, at build time)
 if not AppMeta.app_version:
     AppMeta.app_version = get_version()
 
@@ -115,6 +117,7 @@ class DwhClientWindow(QMainWindow, Ui_MainWindow):
         self.dwhFhirFileText.textChanged.connect(self.dwhFhirFileChanged)
         self.secretKeyPasswordEdit.textChanged.connect(self.secretKeyPasswordChanged)
         self.pseudonymizeButton.clicked.connect(self.pseudonymizeFhir)
+        self.pipelineUploadPushButton.clicked.connect(self.pipelineUpload)
 
         if settings.secret_key != "ChangeMe":
             self.secretKeyPasswordEdit.setText(settings.secret_key)
@@ -135,7 +138,31 @@ class DwhClientWindow(QMainWindow, Ui_MainWindow):
         self.updateSourcePushButton.clicked.connect(self.processDs)
         self.showSourceInfoPushButton.clicked.connect(self.showDsInfo)
         self.showSourceErrorPushButton.clicked.connect(self.showDsError)
-        self.reloadStatusPushButton.clicked.connect(self.showCurrentSourceStatus)
+        self.reloadStatusPushButton.clicked.connect(lambda: self.showCurrentSourceStatus(fresh=True))
+        self.autoRefreshCheckBox.toggled.connect(self.autoRefreshToggled)
+        ## Button actions (All sources)
+        self.overviewRefreshPushButton.clicked.connect(self.showAllSourcesOverview)
+        self.overviewTableWidget.cellDoubleClicked.connect(self.overviewSourceChosen)
+        ## API calls run in the background (see gui/workers.py), uploads show progress and can be cancelled from the status bar
+        self.selectedSourceId = None
+        self.sourceToSelect = None
+        self.uploadWorker = None
+        ## Auto-refresh: the background wait for the last action's final status
+        self.statusWatcher = None
+        self.uploadProgressBar = QProgressBar(self)
+        self.uploadProgressBar.setRange(0, 1000)
+        self.uploadProgressBar.setMaximumWidth(300)
+        self.uploadProgressBar.hide()
+        self.cancelUploadPushButton = QPushButton("Cancel upload", self)
+        self.cancelUploadPushButton.clicked.connect(self.cancelUpload)
+        self.cancelUploadPushButton.hide()
+        self.statusbar.addPermanentWidget(self.uploadProgressBar)
+        self.statusbar.addPermanentWidget(self.cancelUploadPushButton)
+        ## Show the sources known at the end of the last session straight away (API responses are cached, see api_processing.ResponseCache)
+        if not api_processing.settings.api_cache_filename:
+            api_processing.settings.api_cache_filename = settings.api_cache_filename
+        api_processing.loadResponseCache()
+        self.showLastKnownSources()
 
     def eventFilter(self, obj, ev):
         if ev.type() == PySide6.QtCore.QEvent.Enter:
@@ -209,36 +236,28 @@ class DwhClientWindow(QMainWindow, Ui_MainWindow):
             return False
         return True
     def generateFhir(self):
-        """ Call the exisiting "script" style java code """
+        """ Call the exisiting "script" style java code (in the background, see stage1_scheduler) """
         logger.info("Generating fhir started...")
         ## Don't let user click it again while its running
         self.generateFhirButton.setEnabled(False)
-        libsDir = os.path.abspath(os.path.join(projectRoot, 'resources', 'lib'))
-        libs = [os.path.join(libsDir, file) for file in next(os.walk(libsDir), (None, None, []))[2] if file.endswith(".jar")] # [] if no file
-        javaCpSep = ':'
-        if os.name == 'nt':
-            ## Windows class path separator
-            javaCpSep = ';'
-        javaCp = javaCpSep.join(libs)
-        proc = None
-        ## Actual work - write streamed output to file
-        with open(self.rawFhirFileText.text(), 'w') as rawFhir:
-            logger.info("Running java subprocess.Popen to generate fhir")
-            proc = subprocess.Popen([settings.compatible_java,'-Dfile.encoding=UTF-8', '-cp', javaCp, 'de.sekmi.histream.etl.ExportFHIR', self.dsConfigFileText.text()], stdout=subprocess.PIPE)
-            while True:
-                line = proc.stdout.readline()
-                if not line:
-                    break
-                rawFhir.write(line.decode())
-        proc.communicate()
-        if proc.returncode == 0:
+        from i2b2_upload_client.logic import pipeline, stage1_scheduler
+        pipeline.settings.compatible_java = settings.compatible_java
+        pipeline.settings.stage1_libs_dir = os.path.abspath(os.path.join(projectRoot, 'resources', 'lib'))
+        ## Actual work - java writes its output straight to the file
+        logger.info("Running java subprocess to generate fhir")
+        workers.runInBackground(stage1_scheduler.run_export, self.dsConfigFileText.text(), self.rawFhirFileText.text(), stage1_scheduler.plan_heap(1)[1],
+            onFinished=self.generateFhirFinished, onFailed=lambda message: self.generateFhirFinished({"returncode": None, "message": message}))
+    def generateFhirFinished(self, result:dict):
+        """ Show the outcome of stage 1 (from generateFhir) """
+        self.generateFhirButton.setEnabled(True)
+        if result['returncode'] == 0:
             self.stage1StatusLabel.setText("<b style='color:green; font-size:12pt;'>Status:</b>")
             self.stage1StatusText.setText("Completed successfully!")
-            logger.info("Fhir generation complete")
+            logger.info("Fhir generation complete (%.1fs)", result['seconds'])
         else:
             self.stage1StatusLabel.setText("<b style='color:red; font-size:12pt;'>Status:</b>")
-            self.stage1StatusText.setText(f"Processing failed with return code: '{proc.returncode}'<br/>Please check your datasource.xml mapping configuration. Ensure you have timezone set (see readme for guidance)")
-            logger.error("Fhir generation had errors (return code: %s)...", proc.returncode)
+            self.stage1StatusText.setText(f"Processing failed with return code: '{result['returncode']}'<br/>Please check your datasource.xml mapping configuration. Ensure you have timezone set (see readme for guidance)")
+            logger.error("Fhir generation had errors (return code: %s): %s", result['returncode'], result['message'])
 
     def pseudonymizeButton_hover(self):
         """ Verify and enable/disable click action """
@@ -266,17 +285,85 @@ class DwhClientWindow(QMainWindow, Ui_MainWindow):
         """ Call the exisiting "script" style python code """
         logger.info("Pseudonymisation started...")
         self.pseudonymizeButton.setEnabled(False)
-        ## Streaming handled by module, just provide file names and salt/secret-key
-        if stream_pseudonymization.process_fhir_bundle(self.rawFhirFileText.text(), self.dwhFhirFileText.text(), self.secretKeyPasswordEdit.text()):
+        self.lastPseudonymizationCounts = None
+        self.stage2StatusLabel.setText("<b style='font-size:12pt;'>Status:</b>")
+        self.stage2StatusText.setText('<html><head/><body><p><span style=" font-size:12pt; font-weight:600;">Stage 2:</span> Starting...</p></body></html>')
+        ## Streaming handled by module (in the background), just provide file names and salt/secret-key
+        from i2b2_upload_client.logic import stream_pseudonymization
+        workers.runInBackground(stream_pseudonymization.process_fhir_bundle, self.rawFhirFileText.text(), self.dwhFhirFileText.text(), self.secretKeyPasswordEdit.text(),
+            reportsProgress=True, onProgress=self.pseudonymizationProgress, onFinished=self.pseudonymizationFinished,
+            onFailed=lambda message: self.pseudonymizationFinished(False, message))
+    def pseudonymizationProgress(self, values:tuple):
+        """ Show the processing rate and ETA while pseudonymizing """
+        from i2b2_upload_client.logic import stream_pseudonymization
+        counts, = values
+        self.lastPseudonymizationCounts = counts
+        self.stage2StatusText.setText(f'<html><head/><body><p><span style=" font-size:12pt; font-weight:600;">Stage 2:</span> {stream_pseudonymization.describe_progress(counts)}</p></body></html>')
+    def pseudonymizationFinished(self, success:bool, message:str = ""):
+        """ Show the outcome of pseudonymizeFhir """
+        self.pseudonymizeButton.setEnabled(True)
+        if success:
             # self.stage2StatusLabel.append(f"<b>Stage 2:</b> Completed successfully!")
             self.stage2StatusLabel.setText("<b style='color:green; font-size:12pt;'>Status:</b>")
-            self.stage2StatusText.setText('<html><head/><body><p><span style=" font-size:12pt; font-weight:600;">Stage 2:</span> Completed successfully!</p></body></html>')
+            counts = self.lastPseudonymizationCounts
+            summary = "" if counts is None else f" ({counts['entries']:,} entries, {counts['patients']:,} patients in {counts['elapsed']:,.0f}s)"
+            if counts is not None and counts.get('pseudonym_clashes'):
+                summary += f"<br/><span style='color:red;'>{counts['pseudonym_clashes']:,} pseudonyms were given to more than 1 patient, see the log</span>"
+            self.stage2StatusText.setText(f'<html><head/><body><p><span style=" font-size:12pt; font-weight:600;">Stage 2:</span> Completed successfully!{summary}</p></body></html>')
             logger.info("Pseudonymization complete")
         else:
-            # self.stage2StatusLabel.append(f"<b>Stage 2:</b> Pseudonymization failed with return code: '{proc.returncode}'<br/>Please check all file references are correct and that stage 1 has completed successfully.")
             self.stage2StatusLabel.setText("<b style='color:red; font-size:12pt;'>Status:</b>")
-            self.stage2StatusText.setText(f'<html><head/><body><p><span style=" font-size:12pt; font-weight:600;">Stage 2:</span> Pseudonymization failed with return code: \'{proc.returncode}\'<br/>Please check all file references are correct and that stage 1 has completed successfully.</p></body></html>')
-            logger.error("Pseudonymization had errors (return code: %s)...", proc.returncode)
+            self.stage2StatusText.setText(f'<html><head/><body><p><span style=" font-size:12pt; font-weight:600;">Stage 2:</span> Pseudonymization failed {message}<br/>Please check all file references are correct and that stage 1 has completed successfully.</p></body></html>')
+            logger.error("Pseudonymization had errors: %s", message)
+
+    def pipelineUpload(self):
+        """ User confirm, then generate, pseudonymize and upload without writing intermediate files (unless asked to) """
+        source_id = self.newDsNameEdit.text()
+        reFindUnwanted = re.compile(r"[<>{}[\]/\\~`#?!:;*\"']");
+        if not os.path.exists(self.dsConfigFileText.text()) or len(source_id) < 3 or reFindUnwanted.search(source_id):
+            QMessageBox.warning(self, "Cannot start", "Please choose a datasource configuration file here and enter a valid source name in the DWH tab.")
+            return
+        if self.secretKeyPasswordEdit.text() is None or len(self.secretKeyPasswordEdit.text()) < 4 or self.secretKeyPasswordEdit.text() in ["", "ChangeMe"]:
+            QMessageBox.warning(self, "Cannot start", "Please enter your secret key.")
+            return
+        keepFiles = self.keepIntermediateFilesCheckBox.isChecked()
+        if keepFiles and not (self.verifyGeneratePreparedness() and os.path.isdir(os.path.dirname(self.dwhFhirFileText.text()))):
+            QMessageBox.warning(self, "Cannot start", "Please choose where to keep the RAW and DWH fhir files.")
+            return
+        confirmation = QMessageBox(self)
+        confirmation.setWindowTitle("Confirm action")
+        confirmation.setStandardButtons(QMessageBox.Yes | QMessageBox.No)
+        confirmation.setText(f"Are you sure you want to generate, pseudonymize and upload new data for <b>'{source_id}'</b> from:<br/><br/>{self.dsConfigFileText.text()}")
+        if confirmation.exec() != QMessageBox.Yes:
+            return
+
+        logger.info("Running pipeline for '%s'", source_id)
+        self.pipelineUploadPushButton.setEnabled(False)
+        from i2b2_upload_client.logic import pipeline
+        api_processing.settings.DWH_API_ENDPOINT = self.apiUrlEdit.text()
+        api_processing.settings.dwh_api_key = self.apiKeyPasswordEdit.text()
+        pipeline.settings.compatible_java = settings.compatible_java
+        pipeline.settings.stage1_libs_dir = os.path.abspath(os.path.join(projectRoot, 'resources', 'lib'))
+        self.informUserApi(f"[{nowTimeStamp()}] Generating, pseudonymizing and uploading...", clearInfo=True)
+        workers.runInBackground(withStatusBefore, source_id, pipeline.run_pipeline, self.dsConfigFileText.text(), source_id, self.secretKeyPasswordEdit.text(),
+            keep_raw=self.rawFhirFileText.text() if keepFiles else None, keep_dwh=self.dwhFhirFileText.text() if keepFiles else None,
+            onFinished=lambda result: self.pipelineFinished(source_id, *result[1], result[0]), onFailed=lambda message: self.pipelineFinished(source_id, False, message))
+    def pipelineFinished(self, source_id:str, success:bool, response:str, before:None|dict = None):
+        """ Show the outcome of pipelineUpload """
+        self.sourceInfoErrorBrowser.append(f"<b>API response:</b> {response}")
+        self.pipelineUploadPushButton.setEnabled(True)
+        if success:
+            self.stage1StatusLabel.setText("<b style='color:green; font-size:12pt;'>Status:</b>")
+            self.stage1StatusText.setText("Completed successfully! (pipeline)")
+            self.stage2StatusLabel.setText("<b style='color:green; font-size:12pt;'>Status:</b>")
+            self.stage2StatusText.setText('<html><head/><body><p><span style=" font-size:12pt; font-weight:600;">Stage 2:</span> Completed and uploaded successfully!</p></body></html>')
+            self.informUserApi(f"[{nowTimeStamp()}] Upload complete, check status.")
+            self.uploadCompletion(source_id)
+            self.watchSourceStatus(source_id, api_processing.UPLOAD_STATUSES, before)
+        else:
+            self.stage2StatusLabel.setText("<b style='color:red; font-size:12pt;'>Status:</b>")
+            self.stage2StatusText.setText(f'<html><head/><body><p><span style=" font-size:12pt; font-weight:600;">Pipeline:</span> {response}<br/>The upload did not complete, please check your datasource.xml and the log.</p></body></html>')
+            logger.error("Pipeline had errors: %s", response)
 
     ## DWH processing
     def dwhUploadFhirFilePickerClicked(self):
@@ -296,40 +383,46 @@ class DwhClientWindow(QMainWindow, Ui_MainWindow):
         if response == QMessageBox.Yes:
             logger.info("Uploading new data for '%s'", source_id)
             self.informUserApi(f"[{nowTimeStamp()}] Starting upload", clearInfo=True)
-            ## If file big enough (over 1mb), compress before upload
-            realUploadFilePath = self.newDsFileEdit.text()
             if os.path.getsize(self.newDsFileEdit.text()) > 1000000:
-                logger.info("Compressing before upload...")
                 self.informUserApi(f"[{nowTimeStamp()}] Compressing before upload...")
-                ## TODO: The uplaod is currently hard-coded to always be saved with this name, even if compressed
-                serverBundleName = "fhir-bundle.xml"
-                realUploadFilePath = os.path.join(os.path.dirname(self.newDsFileEdit.text()), "upload.gz")
-                if os.path.basename(self.newDsFileEdit.text()) != serverBundleName:
-                    os.rename(self.newDsFileEdit.text(), os.path.join(os.path.dirname(self.newDsFileEdit.text()), serverBundleName))
-                with open(os.path.join(os.path.dirname(self.newDsFileEdit.text()), serverBundleName), 'rb') as f_in:
-                    with gzip.open(realUploadFilePath, 'wb') as f_out:
-                        ## Write the gzipped file
-                        f_out.writelines(f_in)
-                if os.path.basename(self.newDsFileEdit.text()) != serverBundleName:
-                    os.rename(os.path.join(os.path.dirname(self.newDsFileEdit.text()), serverBundleName), self.newDsFileEdit.text())
+            self.newDsUploadPushButton.setEnabled(False)
+            self.uploadProgressBar.setValue(0)
+            self.uploadProgressBar.setFormat("Preparing upload...")
+            self.uploadProgressBar.show()
+            self.cancelUploadPushButton.show()
+            self.uploadWorker = workers.runInBackground(withStatusBefore, source_id, compressAndUploadSource, source_id, self.newDsFileEdit.text(), reportsProgress=True, cancellable=True,
+                onFinished=lambda result: self.uploadFinished(source_id, result[1], result[0]), onFailed=lambda message: self.uploadFinished(source_id, f"Error: {message}"),
+                onProgress=self.uploadProgress)
+    def uploadProgress(self, values:tuple):
+        """ Show upload progress (the first call means compression, if needed, has finished) """
+        sent, total = values
+        if self.uploadProgressBar.format() == "Preparing upload...":
             self.informUserApi(f"[{nowTimeStamp()}] Uploading...")
-            self.sourceInfoErrorBrowser.append(f"<b>API response:</b> {api_processing.uploadSource(source_id, realUploadFilePath)}")
-            if realUploadFilePath != self.newDsFileEdit.text():
-                os.remove(realUploadFilePath)
-            self.informUserApi(f"[{nowTimeStamp()}] Upload complete, check status.")
-            self.uploadCompletion(source_id)
+        self.uploadProgressBar.setValue(int(sent * 1000 / total) if total else 0)
+        self.uploadProgressBar.setFormat(f"%p% ({sent >> 20} of {total >> 20} MB)")
+    def cancelUpload(self):
+        """ Stop the running upload (the server will not receive a complete bundle) """
+        if self.uploadWorker is not None:
+            logger.info("Cancelling upload...")
+            self.informUserApi(f"[{nowTimeStamp()}] Cancelling upload...")
+            self.uploadWorker.cancel()
+    def uploadFinished(self, source_id:str, response:str, before:None|dict = None):
+        """ Show the upload's outcome and refresh the source """
+        self.uploadWorker = None
+        self.uploadProgressBar.hide()
+        self.cancelUploadPushButton.hide()
+        self.newDsUploadPushButton.setEnabled(True)
+        self.sourceInfoErrorBrowser.append(f"<b>API response:</b> {response}")
+        self.informUserApi(f"[{nowTimeStamp()}] Upload finished, check status.")
+        self.uploadCompletion(source_id)
+        if response.startswith("Uploading"):
+            self.watchSourceStatus(source_id, api_processing.UPLOAD_STATUSES, before)
     def uploadCompletion(self, source_id: str):
         """ Post upload processing """
         logger.info("Processing upload completion for source: %s", source_id)
+        ## Select the source once the list has been reloaded
+        self.sourceToSelect = source_id
         self.getDsList()
-        # if self.getUserId() is not None:
-            # source_id = f"{self.getUserId()}_{source_id}"
-            # self.dsSelected(source_id)
-        index = self.dsChooseComboBox.findText(source_id)
-        logger.debug("Updating combo box with source (%s): %s", index, source_id)
-        if index >= 0:
-            self.dsChooseComboBox.setCurrentIndex(index)
-            self.dsSelected(source_id)
     def getUserId(self):
         """ First use prefix of first item """
         userId = None
@@ -367,8 +460,12 @@ class DwhClientWindow(QMainWindow, Ui_MainWindow):
         api_processing.settings.DWH_API_ENDPOINT = self.apiUrlEdit.text()
         api_processing.settings.dwh_api_key = self.apiKeyPasswordEdit.text()
         self.informUserApi(f"[{nowTimeStamp()}] Connecting to server and updating source list...", clearInfo=True)
+        self.apiConnectPushButton.setEnabled(False)
         ## Update sources list
-        sources = api_processing.listDwhSources()
+        workers.runInBackground(api_processing.listDwhSources, fresh=True, onFinished=self.dsListLoaded, onFailed=self.apiCallFailed)
+    def dsListLoaded(self, sources:None|list):
+        """ Populate the list of remote DS's (from getDsList) """
+        self.apiConnectPushButton.setEnabled(True)
         if sources is not None:
             logger.debug("Found sources: %s", sources)
             self.dsChooseComboBox.clear()
@@ -380,6 +477,30 @@ class DwhClientWindow(QMainWindow, Ui_MainWindow):
         else:
             logger.warning("Could not connect to api (%s)", api_processing.settings.DWH_API_ENDPOINT)
             self.informUserApi(f"[{nowTimeStamp()}] Could not connect to api ({api_processing.settings.DWH_API_ENDPOINT})")
+        if self.sourceToSelect is not None:
+            index = self.dsChooseComboBox.findText(self.sourceToSelect)
+            logger.debug("Updating combo box with source (%s): %s", index, self.sourceToSelect)
+            if index >= 0:
+                self.dsChooseComboBox.setCurrentIndex(index)
+                self.dsSelected(self.sourceToSelect)
+            self.sourceToSelect = None
+    def showLastKnownSources(self):
+        """ Fill the list of remote DS's with the last one fetched (eg in the previous session), until connected """
+        api_processing.settings.DWH_API_ENDPOINT = self.apiUrlEdit.text()
+        api_processing.settings.dwh_api_key = self.apiKeyPasswordEdit.text()
+        sources, fetched = api_processing.lastKnownResponse('listDwhSources')
+        if not sources:
+            return
+        ## Nothing selected, so nothing is fetched before the user chooses
+        self.dsChooseComboBox.blockSignals(True)
+        self.dsChooseComboBox.addItems(sources)
+        self.dsChooseComboBox.setCurrentIndex(-1)
+        self.dsChooseComboBox.blockSignals(False)
+        self.informUserApi(f"[{nowTimeStamp()}] Sources as of {datetime.datetime.fromtimestamp(fetched):%Y-%m-%d %H:%M:%S}, connect to refresh the list")
+    def apiCallFailed(self, message:str):
+        """ Tell the user a background API call failed (eg could not connect) """
+        self.apiConnectPushButton.setEnabled(True)
+        self.informUserApi(f"[{nowTimeStamp()}] API call failed: {message}")
 
     def dsSelected(self, source_id: str):
         """ Update selected DS """
@@ -389,32 +510,39 @@ class DwhClientWindow(QMainWindow, Ui_MainWindow):
             self.selectedSourceId = None
         else:
             self.selectedSourceId = source_id
-            selectedSourceStatus = self.showCurrentSourceStatus()
-            # logger.debug("Selected source status: %s", selectedSourceStatus)
             self.newDsNameEdit.setText(self.selectedSourceId)
-            logger.debug("status: %s", dict.get(selectedSourceStatus, 'status', 'Unavailable'))
-            # if dict.get(selectedSourceStatus, 'status', 'Unavailable') == 'Uploaded':
-            if 'status' in selectedSourceStatus and selectedSourceStatus['status'] == 'Uploaded':
-                logger.debug("Setting link line to green")
-                self.uploadProcessLinkLine.setStyleSheet("color: green")
-                self.uploadProcessLinkLine_2.setStyleSheet("color: green")
-                self.uploadProcessLinkLine_3.setStyleSheet("color: green")
-                self.updateSourcePushButton.setStyleSheet("background-color: green; font: bold; color: black;")
-            else:
-                logger.debug("Setting link line to grey")
-                self.uploadProcessLinkLine.setStyleSheet("color: gray")
-                self.uploadProcessLinkLine_2.setStyleSheet("color: gray")
-                self.uploadProcessLinkLine_3.setStyleSheet("color: gray")
-                self.updateSourcePushButton.setStyleSheet("")
-    def showCurrentSourceStatus(self) -> dict:
-        """ Show user status of selected source """
-        dsStatus = api_processing.sourceStatus(self.selectedSourceId)
+            self.showCurrentSourceStatus()
+    def showCurrentSourceStatus(self, fresh:bool = False):
+        """ Show user status of selected source (fetched in the background, unless cached and not fresh) """
+        if self.selectedSourceId is None:
+            return
+        source_id = self.selectedSourceId
+        workers.runInBackground(api_processing.sourceStatus, source_id, fresh=fresh, onFinished=lambda dsStatus: self.sourceStatusLoaded(source_id, dsStatus), onFailed=self.apiCallFailed)
+    def sourceStatusLoaded(self, source_id:str, dsStatus:None|dict):
+        """ Fill the status table and upload/process link (from showCurrentSourceStatus and watchSourceStatus) """
+        if source_id != self.selectedSourceId:
+            logger.debug("Ignoring status of '%s', no longer selected", source_id)
+            return
+        if dsStatus is None:
+            dsStatus = {}
         self.dsStatusTableWidget.setItem(0, 0, QTableWidgetItem(dict.get(dsStatus, 'source_id', 'Unavailable')))
         self.dsStatusTableWidget.setItem(0, 1, QTableWidgetItem(dict.get(dsStatus, 'status', 'Unavailable')))
         self.dsStatusTableWidget.setItem(0, 2, QTableWidgetItem(dict.get(dsStatus, 'sourcesystem_cd', 'Unavailable')))
         self.dsStatusTableWidget.setItem(0, 3, QTableWidgetItem(dict.get(dsStatus, 'last_activity', 'Unavailable')))
         self.dsStatusTableWidget.setItem(0, 4, QTableWidgetItem(dict.get(dsStatus, 'last_update', 'Unavailable')))
-        return dsStatus
+        logger.debug("status: %s", dict.get(dsStatus, 'status', 'Unavailable'))
+        if 'status' in dsStatus and dsStatus['status'] == 'Uploaded':
+            logger.debug("Setting link line to green")
+            self.uploadProcessLinkLine.setStyleSheet("color: green")
+            self.uploadProcessLinkLine_2.setStyleSheet("color: green")
+            self.uploadProcessLinkLine_3.setStyleSheet("color: green")
+            self.updateSourcePushButton.setStyleSheet("background-color: green; font: bold; color: black;")
+        else:
+            logger.debug("Setting link line to grey")
+            self.uploadProcessLinkLine.setStyleSheet("color: gray")
+            self.uploadProcessLinkLine_2.setStyleSheet("color: gray")
+            self.uploadProcessLinkLine_3.setStyleSheet("color: gray")
+            self.updateSourcePushButton.setStyleSheet("")
     def deleteDs(self):
         """ User confirm, then call delete endpoint and show response """
         confirmation = QMessageBox(self)
@@ -425,9 +553,9 @@ class DwhClientWindow(QMainWindow, Ui_MainWindow):
 
         if response == QMessageBox.Yes:
             self.informUserApi(f"[{nowTimeStamp()}] Connecting to server and deleting source...", clearInfo=True)
-            self.sourceInfoErrorBrowser.setText(api_processing.deleteSource(self.selectedSourceId))
-            time.sleep(0.2)
-            self.showCurrentSourceStatus()
+            source_id = self.selectedSourceId
+            workers.runInBackground(withStatusBefore, source_id, api_processing.deleteSource, source_id,
+                onFinished=lambda result: self.apiActionFinished(result[1], None, source_id, api_processing.DELETE_STATUSES, result[0]), onFailed=self.apiCallFailed)
 
     def processDs(self):
         """ User confirm, then call process endpoint and show response """
@@ -439,19 +567,97 @@ class DwhClientWindow(QMainWindow, Ui_MainWindow):
 
         if response == QMessageBox.Yes:
             self.informUserApi(f"[{nowTimeStamp()}] Connecting to server and processing source...", clearInfo=True)
-            self.sourceInfoErrorBrowser.setText(api_processing.processSource(self.selectedSourceId))
-            self.informUserApi(f"[{nowTimeStamp()}] Processing can take some time, reload the status to view progress...")
-            time.sleep(0.2)
-            self.showCurrentSourceStatus()
+            source_id = self.selectedSourceId
+            workers.runInBackground(withStatusBefore, source_id, api_processing.processSource, source_id,
+                onFinished=lambda result: self.apiActionFinished(result[1], "Processing can take some time, reload the status to view progress...", source_id, api_processing.PROCESS_STATUSES, result[0]),
+                onFailed=self.apiCallFailed)
+    def apiActionFinished(self, response:str, followUp:None|str = None, source_id:None|str = None, statuses = None, before:None|dict = None):
+        """ Show the response of delete/process and the new status (kept up to date until it is final, with auto-refresh) """
+        self.sourceInfoErrorBrowser.setText(response)
+        if followUp is not None:
+            self.informUserApi(f"[{nowTimeStamp()}] {followUp}")
+        if source_id is not None and not response.startswith("Error") and self.autoRefreshCheckBox.isChecked():
+            self.watchSourceStatus(source_id, statuses, before)
+        else:
+            ## Give the server a moment before asking for the status, without blocking the UI
+            QTimer.singleShot(200, self.showCurrentSourceStatus)
+    def watchSourceStatus(self, source_id:str, statuses, before:None|dict):
+        """ With auto-refresh, reload the status in the background (backing off while it doesn't change) until it is one of statuses """
+        self.stopWatchingStatus()
+        if not self.autoRefreshCheckBox.isChecked():
+            return
+        logger.info("Watching the status of '%s' until it is %s", source_id, statuses)
+        self.statusWatcher = workers.runInBackground(api_processing.waitForStatus, source_id, statuses, before, reportsProgress=True, cancellable=True,
+            onProgress=lambda values: self.sourceStatusLoaded(source_id, values[0]),
+            onFinished=lambda dsStatus: self.statusWatchFinished(source_id, statuses, dsStatus), onFailed=self.apiCallFailed)
+    def statusWatchFinished(self, source_id:str, statuses, dsStatus:None|dict):
+        """ Tell the user the action has finished (from watchSourceStatus, also called when cancelled) """
+        if dsStatus is not None and dsStatus.get('status') in statuses:
+            self.informUserApi(f"[{nowTimeStamp()}] '{source_id}' is now {dsStatus['status']}")
+    def stopWatchingStatus(self):
+        """ Stop the auto-refresh, if running """
+        if self.statusWatcher is not None:
+            self.statusWatcher.cancel()
+            self.statusWatcher = None
+    def autoRefreshToggled(self, checked:bool):
+        if not checked:
+            self.stopWatchingStatus()
+    def closeEvent(self, event):
+        """ Don't keep the application waiting for an auto-refresh on exit, keep the API responses for next time """
+        self.stopWatchingStatus()
+        api_processing.saveResponseCache()
+        super().closeEvent(event)
     def showDsInfo(self):
         """ Simply call info endpoint and show response """
-        self.sourceInfoErrorBrowser.setText(api_processing.getSourceInfo(self.selectedSourceId))
+        workers.runInBackground(api_processing.getSourceInfo, self.selectedSourceId, onFinished=self.sourceInfoErrorBrowser.setText, onFailed=self.apiCallFailed)
         self.showCurrentSourceStatus()
     def showDsError(self):
         """ Simply call error endpoint and show response """
-        self.sourceInfoErrorBrowser.setText(api_processing.getSourceError(self.selectedSourceId))
+        workers.runInBackground(api_processing.getSourceError, self.selectedSourceId, onFinished=self.sourceInfoErrorBrowser.setText, onFailed=self.apiCallFailed)
         self.showCurrentSourceStatus()
 
+    ## Overview of all sources
+    def showAllSourcesOverview(self):
+        """ Fetch status, info and error of every source (in parallel) and fill the overview table """
+        api_processing.settings.DWH_API_ENDPOINT = self.apiUrlEdit.text()
+        api_processing.settings.dwh_api_key = self.apiKeyPasswordEdit.text()
+        self.overviewRefreshPushButton.setEnabled(False)
+        self.overviewInfoLabel.setText(f"[{nowTimeStamp()}] Fetching the status of all sources...")
+        workers.runInBackground(api_processing.allSourceDetails, fresh=True, onFinished=self.allSourcesOverviewLoaded,
+            onFailed=lambda message: self.allSourcesOverviewLoaded(None))
+    def allSourcesOverviewLoaded(self, sourcesDetails:None|list):
+        """ Fill the overview table (from showAllSourcesOverview) """
+        self.overviewRefreshPushButton.setEnabled(True)
+        if sourcesDetails is None:
+            logger.warning("Could not connect to api (%s)", api_processing.settings.DWH_API_ENDPOINT)
+            self.overviewInfoLabel.setText(f"[{nowTimeStamp()}] Could not connect to api ({api_processing.settings.DWH_API_ENDPOINT})")
+            return
+        ## Sorting while filling would move rows under our feet
+        self.overviewTableWidget.setSortingEnabled(False)
+        self.overviewTableWidget.setRowCount(len(sourcesDetails))
+        for row, details in enumerate(sourcesDetails):
+            status = details['status'] or {}
+            values = [details['source_id'], status.get('status', 'Unavailable'), status.get('sourcesystem_cd', ''), status.get('last_activity', ''), status.get('last_update', ''),
+                api_processing.firstLine(details['info']), api_processing.firstLine(details['error'] or details['failure'])]
+            for column, value in enumerate(values):
+                item = QTableWidgetItem(str(value))
+                if column >= 5 and value:
+                    item.setToolTip(details['info'] if column == 5 else (details['error'] or details['failure']))
+                self.overviewTableWidget.setItem(row, column, item)
+        self.overviewTableWidget.setSortingEnabled(True)
+        self.overviewInfoLabel.setText(f"[{nowTimeStamp()}] Status of {len(sourcesDetails)} sources")
+    def overviewSourceChosen(self, row:int, column:int):
+        """ Open the double clicked source in the DWH tab """
+        source_id = self.overviewTableWidget.item(row, 0).text()
+        index = self.dsChooseComboBox.findText(source_id)
+        if index >= 0:
+            self.dsChooseComboBox.setCurrentIndex(index)
+        else:
+            ## Not listed yet, select it once the list has been loaded
+            self.sourceToSelect = source_id
+            self.getDsList()
+        self.tabWidget.setCurrentWidget(self.dwhTab)
+
     def informUserApi(self, infoText:str, clearInfo:bool = False):
         """ Display some text to user about what the client is doing """
         if clearInfo:
@@ -459,6 +665,35 @@ class DwhClientWindow(QMainWindow, Ui_MainWindow):
         else:
             self.sourceInfoErrorBrowser.append(infoText)
 
+## Bytes compressed between checks for a cancelled upload
+COMPRESS_CHUNK_BYTES:int = 1 << 20
+
+def withStatusBefore(source_id:str, function, *args, **kwargs) -> tuple:
+    """ The source's status right before function(*args, **kwargs) (fresh, the one last shown may be old), and function's result.
+    Runs in a worker: auto-refresh then waits for the action's status rather than one the source had before
+    """
+    return api_processing.sourceStatus(source_id, fresh=True), function(*args, **kwargs)
+def compressAndUploadSource(source_id:str, filePath:str, progress = None, cancelled = None) -> str:
+    """ Upload the bundle, compressed first if it is big enough (over 1mb). Runs in a worker, so no widgets here
+    The bundle itself is left untouched, it is compressed into a temporary directory next to it (stopping if cancelled() becomes true)
+    """
+    if os.path.getsize(filePath) <= 1000000:
+        return api_processing.uploadSource(source_id, filePath, progress=progress, cancelled=cancelled)
+    logger.info("Compressing before upload...")
+    ## TODO: The uplaod is currently hard-coded to always be saved with this name, even if compressed
+    serverBundleName = "fhir-bundle.xml"
+    with tempfile.TemporaryDirectory(prefix=".upload-", dir=os.path.dirname(os.path.abspath(filePath))) as uploadDir:
+        realUploadFilePath = os.path.join(uploadDir, "upload.gz")
+        with open(filePath, 'rb') as f_in, open(realUploadFilePath, 'wb') as gz_f:
+            ## The name stored in the gzip is the server's, whatever the bundle is called here
+            with gzip.GzipFile(filename=serverBundleName, mode='wb', fileobj=gz_f) as f_out:
+                while chunk := f_in.read(COMPRESS_CHUNK_BYTES):
+                    if cancelled is not None and cancelled():
+                        logger.warning("Upload of '%s' cancelled while compressing", source_id)
+                        return "Upload cancelled"
+                    f_out.write(chunk)
+        return api_processing.uploadSource(source_id, realUploadFilePath, progress=progress, cancelled=cancelled)
+
 def nowTimeStamp() -> str:
     """ Simply return the formatted current datetime 
     TODO: Better would be to leverage the logging module even for user feedback """
@@ -466,6 +701,8 @@ def nowTimeStamp() -> str:
     # return f"{datetime.datetime.now():%Y-%m-%d %H:%M:%S}"
 
 def main():
+    ## Pseudonymization can use worker processes, which the frozen (pyinstaller) binary must support
+    multiprocessing.freeze_support()
     # You need one (and only one) QApplication instance per application.
     # Pass in sys.argv to allow command line arguments for your app.
     # If you know you won't use command line arguments QApplication([]) works too.
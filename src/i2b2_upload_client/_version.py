@@ -0,0 +1,2 @@
+## Written by src/build_executables.py (update_version_file) from pyproject.toml, don't edit
+__version__ = "0.2.1"
@@ -0,0 +1,63 @@
+#!/usr/bin/env python3
+"""
+Description: Console entry point (dwh_cli) for the headless operations, never imports Qt
+stderr: for logs
+
+Usage: dwh_cli <command> [options], eg `dwh_cli api --list`, `dwh_cli pipeline --help`, `dwh_cli version`
+Explainer: Each command is one of the logic modules, run as if called as a script (same options). Only that module
+is imported, and only once the command is known, so `dwh_cli --help` and `dwh_cli version` start without importing
+any of them (no Settings here either: pydantic_settings alone takes about a third of a second to import).
+"""
+
+## Import built-ins
+import runpy
+import sys
+
+## command: (module run as script, description)
+COMMANDS:dict[str, tuple[str, str]] = {
+    "api": ("i2b2_upload_client.logic.api_processing", "List, upload, process and delete sources via the DWH API (also --batch)"),
+    "pipeline": ("i2b2_upload_client.logic.pipeline", "Generate, pseudonymize and upload a source in one pass"),
+    "pseudonymize": ("i2b2_upload_client.logic.stream_pseudonymization", "Pseudonymize a fhir bundle (stage 2)"),
+    "tabular": ("i2b2_upload_client.logic.tabular_pseudonymization", "Pseudonymize a datasource's patient table before stage 1"),
+    "scan": ("i2b2_upload_client.logic.source_scanner", "Regenerate the bundles of the local sources that changed"),
+    "stage1": ("i2b2_upload_client.logic.stage1_scheduler", "Generate the raw fhir bundles of many datasources at once"),
+    "delta": ("i2b2_upload_client.logic.delta_manifest", "Show what changed since the previous pseudonymization run"),
+    "stats": ("i2b2_upload_client.logic.bundle_statistics", "Show the statistics report of a pseudonymization run"),
+    "store": ("i2b2_upload_client.logic.pseudonym_store", "Export the pseudonym store as a mapping TSV"),
+    "lookup": ("i2b2_upload_client.logic.pseudonym_lookup", "Find patients by pseudonym, or pseudonyms by patient (indexed)"),
+}
+
+def version() -> str:
+    """ Version written at build time, see build_executables.py """
+    try:
+        from i2b2_upload_client._version import __version__
+    except ImportError:
+        return "Unknown"
+    return __version__
+
+def usage() -> str:
+    width = max(len(command) for command in COMMANDS)
+    lines = ["usage: dwh_cli <command> [options]", "", "Headless DWH client operations, see `dwh_cli <command> --help` for each.", "", "commands:"]
+    lines += [f"  {command:<{width}}  {description}" for command, (_, description) in COMMANDS.items()]
+    lines += [f"  {'version':<{width}}  Print the client version"]
+    return "\n".join(lines)
+
+def main(argv:None|list[str] = None) -> None:
+    """ Run the command's module with the remaining arguments """
+    argv = sys.argv[1:] if argv is None else argv
+    if not argv or argv[0] in ["-h", "--help", "help"]:
+        print(usage())
+        return
+    if argv[0] in ["version", "--version"]:
+        print(version())
+        return
+    if argv[0] not in COMMANDS:
+        print(f"dwh_cli: unknown command '{argv[0]}'\n\n{usage()}", file=sys.stderr)
+        sys.exit(2)
+    ## As __main__ (alter_sys), like `python -m`, so its functions can be pickled for the worker processes
+    sys.argv = argv
+    runpy.run_module(COMMANDS[argv[0]][0], run_name="__main__", alter_sys=True)
+
+## When called as script (not run if imported as module):
+if __name__ == "__main__":
+    main()
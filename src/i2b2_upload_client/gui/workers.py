@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+"""
+Description: Run blocking (network) calls of the GUI in a thread pool, reporting back to the UI thread with signals
+stderr: for logs
+
+Usage: from i2b2_upload_client.gui.workers import Worker
+Explainer: Qt widgets may only be touched by the UI thread. A Worker runs its function on QThreadPool.globalInstance()
+and emits the result (or error) as a signal, which Qt delivers to the connected slot on the UI thread.
+Functions which accept a `progress` (and `cancelled`) keyword argument can report progress (and be cancelled).
+"""
+
+## Import built-ins
+import threading
+
+## Import third party libraries
+import logging
+from pydantic_settings import BaseSettings
+from PySide6.QtCore import QObject, QRunnable, QThreadPool, Signal
+
+## ---------------- ##
+## Create  settings ##
+## ---------------- ##
+class Settings(BaseSettings):
+    """ The variables defined here will be taken from env vars if available and matching the type hint """
+    log_level: str = "WARNING"
+    log_format: str = "[%(asctime)s] {%(name)s/%(module)s:%(lineno)d (%(funcName)s)} %(levelname)s - %(message)s"
+settings = Settings()
+
+## Load logger for this file/script
+formatter = logging.Formatter(settings.log_format)
+logging.basicConfig(format=settings.log_format)
+## Set app's logger level and format...
+logger = logging.getLogger(__name__)
+logger.setLevel(settings.log_level)
+
+class WorkerSignals(QObject):
+    """ QRunnable can't have signals itself """
+    finished = Signal(object)
+    failed = Signal(str)
+    ## The arguments the function passed to progress(), as a tuple
+    progress = Signal(tuple)
+
+class Worker(QRunnable):
+    """ Call function(*args, **kwargs) in the thread pool
+    With reportsProgress, the function is also passed a progress(*values) keyword argument, with cancellable a cancelled() one
+    """
+    def __init__(self, function, *args, reportsProgress:bool = False, cancellable:bool = False, **kwargs):
+        super().__init__()
+        self.function = function
+        self.args = args
+        self.kwargs = kwargs
+        self.signals = WorkerSignals()
+        self._cancel = threading.Event()
+        if reportsProgress:
+            self.kwargs['progress'] = lambda *values: self.signals.progress.emit(values)
+        if cancellable:
+            self.kwargs['cancelled'] = self._cancel.is_set
+
+    def run(self):
+        """ Runs in a pool thread, never touch widgets here """
+        try:
+            result = self.function(*self.args, **self.kwargs)
+        except Exception as err:
+            logger.error("Background call to %s failed: %s", getattr(self.function, '__name__', self.function), err, exc_info=True)
+            self.signals.failed.emit(str(err))
+        else:
+            self.signals.finished.emit(result)
+
+    def cancel(self):
+        """ Ask the function to stop (only has an effect if cancellable) """
+        self._cancel.set()
+
+    @property
+    def isCancelled(self) -> bool:
+        return self._cancel.is_set()
+
+def runInBackground(function, *args, onFinished = None, onFailed = None, onProgress = None, reportsProgress:bool = False, cancellable:bool = False, **kwargs) -> Worker:
+    """ Start a Worker and connect its signals, returns the worker (eg to cancel it) """
+    worker = Worker(function, *args, reportsProgress=reportsProgress, cancellable=cancellable, **kwargs)
+    if onFinished is not None:
+        worker.signals.finished.connect(onFinished)
+    if onFailed is not None:
+        worker.signals.failed.connect(onFailed)
+    if onProgress is not None:
+        worker.signals.progress.connect(onProgress)
+    QThreadPool.globalInstance().start(worker)
+    return worker
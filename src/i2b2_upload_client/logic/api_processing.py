@@ -5,15 +5,25 @@ stderr: for logs
 """
 
 ## Import built-ins
-from functools import cache
+import asyncio
+from collections import OrderedDict
+import copy
+from functools import cache, wraps
+import hashlib
+import io
 import json
 import os
 import sys
+import threading
+import time
+import uuid
 
 ## Import third party libraries
 import logging
 from pydantic_settings import BaseSettings
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 class AppMeta():
     """ Purely constants """
@@ -30,6 +40,25 @@ class Settings(BaseSettings):
     log_format: str = "[%(asctime)s] {%(name)s/%(module)s:%(lineno)d (%(funcName)s)} %(levelname)s - %(message)s"
     DWH_API_ENDPOINT: str = "https://data.dzl.de/api"
     dwh_api_key: str = ""
+    api_connect_timeout: float = 10.0
+    api_read_timeout: float = 300.0
+    api_retries: int = 3
+    api_backoff_factor: float = 0.5
+    api_pool_size: int = 10
+    api_concurrency: int = 8
+    ## Sources uploaded/processed at once in a batch (--batch), lowered for a while when the server is busy (429/5xx)
+    api_batch_concurrency: int = 4
+    ## Waiting for a status (--wait, GUI auto-refresh): poll after api_wait_interval seconds, backing off (x api_wait_backoff,
+    ## up to api_wait_max_interval) while the status doesn't change, and give up after api_wait_timeout seconds
+    api_wait_interval: float = 2.0
+    api_wait_backoff: float = 1.5
+    api_wait_max_interval: float = 60.0
+    api_wait_timeout: float = 3600.0
+    ## Responses of read endpoints (source list, status, connection check) are reused for api_cache_ttl seconds (0: not cached),
+    ## at most api_cache_size of them. Saved to api_cache_filename (JSON) if set, so the last known sources can be shown on startup
+    api_cache_ttl: float = 30.0
+    api_cache_size: int = 256
+    api_cache_filename: str = ""
 settings = Settings()
 
 ## Load logger for this file/script
@@ -40,23 +69,188 @@ logger = logging.getLogger(AppMeta.app_sub_name)
 logger.setLevel(settings.log_level)
 logger.debug("Logging loaded with default configuration")
 
+class ApiClient():
+    """ Pooled (keep-alive) session shared by all API calls, with timeouts and retries
+    Connection errors are retried for every request, 5xx responses only for idempotent ones (not upload or process)
+    Each retry waits exponentially longer (api_backoff_factor * 2^n seconds)
+    """
+    def __init__(self, retries:None|int = None, backoff_factor:None|float = None, timeout:None|tuple = None, pool_size:None|int = None):
+        """ Defaults from settings """
+        if retries is None:
+            retries = settings.api_retries
+        if backoff_factor is None:
+            backoff_factor = settings.api_backoff_factor
+        if pool_size is None:
+            pool_size = settings.api_pool_size
+        self.timeout = (settings.api_connect_timeout, settings.api_read_timeout) if timeout is None else timeout
+        retry = Retry(total=retries, connect=retries, read=retries, status=retries, backoff_factor=backoff_factor,
+            status_forcelist=(500, 502, 503, 504), allowed_methods=frozenset({'GET', 'HEAD', 'OPTIONS', 'DELETE'}), raise_on_status=False)
+        adapter = HTTPAdapter(max_retries=retry, pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session = requests.Session()
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+    def request(self, method:str, path:str, apiEndpoint:str = None, apiKey:str = None, **kwargs) -> requests.Response:
+        """ Call path (eg 'datasource/<id>/etl') of the API, endpoint and key default to the current settings """
+        ## Pick up defaults here, in case they are changed after creating the client (eg by the GUI)
+        if apiEndpoint is None:
+            apiEndpoint = settings.DWH_API_ENDPOINT
+        if apiKey is None:
+            apiKey = settings.dwh_api_key
+        headers = {'x-api-key': apiKey, **kwargs.pop('headers', {})}
+        kwargs.setdefault('timeout', self.timeout)
+        logger.debug("Connecting to api: %s", apiEndpoint)
+        return self.session.request(method, f'{apiEndpoint.rstrip("/")}/{path}', headers=headers, **kwargs)
+
+    def get(self, path:str, **kwargs) -> requests.Response:
+        return self.request('GET', path, **kwargs)
+    def put(self, path:str, **kwargs) -> requests.Response:
+        return self.request('PUT', path, **kwargs)
+    def post(self, path:str, **kwargs) -> requests.Response:
+        return self.request('POST', path, **kwargs)
+    def delete(self, path:str, **kwargs) -> requests.Response:
+        return self.request('DELETE', path, **kwargs)
+
+    def close(self):
+        """ Close the pooled connections """
+        self.session.close()
+
 @cache
-def checkApiUserConnection(apiEndpoint:str = None, apiKey:str = None) -> dict:
-    """ Connect to API and check for 401 response code
-    return {isAuthorized: bool, responseCode: int} 
+def getApiClient() -> ApiClient:
+    """ The client shared by all functions of this module """
+    return ApiClient()
+
+class ResponseCache():
+    """ Responses of the read endpoints, each reused for ttl seconds, at most max_size of them (least recently used dropped first)
+    Entries are stored with the (wall clock) time they were fetched, so they can be saved and loaded again later.
+    Thread-safe, the GUI calls the API from worker threads.
     """
-    ## Pick up defaults here, in case they are changed after loading the module
+    def __init__(self, ttl:None|float = None, max_size:None|int = None):
+        """ Defaults from settings """
+        self.ttl = settings.api_cache_ttl if ttl is None else ttl
+        self.max_size = settings.api_cache_size if max_size is None else max_size
+        self.entries:OrderedDict = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key:tuple, maxAge:None|float = None) -> tuple[bool, object, None|float]:
+        """ (True, value, fetched) if key was fetched within maxAge (default ttl) seconds, else (False, None, None) """
+        maxAge = self.ttl if maxAge is None else maxAge
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or time.time() - entry[0] > maxAge:
+                self.misses += 1
+                return False, None, None
+            self.hits += 1
+            self.entries.move_to_end(key)
+            return True, copy.deepcopy(entry[1]), entry[0]
+
+    def set(self, key:tuple, value, fetched:None|float = None):
+        """ Store a (fresh) response """
+        with self.lock:
+            self.entries[key] = (time.time() if fetched is None else fetched, copy.deepcopy(value))
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def invalidate(self, source_id:None|str = None, sources:bool = True):
+        """ Forget everything fetched about source_id, and (with sources, it may have joined or left them) the source lists. Everything if None """
+        with self.lock:
+            if source_id is None:
+                self.entries.clear()
+                return
+            for key in [key for key in self.entries if (sources and key[2] == 'listDwhSources') or source_id in key[3:]]:
+                del self.entries[key]
+        logger.debug("Cached responses about '%s' invalidated", source_id)
+
+    def save(self, path:str):
+        """ Write the entries to path (JSON), replacing it only once complete """
+        with self.lock:
+            entries = [[list(key), fetched, value] for key, (fetched, value) in self.entries.items()]
+        with open(path + '.tmp', 'w') as cache_f:
+            json.dump({"entries": entries}, cache_f)
+        os.replace(path + '.tmp', path)
+        logger.debug("Saved %s cached responses to '%s' (%s hits, %s misses)", len(entries), path, self.hits, self.misses)
+
+    def load(self, path:str):
+        """ Add the entries saved in path (if it exists and is readable), keeping when they were fetched """
+        try:
+            with open(path) as cache_f:
+                entries = json.load(cache_f)['entries']
+        except (OSError, ValueError, KeyError) as err:
+            logger.debug("No cached responses loaded from '%s': %s", path, err)
+            return
+        for key, fetched, value in entries:
+            self.set(tuple(key), value, fetched)
+        logger.debug("Loaded %s cached responses from '%s'", len(entries), path)
+
+## The cache shared by all functions of this module
+responseCache = ResponseCache()
+
+def _cacheKey(name:str, *args, apiEndpoint:str = None, apiKey:str = None) -> tuple:
+    """ Key of a response: the endpoint and (a hash of) the key, so other servers and users don't get it, the function and its arguments """
     if apiEndpoint is None:
         apiEndpoint = settings.DWH_API_ENDPOINT
     if apiKey is None:
         apiKey = settings.dwh_api_key
-    logger.debug("Connecting to api: %s", apiEndpoint)
+    return (apiEndpoint.rstrip("/"), hashlib.sha256(apiKey.encode()).hexdigest()[:16], name, *args)
+
+def cachedResponse(function):
+    """ Reuse the function's result (unless None, eg failed) from responseCache while fresh, fresh=True fetches (and caches) it anyway """
+    @wraps(function)
+    def wrapper(*args, fresh:bool = False):
+        key = _cacheKey(function.__name__, *args)
+        if not fresh:
+            found, value, _ = responseCache.get(key)
+            if found:
+                logger.debug("Cached response: %s", key[2:])
+                return value
+        value = function(*args)
+        if value is not None:
+            responseCache.set(key, value)
+        return value
+    return wrapper
+
+def lastKnownResponse(name:str, *args) -> tuple[object, None|float]:
+    """ The last response of function name (eg 'listDwhSources') for these arguments however old, and when it was fetched (None if never) """
+    _, value, fetched = responseCache.get(_cacheKey(name, *args), maxAge=float('inf'))
+    return value, fetched
+
+def loadResponseCache(path:None|str = None):
+    """ Load responses saved by saveResponseCache, path defaults to api_cache_filename (nothing happens if that is empty) """
+    path = settings.api_cache_filename if path is None else path
+    if path:
+        responseCache.load(path)
+def saveResponseCache(path:None|str = None):
+    """ Save the cached responses, path defaults to api_cache_filename (nothing happens if that is empty) """
+    path = settings.api_cache_filename if path is None else path
+    if path:
+        try:
+            responseCache.save(path)
+        except OSError as err:
+            logger.warning("Could not save cached responses to '%s': %s", path, err)
+
+def checkApiUserConnection(apiEndpoint:str = None, apiKey:str = None) -> dict:
+    """ Connect to API and check for 401 response code (a conclusive answer is cached, see responseCache)
+    return {isAuthorized: bool, responseCode: int} 
+    """
+    key = _cacheKey('checkApiUserConnection', apiEndpoint=apiEndpoint, apiKey=apiKey)
+    found, apiUserCheck, _ = responseCache.get(key)
+    if found:
+        return apiUserCheck
     isAuthorized = False
-    response = requests.get(f'{apiEndpoint.rstrip("/")}/datasource', headers={'x-api-key': apiKey})
+    response = getApiClient().get('datasource', apiEndpoint=key[0], apiKey=settings.dwh_api_key if apiKey is None else apiKey)
     logger.debug("Response (%s): %s", response.status_code, response)
     if response.status_code != 401:
         isAuthorized = True
-    return {"isAuthorized": isAuthorized, "responseCode": response.status_code}
+    apiUserCheck = {"isAuthorized": isAuthorized, "responseCode": response.status_code}
+    if response.status_code in (200, 401, 403):
+        responseCache.set(key, apiUserCheck)
+    if response.status_code == 200:
+        ## Same request as listDwhSources, which is usually next
+        responseCache.set((*key[:2], 'listDwhSources'), [source['source_id'] for source in response.json()])
+    return apiUserCheck
 
 def isValidApiUser(apiUserCheck:dict = None) -> bool:
     """ Use response from checkApiUserConnection to check for validity """
@@ -68,12 +262,12 @@ def isValidApiUser(apiUserCheck:dict = None) -> bool:
         logger.error("API connection not valid.")
         return False
 
+@cachedResponse
 def listDwhSources() -> list:
-    """ Convert the response into a plain list """
+    """ Convert the response into a plain list (cached, see cachedResponse) """
     ## Return empty list if no sources on server (but connection succeeded)
     ## and None if curl/connection errors
-    logger.debug("Connecting to api: %s", settings.DWH_API_ENDPOINT)
-    response = requests.get(f'{settings.DWH_API_ENDPOINT.rstrip("/")}/datasource', headers={'x-api-key': settings.dwh_api_key})
+    response = getApiClient().get('datasource')
     logger.debug("Response (%s): %s", response.status_code, response)
     if response.status_code != 200:
         logger.warning("Failed to connect to API")
@@ -85,11 +279,11 @@ def listDwhSources() -> list:
         sourceIds = [source['source_id'] for source in sources]
     return sourceIds
 
+@cachedResponse
 def sourceStatus(source_id: str) -> dict:
-    """ Convert the response into a plain dict """
+    """ Convert the response into a plain dict (cached, see cachedResponse) """
     ## Return empty list and error code if curl errors
-    logger.debug("Connecting to api: %s", settings.DWH_API_ENDPOINT)
-    response = requests.get(f'{settings.DWH_API_ENDPOINT.rstrip("/")}/datasource/{source_id}/etl', headers={'x-api-key': settings.dwh_api_key})
+    response = getApiClient().get(f'datasource/{source_id}/etl')
     logger.debug("Response: %s", response)
     if response.status_code != 200:
         logger.warning("Failed to connect to API")
@@ -97,50 +291,392 @@ def sourceStatus(source_id: str) -> dict:
     source = response.json()
     logger.debug("...and data: %s", source)
     return source
+## Statuses after which nothing more happens until the next action
+TERMINAL_STATUSES:frozenset = frozenset({"Uploaded", "Succeeded", "Failed", "Deleted"})
+## What each action ends in
+UPLOAD_STATUSES:frozenset = frozenset({"Uploaded", "Failed"})
+PROCESS_STATUSES:frozenset = frozenset({"Succeeded", "Failed"})
+DELETE_STATUSES:frozenset = frozenset({"Deleted"})
+
+def _pollSourceStatus(source_id: str, validators: dict) -> tuple[None|dict, bool]:
+    """ Fetch the status, conditional on the ETag/Last-Modified of the previous response (kept in validators)
+    Returns (status, True), or (None, False) if the server says it is unchanged. A source the server doesn't know (any more) is 'Deleted'
+    """
+    headers = {}
+    if validators.get('etag'):
+        headers['If-None-Match'] = validators['etag']
+    elif validators.get('last_modified'):
+        headers['If-Modified-Since'] = validators['last_modified']
+    response = getApiClient().get(f'datasource/{source_id}/etl', headers=headers)
+    if response.status_code == 304:
+        return None, False
+    if response.status_code == 404:
+        return {"source_id": source_id, "status": "Deleted"}, True
+    if response.status_code != 200:
+        raise requests.HTTPError(f"Status request failed ({response.status_code})", response=response)
+    validators['etag'] = response.headers.get('ETag')
+    validators['last_modified'] = response.headers.get('Last-Modified')
+    return response.json(), True
+
+def _sleep(seconds: float, cancelled = None) -> bool:
+    """ Sleep, returns early (True) if cancelled() becomes true """
+    deadline = time.monotonic() + seconds
+    while (remaining := deadline - time.monotonic()) > 0:
+        if cancelled is not None and cancelled():
+            return True
+        time.sleep(min(remaining, 0.25))
+    return cancelled is not None and cancelled()
+
+def waitForStatus(source_id: str, statuses = None, before: None|dict = None, timeout: None|float = None, progress = None, cancelled = None) -> None|dict:
+    """ Poll the source's status until it is one of statuses (default TERMINAL_STATUSES), returns that status
+    before: the status seen before an action, it doesn't count (eg the previous run's 'Failed' straight after processing again)
+    progress(status) is called with every new status. Polls quickly while the status changes and backs off while it doesn't.
+    Raises TimeoutError after timeout seconds (default api_wait_timeout), returns the latest status (or None) if cancelled() is true
+    """
+    statuses = TERMINAL_STATUSES if statuses is None else frozenset(statuses)
+    timeout = settings.api_wait_timeout if timeout is None else timeout
+    deadline = time.monotonic() + timeout
+    interval = settings.api_wait_interval
+    validators:dict = {}
+    current = None
+    while True:
+        try:
+            status, changed = _pollSourceStatus(source_id, validators)
+        except requests.RequestException as err:
+            logger.warning("Could not fetch the status of '%s', trying again: %s", source_id, err)
+            status, changed = None, False
+        if changed and status != current:
+            current = status
+            ## Keep the cache up to date for whoever asks next
+            if current.get('status') == 'Deleted':
+                responseCache.invalidate(source_id)
+            else:
+                responseCache.set(_cacheKey('sourceStatus', source_id), current)
+            ## Something is happening, look again soon
+            interval = settings.api_wait_interval
+            if progress is not None:
+                progress(current)
+            if current.get('status') in statuses and current != before:
+                return current
+        else:
+            interval = min(interval * settings.api_wait_backoff, settings.api_wait_max_interval)
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            raise TimeoutError(f"'{source_id}' didn't reach {'/'.join(sorted(statuses))} within {timeout:.0f}s (last status: {(current or {}).get('status', 'unknown')})")
+        if _sleep(min(interval, remaining), cancelled):
+            return current
+
 def getSourceInfo(source_id: str) -> str:
     """ Call endpoint """
-    logger.debug("Connecting to api: %s", settings.DWH_API_ENDPOINT)
-    response = requests.get(f'{settings.DWH_API_ENDPOINT.rstrip("/")}/datasource/{source_id}/etl/info', headers={'x-api-key': settings.dwh_api_key})
+    response = getApiClient().get(f'datasource/{source_id}/etl/info')
     return response.content.decode()
 def getSourceError(source_id: str) -> str:
     """ Call endpoint """
-    logger.debug("Connecting to api: %s", settings.DWH_API_ENDPOINT)
-    response = requests.get(f'{settings.DWH_API_ENDPOINT.rstrip("/")}/datasource/{source_id}/etl/error', headers={'x-api-key': settings.dwh_api_key})
+    response = getApiClient().get(f'datasource/{source_id}/etl/error')
     return response.content.decode()
 
 def deleteSource(source_id: str) -> str:
     """ Call endpoint """
-    logger.debug("Connecting to api: %s", settings.DWH_API_ENDPOINT)
-    response = requests.delete(f'{settings.DWH_API_ENDPOINT.rstrip("/")}/datasource/{source_id}', headers={'x-api-key': settings.dwh_api_key})
+    response = getApiClient().delete(f'datasource/{source_id}')
+    responseCache.invalidate(source_id)
     if response.status_code == 202:
         return "Accepted request, processing...\nPlease refresh status to check progress"
     else:
         return f"Error: Something unexpected happended: {response.status_code}: {response.content}"
 
-def uploadSource(source_id: str, sourceFhirBundlePath: str) -> str:
-    """ Call endpoint """
-    logger.debug("Connecting to api: %s", settings.DWH_API_ENDPOINT)
-    url = f'{settings.DWH_API_ENDPOINT.rstrip("/")}/datasource/{source_id}/fhir-bundle'
+class UploadCancelled(Exception):
+    """ Raised (inside the upload) when the user cancelled it """
+
+class _MultipartFileBody():
+    """ The multipart/form-data body requests builds for files={'fhir_bundle': ...}, read from the file as it is sent
+    Has a length (so it's not sent chunked), reports progress(sent, total) and stops if cancelled() becomes true
+    """
+    progress_step:int = 1 << 20
+    def __init__(self, path:str, boundary:str, progress = None, cancelled = None):
+        head = f'--{boundary}\r\nContent-Disposition: form-data; name="fhir_bundle"; filename="{os.path.basename(path)}"\r\n\r\n'.encode()
+        tail = f'\r\n--{boundary}--\r\n'.encode()
+        self.total = len(head) + os.path.getsize(path) + len(tail)
+        self.parts = [io.BytesIO(head), open(path, 'rb'), io.BytesIO(tail)]
+        self.sent = 0
+        self.reported = 0
+        self.progress = progress
+        self.cancelled = cancelled
+    def __len__(self) -> int:
+        return self.total
+    def read(self, size:int = -1) -> bytes:
+        if self.cancelled is not None and self.cancelled():
+            raise UploadCancelled("Upload cancelled")
+        if size is None or size < 0:
+            size = self.total - self.sent
+        data = b''
+        while len(data) < size and self.parts:
+            chunk = self.parts[0].read(size - len(data))
+            if chunk:
+                data += chunk
+            else:
+                self.parts.pop(0).close()
+        self.sent += len(data)
+        ## Report every progress_step bytes (and when done), not every block
+        if self.progress is not None and (self.sent - self.reported >= self.progress_step or (data and self.sent == self.total)):
+            self.reported = self.sent
+            self.progress(self.sent, self.total)
+        return data
+    def close(self):
+        for part in self.parts:
+            part.close()
+
+def _putFhirBundle(source_id: str, sourceFhirBundlePath: str, progress = None, cancelled = None) -> requests.Response:
+    """ Send the bundle file (see uploadSource), returns the server's response. Raises UploadCancelled """
+    boundary = uuid.uuid4().hex
+    body = _MultipartFileBody(sourceFhirBundlePath, boundary, progress, cancelled)
+    headers = {'Content-Type': f'multipart/form-data; boundary={boundary}'}
+    try:
+        return getApiClient().put(f'datasource/{source_id}/fhir-bundle', data=body, headers=headers)
+    finally:
+        body.close()
+        responseCache.invalidate(source_id)
+
+def uploadSource(source_id: str, sourceFhirBundlePath: str, progress = None, cancelled = None) -> str:
+    """ Call endpoint
+    progress(sent, total): called with the bytes sent so far
+    cancelled(): checked while sending, the upload is aborted once it returns true
+    """
     ## basic file check
     if not sourceFhirBundlePath or not os.path.isfile(sourceFhirBundlePath):
         return f"Failed to locate file: '{sourceFhirBundlePath}'"
-    files = {'fhir_bundle': open(sourceFhirBundlePath, 'rb')}
-    headers = {'x-api-key': settings.dwh_api_key}
-    response = requests.put(url, files=files, headers=headers)
+    try:
+        response = _putFhirBundle(source_id, sourceFhirBundlePath, progress, cancelled)
+    except UploadCancelled:
+        logger.warning("Upload of '%s' cancelled", source_id)
+        return "Upload cancelled"
     if response.status_code == 204:
         return "Uploading...\nPlease refresh status to check progress (If this is a new source, refresh list first with the API connect button)"
     else:
         return f"Error: Something unexpected happedned: {response.status_code}: {response.content}"
 
+def uploadSourceStream(source_id: str, chunks, filename: str = "upload.gz") -> str:
+    """ As uploadSource, but the bundle comes from an iterable of bytes (sent chunked, nothing is written to disk)
+    If the iterable raises, the upload is aborted before completing and the exception is passed on
+    """
+    ## Same multipart/form-data body requests builds for uploadSource, but generated as the data arrives
+    boundary = uuid.uuid4().hex
+    def body():
+        yield f'--{boundary}\r\nContent-Disposition: form-data; name="fhir_bundle"; filename="{filename}"\r\n\r\n'.encode()
+        yield from chunks
+        yield f'\r\n--{boundary}--\r\n'.encode()
+    headers = {'Content-Type': f'multipart/form-data; boundary={boundary}'}
+    try:
+        response = getApiClient().put(f'datasource/{source_id}/fhir-bundle', data=body(), headers=headers)
+    finally:
+        responseCache.invalidate(source_id)
+    if response.status_code == 204:
+        return "Uploading...\nPlease refresh status to check progress (If this is a new source, refresh list first with the API connect button)"
+    else:
+        return f"Error: Something unexpected happedned: {response.status_code}: {response.content}"
+
+def _postProcessing(source_id: str) -> requests.Response:
+    """ Ask the server to process the uploaded bundle (see processSource), returns its response """
+    response = getApiClient().post(f'datasource/{source_id}/etl')
+    ## Processing doesn't add or remove sources
+    responseCache.invalidate(source_id, sources=False)
+    return response
+
 def processSource(source_id: str) -> str:
     """ Call endpoint """
-    logger.debug("Connecting to api: %s", settings.DWH_API_ENDPOINT)
-    response = requests.post(f'{settings.DWH_API_ENDPOINT.rstrip("/")}/datasource/{source_id}/etl', headers={'x-api-key': settings.dwh_api_key})
+    response = _postProcessing(source_id)
     if response.status_code == 202:
         return "Accepted request, processing...\nPlease refresh status to check progress"
     else:
         return f"Error: Something unexpected happedned: {response.status_code}: {response.content}"
 
+## Concurrent access (many sources at once)
+async def _limited(semaphore:asyncio.Semaphore, function, *args):
+    """ Run a (blocking) API function in a thread, at most api_concurrency at once """
+    async with semaphore:
+        return await asyncio.to_thread(function, *args)
+
+async def sourceDetailsAsync(source_id:str, semaphore:asyncio.Semaphore, fresh:bool = False) -> dict:
+    """ Status, info and error of one source, fetched in parallel (fresh: don't use a cached status)
+    return {source_id: str, status: dict|None, info: str|None, error: str|None, failure: str|None}
+    """
+    results = await asyncio.gather(_limited(semaphore, lambda: sourceStatus(source_id, fresh=fresh)), _limited(semaphore, getSourceInfo, source_id),
+        _limited(semaphore, getSourceError, source_id), return_exceptions=True)
+    details = {"source_id": source_id, "failure": None}
+    for key, result in zip(["status", "info", "error"], results):
+        if isinstance(result, Exception):
+            logger.warning("Failed to fetch %s of '%s': %s", key, source_id, result)
+            details["failure"] = str(result)
+            result = None
+        details[key] = result
+    return details
+
+async def allSourceDetailsAsync(sourceIds:list = None, concurrency:int = None, fresh:bool = False) -> list:
+    """ sourceDetailsAsync of each source (default: all sources listed by the DWH), in order """
+    if sourceIds is None:
+        sourceIds = await asyncio.to_thread(lambda: listDwhSources(fresh=fresh))
+        if sourceIds is None:
+            return None
+    semaphore = asyncio.Semaphore(settings.api_concurrency if concurrency is None else concurrency)
+    return await asyncio.gather(*[sourceDetailsAsync(sourceId, semaphore, fresh) for sourceId in sourceIds])
+
+def allSourceDetails(sourceIds:list = None, concurrency:int = None, fresh:bool = False) -> list:
+    """ Blocking call of allSourceDetailsAsync (for the GUI and CLI), None if the sources could not be listed """
+    return asyncio.run(allSourceDetailsAsync(sourceIds, concurrency, fresh))
+
+## Batches (upload and process many sources, see cliBatch)
+BATCH_ACTIONS:list[str] = ["upload", "process"]
+
+class BatchJob():
+    """ What to do with one source, and (once run) how it went """
+    def __init__(self, source_id:str, bundlePath:None|str = None, actions:None|list = None):
+        """ Without actions, a source with a bundle is uploaded and processed, one without only processed """
+        self.source_id = source_id
+        self.bundlePath = bundlePath
+        self.actions = actions if actions else (["upload", "process"] if bundlePath else ["process"])
+        self.seconds:dict = {}
+        self.retries = 0
+        self.outcome:None|str = None
+        self.message = ""
+    @property
+    def failed(self) -> bool:
+        return self.outcome in (None, "Error", "Failed")
+
+def readBatchManifest(path:str) -> list[BatchJob]:
+    """ Jobs of a manifest ('-' for stdin): one source per line, tab separated: source name, bundle path (optional),
+    actions (optional, comma separated: upload, process). Empty lines and # comments are skipped, bundle paths are
+    relative to the manifest. Raises ValueError (with the line) for unknown actions, missing bundles or repeated sources
+    """
+    if path == '-':
+        lines, base = sys.stdin.read().splitlines(), os.getcwd()
+    else:
+        with open(path) as manifest_f:
+            lines, base = manifest_f.read().splitlines(), os.path.dirname(os.path.abspath(path))
+    jobs = []
+    for number, line in enumerate(lines, 1):
+        if not line.strip() or line.lstrip().startswith('#'):
+            continue
+        source_id, bundlePath, actions = ([field.strip() for field in line.split('\t')] + ["", ""])[:3]
+        actions = [action.strip() for action in actions.split(',') if action.strip()]
+        if set(actions) - set(BATCH_ACTIONS):
+            raise ValueError(f"{path}:{number}: unknown action(s) {', '.join(sorted(set(actions) - set(BATCH_ACTIONS)))} (use {', '.join(BATCH_ACTIONS)})")
+        job = BatchJob(source_id, os.path.join(base, bundlePath) if bundlePath else None, actions)
+        if 'upload' in job.actions and not (job.bundlePath and os.path.isfile(job.bundlePath)):
+            raise ValueError(f"{path}:{number}: no bundle to upload for '{source_id}' ('{bundlePath}')")
+        if source_id in [other.source_id for other in jobs]:
+            raise ValueError(f"{path}:{number}: '{source_id}' is listed more than once")
+        jobs.append(job)
+    return jobs
+
+def _retryAfter(response:requests.Response) -> None|float:
+    """ Seconds the server asked us to wait (Retry-After), if it said so in seconds """
+    try:
+        return min(float(response.headers['Retry-After']), settings.api_wait_max_interval)
+    except (KeyError, ValueError):
+        return None
+
+class _AdaptiveLimit():
+    """ At most limit jobs at once, starting at maximum. When the server pushes back (429/503, or any 5xx for requests that
+    may be repeated) the limit is halved and all new requests pause (Retry-After, or exponentially longer), each success
+    raises it by one again
+    """
+    def __init__(self, maximum:int):
+        self.maximum = max(1, maximum)
+        self.limit = self.maximum
+        self.lowest = self.maximum
+        self.active = 0
+        self.pausedUntil = 0.0
+        self.condition = asyncio.Condition()
+    async def __aenter__(self):
+        async with self.condition:
+            await self.condition.wait_for(lambda: self.active < self.limit)
+            self.active += 1
+    async def __aexit__(self, *exc):
+        async with self.condition:
+            self.active -= 1
+            self.condition.notify_all()
+
+    async def request(self, job:BatchJob, function, *args, repeatable:bool = False) -> requests.Response:
+        """ function(*args) (returning the response) in a thread, repeated (at most api_retries times, counted in job) while the server pushes back """
+        for attempt in range(settings.api_retries + 1):
+            if (pause := self.pausedUntil - time.monotonic()) > 0:
+                await asyncio.sleep(pause)
+            response = await asyncio.to_thread(function, *args)
+            if response.status_code not in (429, 503) and not (repeatable and response.status_code >= 500):
+                async with self.condition:
+                    self.limit = min(self.limit + 1, self.maximum)
+                    self.condition.notify_all()
+                return response
+            if attempt == settings.api_retries:
+                break
+            delay = _retryAfter(response) or settings.api_backoff_factor * 2 ** (attempt + 1)
+            self.limit = max(1, self.limit // 2)
+            self.lowest = min(self.lowest, self.limit)
+            self.pausedUntil = max(self.pausedUntil, time.monotonic() + delay)
+            job.retries += 1
+            logger.warning("Server busy (%s) for '%s', running %s at once and pausing %.1fs", response.status_code, job.source_id, self.limit, delay)
+        return response
+
+async def batchJobAsync(job:BatchJob, limit:_AdaptiveLimit, wait:bool = False, known:bool = True) -> BatchJob:
+    """ Run the job's actions in order, stopping at the first failure. An upload is waited for (until Uploaded) before processing,
+    processing only with wait (until Succeeded). Fills in the job's timings and outcome. known: the server has the source already
+    """
+    async with limit:
+        started = time.monotonic()
+        try:
+            ## Fresh, a cached status may be older than an action of a previous run
+            before = await asyncio.to_thread(lambda: sourceStatus(job.source_id, fresh=True)) if known else None
+            for action in job.actions:
+                actionStarted = time.monotonic()
+                try:
+                    if action == 'upload':
+                        ## Sending the bundle again replaces it, so it may be repeated for any server error
+                        response = await limit.request(job, _putFhirBundle, job.source_id, job.bundlePath, repeatable=True)
+                        accepted, statuses = 204, UPLOAD_STATUSES
+                    else:
+                        response = await limit.request(job, _postProcessing, job.source_id)
+                        accepted, statuses = 202, PROCESS_STATUSES
+                    if response.status_code != accepted:
+                        job.outcome, job.message = "Error", f"{action}: {response.status_code}: {firstLine(response.text)}"
+                        break
+                    job.outcome = "Accepted"
+                    if action == 'upload' or wait:
+                        before = await asyncio.to_thread(waitForStatus, job.source_id, statuses, before)
+                        job.outcome = before.get('status')
+                        if job.outcome == 'Failed':
+                            job.message = f"{action} failed, see --error"
+                            break
+                finally:
+                    job.seconds[action] = time.monotonic() - actionStarted
+        except (requests.RequestException, OSError, TimeoutError) as err:
+            job.outcome, job.message = "Error", str(err)
+        job.seconds['total'] = time.monotonic() - started
+    return job
+
+async def runBatchAsync(jobs:list[BatchJob], concurrency:None|int = None, wait:bool = False, progress = None) -> int:
+    """ batchJobAsync of each job, at most concurrency (default api_batch_concurrency) at once, progress(job) after each.
+    Returns the lowest concurrency the server's load allowed
+    """
+    limit = _AdaptiveLimit(settings.api_batch_concurrency if concurrency is None else concurrency)
+    ## New sources have no status to compare with yet
+    knownSources = await asyncio.to_thread(listDwhSources)
+    async def run(job:BatchJob):
+        await batchJobAsync(job, limit, wait, knownSources is None or job.source_id in knownSources)
+        if progress is not None:
+            progress(job)
+    await asyncio.gather(*[run(job) for job in jobs])
+    return limit.lowest
+
+def runBatch(jobs:list[BatchJob], concurrency:None|int = None, wait:bool = False, progress = None) -> int:
+    """ Blocking call of runBatchAsync """
+    return asyncio.run(runBatchAsync(jobs, concurrency, wait, progress))
+
+def firstLine(text:None|str, length:int = 60) -> str:
+    """ Shorten server messages for overview tables """
+    if not text:
+        return ""
+    line = text.strip().splitlines()[0] if text.strip() else ""
+    return line if len(line) <= length else line[:length - 3] + "..."
+
 ## CLI action processing
 def cliSummary():
     """ Render the summary/list of sources the DWH knows of """
@@ -155,10 +691,17 @@ def cliSummary():
         print("You can use these source names to make further queries and updates")
     print("")
 
-def cliStatus(datasourceName:str):
-    """ Provide the status and last update/ativity dates """
+def cliStatus(datasourceName:str, wait:bool = False):
+    """ Provide the status and last update/ativity dates (if waiting: once the next final status, other than the current one, is reached; exits with 1 if it Failed or doesn't get there) """
     logger.debug("Starting action...")
+    if wait:
+        cliWaitAndShow(datasourceName, None, sourceStatus(datasourceName, fresh=True))
+        return
     sourceDetails = sourceStatus(datasourceName)
+    if sourceDetails is None:
+        print(f"No status available for '{datasourceName}'")
+        print("")
+        return
 
     headers = []
     values = []
@@ -180,6 +723,21 @@ def cliStatus(datasourceName:str):
     myTable.add_row(values)
     print(myTable)
     print("")
+def cliStatusAll():
+    """ Provide the status, info and error of all sources in one table """
+    logger.debug("Starting action...")
+    sourcesDetails = allSourceDetails()
+    if sourcesDetails is None:
+        print("Failed to list sources from the DWH")
+        return
+    myTable = PrettyTable(["source_id", "status", "last_activity", "last_update", "info", "error"])
+    myTable.align = "l"
+    for details in sourcesDetails:
+        status = details["status"] or {}
+        myTable.add_row([details["source_id"], status.get("status", "Unavailable"), status.get("last_activity", ""), status.get("last_update", ""),
+            firstLine(details["info"]), firstLine(details["error"] or details["failure"])])
+    print(myTable)
+    print("")
 def cliInfo(datasourceName:str):
     """ Print info of last update of the datasource """
     logger.debug("Starting action...")
@@ -195,16 +753,38 @@ def cliError(datasourceName:str):
     print(sourceError)
     print("")
 
-def cliUpload(datasourceName:str, uploadFilepath:str):
+def cliWait(datasourceName:str, statuses = None, before:None|dict = None) -> None|dict:
+    """ Show each new status until it is final, returns it (None if it took too long) """
+    print(f"Waiting for '{datasourceName}' to be {' or '.join(sorted(statuses or TERMINAL_STATUSES))} (up to {settings.api_wait_timeout:.0f}s)...")
+    try:
+        return waitForStatus(datasourceName, statuses, before,
+            progress=lambda status: print(f"[{time.strftime('%H:%M:%S')}] {status.get('status', 'Unavailable')}", flush=True))
+    except TimeoutError as err:
+        print(f"Stopped waiting: {err}")
+        return None
+def cliWaitAndShow(datasourceName:str, statuses, before:None|dict):
+    """ Wait for the action to finish and show the status, exits with 1 if it failed (or didn't finish) """
+    finalStatus = cliWait(datasourceName, statuses, before)
+    cliStatus(datasourceName)
+    if finalStatus is None or finalStatus.get('status') == 'Failed':
+        if finalStatus is not None:
+            print("See the errors with --error")
+        sys.exit(1)
+
+def cliUpload(datasourceName:str, uploadFilepath:str, wait:bool = False):
     """ Upload a file with fhir bundle data """
     logger.debug("Starting action...")
+    before = sourceStatus(datasourceName, fresh=True) if wait else None
     print(f"Uploading source: '{datasourceName}'")
     apiResponse = uploadSource(datasourceName, uploadFilepath)
     print(f"Response from server: {apiResponse}")
+    if wait and not apiResponse.startswith("Error"):
+        cliWaitAndShow(datasourceName, UPLOAD_STATUSES, before)
+        return
     time.sleep(2)
     cliStatus(datasourceName)
 
-def cliProcess(datasourceName:str):
+def cliProcess(datasourceName:str, wait:bool = False):
     """ Process a file which has already been uploaded """
     logger.debug("Starting action...")
     if datasourceName not in listDwhSources():
@@ -213,17 +793,21 @@ def cliProcess(datasourceName:str):
     print(f"About to process source: '{datasourceName}'")
     print("This means the file upload will be added to the DWH database")
     if args.yes >= 1 or areYouSure():
+        before = sourceStatus(datasourceName, fresh=True) if wait else None
         print(f"Processing source: '{datasourceName}'")
         apiResponse = processSource(datasourceName)
         logger.info("Source processed: '%s'", datasourceName)
         print(f"Response from server: {apiResponse}")
+        if wait and not apiResponse.startswith("Error"):
+            cliWaitAndShow(datasourceName, PROCESS_STATUSES, before)
+            return True
         time.sleep(2)
         cliStatus(datasourceName)
         print("You may need to wait for processing and check the status later.")
         return True
     print("Aborting processing, no action taken")
     return False
-def cliDelete(datasourceName:str):
+def cliDelete(datasourceName:str, wait:bool = False):
     """ Delete source and show status after a few seconds """
     logger.debug("Starting action...")
     if datasourceName not in listDwhSources():
@@ -231,10 +815,14 @@ def cliDelete(datasourceName:str):
         sys.exit(2)
     print(f"About to delete source: '{datasourceName}'")
     if args.yes >= 2 or areYouSure():
+        before = sourceStatus(datasourceName, fresh=True) if wait else None
         print(f"Deleting source: '{datasourceName}'")
         apiResponse = deleteSource(datasourceName)
         logger.info("Source deleted: '%s'", datasourceName)
         print(f"Response from server: {apiResponse}")
+        if wait and not apiResponse.startswith("Error"):
+            cliWaitAndShow(datasourceName, DELETE_STATUSES, before)
+            return True
         time.sleep(2)
         cliStatus(datasourceName)
         print("You may need to wait for processing and check the status later.")
@@ -242,6 +830,39 @@ def cliDelete(datasourceName:str):
     print("Aborting delete, no action taken")
     return False
 
+def cliBatch(manifestPath:str, concurrency:None|int = None, wait:bool = False):
+    """ Upload and/or process all sources of a manifest (see readBatchManifest) several at once and summarise, exits with 1 if any failed """
+    logger.debug("Starting action...")
+    try:
+        jobs = readBatchManifest(manifestPath)
+    except (OSError, ValueError) as err:
+        logger.error("Could not read the batch manifest: %s", err)
+        sys.exit(2)
+    print(f"About to run {len(jobs)} sources, {settings.api_batch_concurrency if concurrency is None else concurrency} at once:")
+    for job in jobs:
+        print(f"> {job.source_id}: {', '.join(job.actions)}" + (f" ({job.bundlePath})" if job.bundlePath else ""))
+    if any('process' in job.actions for job in jobs):
+        print("Processing means the file uploads will be added to the DWH database")
+        if not (args.yes >= 1 or areYouSure()):
+            print("Aborting batch, no action taken")
+            return False
+    started = time.monotonic()
+    lowest = runBatch(jobs, concurrency, wait,
+        progress=lambda job: print(f"[{time.strftime('%H:%M:%S')}] {job.source_id}: {job.outcome} ({job.seconds['total']:.1f}s)", flush=True))
+    myTable = PrettyTable(["source_id", "actions", "upload s", "process s", "total s", "retries", "outcome", "message"])
+    myTable.align = "l"
+    for job in jobs:
+        seconds = [f"{job.seconds[key]:.1f}" if key in job.seconds else "" for key in ["upload", "process", "total"]]
+        myTable.add_row([job.source_id, ",".join(job.actions), *seconds, job.retries, job.outcome, firstLine(job.message)])
+    print(myTable)
+    failed = [job for job in jobs if job.failed]
+    print(f"{len(jobs) - len(failed)} of {len(jobs)} sources done in {time.monotonic() - started:.1f}s"
+        + (f", the server was busy (down to {lowest} at once)" if lowest < (concurrency or settings.api_batch_concurrency) else ""))
+    print("")
+    if failed:
+        sys.exit(1)
+    return True
+
 def areYouSure():
     """ Ask user to confirm action """
     response = input("Please confirm [y/N]:")
@@ -263,7 +884,6 @@ if __name__ == "__main__":
     ## Application logic starts here; allow direct processing from CLI using functions unchanged from module use
     import argparse
     from prettytable import PrettyTable
-    import time
     logger.info("Starting api processing...")
     logger.warning("WORK IN PROGRESS")
     ## TODO: 
@@ -281,16 +901,31 @@ if __name__ == "__main__":
     action = parser.add_mutually_exclusive_group(required=True)
     action.add_argument('-l', '-S', '--list', '--summary', action='store_true', help='Fetch summary list of sources from the DWH.')
     action.add_argument('-s', '--status', action='store_true', help='Show status of uploaded datasource.')
+    action.add_argument('-A', '--status-all', action='store_true', help='Show status, info and error of all datasources (fetched in parallel).')
     action.add_argument('-i', '--info', action='store_true', help='Show info about the most recently uploaded datasource.')
     action.add_argument('-e', '--error', action='store_true', help='Show error (if exists) about the most recently uploaded datasource.')
     action.add_argument('-u', '--upload', action='store_true', help='Send a new/updated fhir-bundle for a datasource.')
     action.add_argument('-p', '--process', action='store_true', help='Process an uploaded fhir-bundle file data into the DWH database.')
     action.add_argument('-d', '--delete', action='store_true', help='Remove a datasource from the DWH.')
+    action.add_argument('-b', '--batch', metavar='MANIFEST', help='Upload and/or process the sources listed in MANIFEST (- for stdin), several at once: one per line, tab separated: name, bundle file (optional), actions (optional: upload,process).')
 
     parser.add_argument('-n', '--ds-name', required=False, help='Name of datasource.')
     parser.add_argument('-f', '--upload-file', required=False, help='Filename for the fhir-bundle.')
     parser.add_argument('-a', '--dwh_api_endpoint', required=False, help='API endpoint for the DWH.')
+    parser.add_argument('-w', '--wait', action='store_true', help='Wait until upload/process/delete is final: Uploaded, Succeeded, Failed or Deleted. With --status, wait for the next final status (not the current one, eg of a run started elsewhere). Exits with 1 if it Failed or --wait-timeout passed.')
+    parser.add_argument('--wait-timeout', type=float, required=False, help=f'Seconds to wait at most (default {settings.api_wait_timeout:.0f}).')
+    parser.add_argument('--concurrency', type=int, required=False, help=f'Sources run at once with --batch (default {settings.api_batch_concurrency}).')
+    parser.add_argument('--fresh', action='store_true', help='Don\'t use (or keep) cached responses.')
     args = parser.parse_args()
+    if args.wait_timeout is not None:
+        settings.api_wait_timeout = args.wait_timeout
+    if args.fresh:
+        settings.api_cache_filename = ""
+        responseCache.ttl = 0
+    else:
+        import atexit
+        loadResponseCache()
+        atexit.register(saveResponseCache)
 
     ## Map verbose count to log level
     if args.verbose is not None:
@@ -318,13 +953,17 @@ if __name__ == "__main__":
     if not any(vars(args).values()):
         logger.warning("You must specify an action (try --help).")
         parser.print_help()
-    actions = {'list': 'cliSummary', 'status': 'cliStatus', 'info': 'cliInfo', 'error': 'cliError', 'upload': 'cliUpload', 'process': 'cliProcess', 'delete': 'cliDelete'}
+    actions = {'list': 'cliSummary', 'status_all': 'cliStatusAll', 'status': 'cliStatus', 'info': 'cliInfo', 'error': 'cliError', 'upload': 'cliUpload', 'process': 'cliProcess', 'delete': 'cliDelete', 'batch': 'cliBatch'}
     action = [x for x in actions.keys() if getattr(args, x)][0]
     logger.debug("action: %s", action)
-    if action == 'list':
+    if action in ['list', 'status_all']:
         locals()[actions[action]]()
-    elif action in ['status', 'info', 'error', 'process', 'delete']:
+    elif action == 'batch':
+        cliBatch(args.batch, args.concurrency, wait=args.wait)
+    elif action in ['info', 'error']:
         locals()[actions[action]](args.ds_name)
+    elif action in ['status', 'process', 'delete']:
+        locals()[actions[action]](args.ds_name, wait=args.wait)
     else:
-        locals()[actions[action]](args.ds_name, args.upload_file)
+        locals()[actions[action]](args.ds_name, args.upload_file, wait=args.wait)
     logger.info("Script run completed!")
@@ -0,0 +1,220 @@
+#!/usr/bin/env python3
+"""
+Description: Counts and checks of a fhir bundle, collected while it is pseudonymized and written as a JSON report
+stderr: for logs
+
+Usage: src/i2b2_upload_client/logic/bundle_statistics.py --report client-output/bundle-statistics.json [--examples]
+Explainer: The pseudonymization run (see stream_pseudonymization.py, statistics_report) passes each entry it writes
+and each Patient/Encounter it parses to BundleStatistics, so nothing has to read the (multi-GB) bundle again:
+entries and bytes per resource type with a size histogram, Patients with a duplicate id or without a name,
+Encounters with several identifiers, Encounters whose subject Patient is not in the bundle and (with clash_detection)
+pseudonym clashes and duplicate patients.
+Patient ids are only kept as 8 byte digests, only Encounters seen before their Patient are remembered until the end.
+"""
+
+## Import built-ins
+import datetime
+import hashlib
+import json
+import sys
+
+## Import third party libraries
+import logging
+from pydantic_settings import BaseSettings
+
+## ---------------- ##
+## Create  settings ##
+## ---------------- ##
+class Settings(BaseSettings):
+    """ The variables defined here will be taken from env vars if available and matching the type hint """
+    log_level: str = "WARNING"
+    log_format: str = "[%(asctime)s] {%(name)s/%(module)s:%(lineno)d (%(funcName)s)} %(levelname)s - %(message)s"
+    ## Ids listed in the report per kind of issue (all are counted)
+    statistics_examples: int = 20
+settings = Settings()
+
+## Load logger for this file/script
+formatter = logging.Formatter(settings.log_format)
+logging.basicConfig(format=settings.log_format)
+## Set app's logger level and format...
+logger = logging.getLogger(__name__)
+logger.setLevel(settings.log_level)
+
+## Kinds of issue reported, with a description
+ISSUES:dict[str, str] = {
+    "duplicate_patient_ids": "Patient id seen more than once",
+    "patients_without_id": "Patient without an id",
+    "patients_without_name": "Patient without a name (pseudonym from the birthdate alone)",
+    "patients_with_several_names": "Patient with more than 1 name (the 1st is used)",
+    "encounters_with_several_identifiers": "Encounter with more than 1 identifier/value (only the 1st is replaced)",
+    "encounters_without_subject": "Encounter without a subject reference",
+    "encounters_without_patient": "Encounter whose subject Patient is not in the bundle",
+    ## From the clash detection (clash_detection.py), the examples are pseudonyms
+    "pseudonym_clashes": "Pseudonym already given to a patient with other names or birthdate",
+    "duplicate_patients": "Patient with the same names and birthdate as an earlier one",
+}
+
+def _digest(id:str) -> int:
+    """ 8 byte digest of an id (as int), so the index doesn't keep the ids themselves """
+    return int.from_bytes(hashlib.blake2b(id.encode('UTF-8'), digest_size=8).digest())
+
+def _referenced_patient(reference:str) -> str:
+    """ Patient id of a reference like 'Patient/123' (also absolute or versioned), the reference itself if it isn't one """
+    if "Patient/" not in reference:
+        return reference
+    return reference.rsplit("Patient/", 1)[1].split("/_history", 1)[0]
+
+class BundleStatistics():
+    """ Collects the counts and issues of one run, see the module description """
+    def __init__(self, examples:None|int = None):
+        self.examples = settings.statistics_examples if examples is None else examples
+        self.entries:int = 0
+        self.bytes:int = 0
+        ## resource type: [entries, bytes, largest, histogram (entries per power of 2 of their size)]
+        self.resource_types:dict[str, list] = {}
+        self.patients:int = 0
+        self.encounters:int = 0
+        self.patient_digests:set[int] = set()
+        ## Encounters referring to a Patient not seen (yet): patient digest -> [encounters, (encounter id, reference) examples]
+        self.pending_encounters:dict[int, list] = {}
+        self.issues:dict[str, list] = {kind: [0, []] for kind in ISSUES}
+
+    def entry(self, resource_type:None|str, size:int):
+        """ Count a written entry of size bytes """
+        self.entries += 1
+        self.bytes += size
+        counts = self.resource_types.get(resource_type)
+        if counts is None:
+            counts = self.resource_types[resource_type] = [0, 0, 0, []]
+        counts[0] += 1
+        counts[1] += size
+        if size > counts[2]:
+            counts[2] = size
+        bucket = (size - 1).bit_length()
+        histogram = counts[3]
+        if bucket >= len(histogram):
+            histogram.extend([0] * (bucket + 1 - len(histogram)))
+        histogram[bucket] += 1
+
+    def issue(self, kind:str, example):
+        """ Count an issue (see ISSUES), keeping the first examples """
+        counts = self.issues[kind]
+        counts[0] += 1
+        if len(counts[1]) < self.examples:
+            counts[1].append(example)
+
+    def patient(self, id:None|str, names:int):
+        """ A Patient entry with its id and number of names """
+        self.patients += 1
+        if not id:
+            self.issue("patients_without_id", None)
+        else:
+            digest = _digest(id)
+            if digest in self.patient_digests:
+                self.issue("duplicate_patient_ids", id)
+            else:
+                self.patient_digests.add(digest)
+                self.pending_encounters.pop(digest, None)
+        if names == 0:
+            self.issue("patients_without_name", id)
+        elif names > 1:
+            self.issue("patients_with_several_names", id)
+
+    def encounter(self, id:None|str, reference:None|str, identifiers:int):
+        """ An Encounter entry with its id, subject reference and number of identifier values """
+        self.encounters += 1
+        if identifiers > 1:
+            self.issue("encounters_with_several_identifiers", id)
+        if not reference:
+            self.issue("encounters_without_subject", id)
+            return
+        digest = _digest(_referenced_patient(reference))
+        if digest in self.patient_digests:
+            return
+        ## The Patient may still come later in the bundle
+        pending = self.pending_encounters.get(digest)
+        if pending is None:
+            pending = self.pending_encounters[digest] = [0, []]
+        pending[0] += 1
+        if len(pending[1]) < self.examples:
+            pending[1].append({"encounter": id, "reference": reference})
+
+    def replay(self, events:list):
+        """ Apply events recorded elsewhere (eg in a worker process), see StatisticsEvents """
+        for method, args in events:
+            getattr(self, method)(*args)
+
+    def report(self) -> dict:
+        """ The report (as written to JSON), once every entry was seen """
+        issues = {kind: {"count": count, "examples": examples} for kind, (count, examples) in self.issues.items()}
+        orphans = issues["encounters_without_patient"]
+        for count, examples in self.pending_encounters.values():
+            orphans["count"] += count
+            orphans["examples"].extend(examples[:self.examples - len(orphans["examples"])])
+        return {
+            "created": datetime.datetime.now().isoformat(timespec='seconds'),
+            "entries": self.entries,
+            "bytes": self.bytes,
+            "patients": self.patients,
+            "encounters": self.encounters,
+            ## Histogram keys: entries of at most that many bytes (and more than the previous key)
+            "resource_types": {resource_type or "(none)": {
+                "entries": entries,
+                "bytes": size,
+                "largest_bytes": largest,
+                "size_histogram": {str(1 << bucket): count for bucket, count in enumerate(histogram) if count},
+            } for resource_type, (entries, size, largest, histogram) in sorted(self.resource_types.items(), key=lambda item: -item[1][0])},
+            "issues": issues,
+        }
+
+    def write(self, path:str) -> dict:
+        """ Write the report as JSON, returns it """
+        report = self.report()
+        with open(path, 'w') as report_f:
+            json.dump(report, report_f, indent=2)
+        logger.info("Bundle statistics written to '%s': %s", path, describe_statistics(report))
+        return report
+
+class StatisticsEvents(list):
+    """ Stand-in for BundleStatistics which records the calls, eg to return them from a worker process (see BundleStatistics.replay) """
+    def entry(self, *args):
+        self.append(("entry", args))
+    def issue(self, *args):
+        self.append(("issue", args))
+    def patient(self, *args):
+        self.append(("patient", args))
+    def encounter(self, *args):
+        self.append(("encounter", args))
+
+def describe_statistics(report:dict) -> str:
+    """ One line summary of the report """
+    text = f"{report['entries']:,} entries ({report['bytes'] / 1e6:,.1f} MB), {report['patients']:,} patients, {report['encounters']:,} encounters"
+    found = [f"{details['count']:,} {kind.replace('_', ' ')}" for kind, details in report['issues'].items() if details['count']]
+    return text + (", " + ", ".join(found) if found else ", no issues")
+
+## When called as script (not run if imported as module):
+if __name__ == "__main__":
+    import argparse
+    from prettytable import PrettyTable
+    parser = argparse.ArgumentParser(description="Show the statistics report of a pseudonymization run. Exits with 3 if it found issues.")
+    parser.add_argument('--report', required=True, help='The report (JSON, see statistics_report).')
+    parser.add_argument('--examples', action='store_true', help='List the example ids of each issue.')
+    args = parser.parse_args()
+
+    with open(args.report) as report_f:
+        report = json.load(report_f)
+    print(f"Report of {report['created']}: {describe_statistics(report)}")
+    myTable = PrettyTable(["resource type", "entries", "MB", "largest kB", "sizes (entries up to kB)"])
+    myTable.align = "r"
+    myTable.align["resource type"] = myTable.align["sizes (entries up to kB)"] = "l"
+    for resource_type, counts in report['resource_types'].items():
+        myTable.add_row([resource_type, f"{counts['entries']:,}", f"{counts['bytes'] / 1e6:,.1f}", f"{counts['largest_bytes'] / 1e3:,.1f}",
+            ", ".join(f"{int(bound) / 1e3:g}: {count:,}" for bound, count in counts['size_histogram'].items())])
+    print(myTable)
+    issues = PrettyTable(["issue", "count"] + (["examples"] if args.examples else []))
+    issues.align = "l"
+    for kind, details in report['issues'].items():
+        issues.add_row([ISSUES.get(kind, kind), f"{details['count']:,}"] + ([", ".join(json.dumps(example) for example in details['examples'])] if args.examples else []))
+    print(issues)
+    if any(details['count'] for details in report['issues'].values()):
+        sys.exit(3)
@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+"""
+Description: Detect pseudonym clashes (different patients, same pseudonym) and duplicate patients during a run
+stderr: for logs
+
+Usage: imported by stream_pseudonymization.py (clash_detection), no script mode
+Explainer: Every pseudonymized patient is checked against a table of the patients seen so far in this run. The table
+keeps 8 bytes of the SHA3 of each pseudonym (the key) and 4 bytes of the SHA3 of its names and birthdate, in two arrays
+used as an open addressing hash table, about 18 bytes per patient (10 million patients: ~180 MB). A pseudonym seen
+before with other names/birthdate is a clash, with the same ones a duplicate patient. If the table would outgrow
+clash_detection_memory_mb, later patients are still checked against it but no longer added (and this is logged).
+NOTE: Patients pseudonymized from source ids (source_pseudonyms_filename) have no mapping row and aren't checked
+"""
+
+## Import built-ins
+from array import array
+import hashlib
+
+## Import third party libraries
+import logging
+from pydantic_settings import BaseSettings
+
+## ---------------- ##
+## Create  settings ##
+## ---------------- ##
+class Settings(BaseSettings):
+    """ The variables defined here will be taken from env vars if available and matching the type hint """
+    log_level: str = "WARNING"
+    log_format: str = "[%(asctime)s] {%(name)s/%(module)s:%(lineno)d (%(funcName)s)} %(levelname)s - %(message)s"
+    ## MB the table of patients seen may use
+    clash_detection_memory_mb: int = 512
+settings = Settings()
+
+## Load logger for this file/script
+formatter = logging.Formatter(settings.log_format)
+logging.basicConfig(format=settings.log_format)
+## Set app's logger level and format...
+logger = logging.getLogger(__name__)
+logger.setLevel(settings.log_level)
+
+## Bytes per slot (key and tag), slots are kept at most 2/3 full
+SLOT_BYTES:int = 12
+## Pseudonyms listed per kind (all are counted)
+EXAMPLES:int = 20
+
+class ClashDetector():
+    """ Patients seen in this run, see the module description """
+    def __init__(self, memory_mb:None|int = None):
+        self.budget = (settings.clash_detection_memory_mb if memory_mb is None else memory_mb) << 20
+        self.count:int = 0
+        self.clashes:int = 0
+        self.duplicates:int = 0
+        self.full:bool = False
+        self.examples:dict[str, list[str]] = {"clash": [], "duplicate": []}
+        self._allocate(1 << 16)
+
+    def _allocate(self, capacity:int):
+        ## Key 0 marks an empty slot
+        self.keys = array('Q', bytes(8 * capacity))
+        self.tags = array('I', bytes(4 * capacity))
+        self.mask = capacity - 1
+
+    def _slot(self, key:int) -> int:
+        """ Slot of the key, or the empty slot where it would go """
+        keys, mask = self.keys, self.mask
+        slot = key & mask
+        while keys[slot] and keys[slot] != key:
+            slot = (slot + 1) & mask
+        return slot
+
+    def _grow(self) -> bool:
+        """ Double the table if the budget allows """
+        capacity = 2 * len(self.keys)
+        if capacity * SLOT_BYTES > self.budget:
+            return False
+        keys, tags = self.keys, self.tags
+        self._allocate(capacity)
+        for key, tag in zip(keys, tags):
+            if key:
+                slot = self._slot(key)
+                self.keys[slot] = key
+                self.tags[slot] = tag
+        return True
+
+    def check(self, given_names:str, surname:str, birthdate:str, pseudonym:str) -> None|str:
+        """ Remember the patient, returns 'clash' or 'duplicate' if its pseudonym was seen before (else None) """
+        key = int.from_bytes(hashlib.sha3_256(pseudonym.encode('UTF-8')).digest()[:8]) or 1
+        ## Unit separator: unlike '|' (used for the pseudonym), it doesn't occur in names
+        tag = int.from_bytes(hashlib.sha3_256(f"{given_names}\x1f{surname}\x1f{birthdate}".encode('UTF-8')).digest()[:4])
+        slot = self._slot(key)
+        if self.keys[slot]:
+            kind = "duplicate" if self.tags[slot] == tag else "clash"
+            if kind == "clash":
+                self.clashes += 1
+                logger.warning("Pseudonym clash: '%s' was already given to a patient with other names or birthdate", pseudonym)
+            else:
+                self.duplicates += 1
+            if len(self.examples[kind]) < EXAMPLES:
+                self.examples[kind].append(pseudonym)
+            return kind
+        if self.full:
+            return None
+        self.keys[slot] = key
+        self.tags[slot] = tag
+        self.count += 1
+        if 3 * self.count > 2 * len(self.keys) and not self._grow():
+            self.full = True
+            logger.warning("Clash detection reached clash_detection_memory_mb (%s MB) after %s patients, later patients are only checked against those", self.budget >> 20, self.count)
+        return None
+
+    def summary(self) -> dict:
+        """ Counts (and first pseudonyms) of the clashes and duplicates """
+        return {
+            "patients": self.count,
+            "pseudonym_clashes": self.clashes,
+            "duplicate_patients": self.duplicates,
+            "clash_examples": list(self.examples["clash"]),
+            "duplicate_examples": list(self.examples["duplicate"]),
+            "complete": not self.full,
+            "table_mb": len(self.keys) * SLOT_BYTES / (1 << 20),
+        }
@@ -0,0 +1,134 @@
+#!/usr/bin/env python3
+"""
+Description: Remember a content hash per bundle entry, to report what changed since the previous pseudonymization run
+stderr: for logs
+
+Usage: src/i2b2_upload_client/logic/delta_manifest.py --manifest client-output/delta-manifest.sqlite [--changes]
+Explainer: Entries are keyed by (resource type, id) and hashed as written (after pseudonymization). A run is
+compared against the previous run's manifest, which is only replaced once the run has finished successfully.
+"""
+
+## Import built-ins
+import datetime
+import hashlib
+import os
+import sqlite3
+import sys
+
+## Import third party libraries
+import logging
+from pydantic_settings import BaseSettings
+
+## ---------------- ##
+## Create  settings ##
+## ---------------- ##
+class Settings(BaseSettings):
+    """ The variables defined here will be taken from env vars if available and matching the type hint """
+    log_level: str = "WARNING"
+    log_format: str = "[%(asctime)s] {%(name)s/%(module)s:%(lineno)d (%(funcName)s)} %(levelname)s - %(message)s"
+settings = Settings()
+
+## Load logger for this file/script
+formatter = logging.Formatter(settings.log_format)
+logging.basicConfig(format=settings.log_format)
+## Set app's logger level and format...
+logger = logging.getLogger(__name__)
+logger.setLevel(settings.log_level)
+
+class DeltaManifest():
+    """ Compare each entry of this run with the previous run, then replace the manifest when finished """
+    def __init__(self, path:str):
+        """ Open (or create) the manifest and start a new run """
+        self.path = path
+        self.counts:dict = {"added": 0, "changed": 0, "unchanged": 0, "removed": 0}
+        self.connection = sqlite3.connect(path)
+        self.connection.executescript("""
+            CREATE TABLE IF NOT EXISTS manifest (resource_type TEXT NOT NULL, id TEXT NOT NULL, hash BLOB NOT NULL, PRIMARY KEY (resource_type, id)) WITHOUT ROWID;
+            CREATE TABLE IF NOT EXISTS changes (run INTEGER NOT NULL, change TEXT NOT NULL, resource_type TEXT NOT NULL, id TEXT NOT NULL);
+            CREATE TABLE IF NOT EXISTS runs (finished TEXT NOT NULL, added INTEGER, changed INTEGER, unchanged INTEGER, removed INTEGER);
+            DROP TABLE IF EXISTS manifest_new;
+            CREATE TABLE manifest_new (resource_type TEXT NOT NULL, id TEXT NOT NULL, hash BLOB NOT NULL, PRIMARY KEY (resource_type, id)) WITHOUT ROWID;
+            DELETE FROM changes WHERE run < (SELECT max(rowid) FROM runs);
+        """)
+        ## Changes are kept for the previous run and this one (until it finishes)
+        self.run:int = self.connection.execute("SELECT coalesce(max(rowid), 0) + 1 FROM runs").fetchone()[0]
+
+    def record(self, resource_type:str, id:str, content:bytes) -> str:
+        """ Remember the entry for this run, returns 'added', 'changed' or 'unchanged' """
+        digest = hashlib.blake2b(content, digest_size=16).digest()
+        previous = self.connection.execute("SELECT hash FROM manifest WHERE resource_type = ? AND id = ?", (resource_type, id)).fetchone()
+        if previous is None:
+            change = "added"
+        elif previous[0] == digest:
+            change = "unchanged"
+        else:
+            change = "changed"
+        self.connection.execute("INSERT OR REPLACE INTO manifest_new (resource_type, id, hash) VALUES (?, ?, ?)", (resource_type, id, digest))
+        if change != "unchanged":
+            self.connection.execute("INSERT INTO changes (run, change, resource_type, id) VALUES (?, ?, ?, ?)", (self.run, change, resource_type, id))
+        self.counts[change] += 1
+        return change
+
+    def finish(self) -> dict:
+        """ Work out what was removed, make this run the new manifest and return the counts """
+        self.counts["removed"] = self.connection.execute("""INSERT INTO changes (run, change, resource_type, id)
+            SELECT ?, 'removed', resource_type, id FROM manifest AS m
+            WHERE NOT EXISTS (SELECT 1 FROM manifest_new AS n WHERE n.resource_type = m.resource_type AND n.id = m.id)""", (self.run,)).rowcount
+        self.connection.execute("DROP TABLE manifest")
+        self.connection.execute("ALTER TABLE manifest_new RENAME TO manifest")
+        self.connection.execute("INSERT INTO runs (rowid, finished, added, changed, unchanged, removed) VALUES (?, ?, ?, ?, ?, ?)",
+            (self.run, datetime.datetime.now().isoformat(timespec='seconds'), self.counts["added"], self.counts["changed"], self.counts["unchanged"], self.counts["removed"]))
+        self.connection.commit()
+        self.connection.close()
+        logger.info("Entries compared to the previous run: %s", self.counts)
+        return self.counts
+
+    def abort(self):
+        """ Keep the previous manifest (eg the run failed) """
+        self.connection.rollback()
+        self.connection.execute("DROP TABLE IF EXISTS manifest_new")
+        self.connection.commit()
+        self.connection.close()
+
+    @property
+    def hasChanges(self) -> bool:
+        """ Whether anything was added, changed or removed so far """
+        return self.counts["added"] + self.counts["changed"] + self.counts["removed"] > 0
+
+def last_run_summary(path:str) -> None|dict:
+    """ Counts of the most recent finished run, None if there wasn't one """
+    if not os.path.isfile(path):
+        return None
+    connection = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+    row = connection.execute("SELECT finished, added, changed, unchanged, removed FROM runs ORDER BY rowid DESC LIMIT 1").fetchone()
+    connection.close()
+    if row is None:
+        return None
+    return dict(zip(["finished", "added", "changed", "unchanged", "removed"], row))
+
+def last_run_changes(path:str):
+    """ (change, resource type, id) of each entry which was not unchanged in the most recent run """
+    connection = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+    try:
+        yield from connection.execute("SELECT change, resource_type, id FROM changes WHERE run = (SELECT max(rowid) FROM runs) ORDER BY rowid")
+    finally:
+        connection.close()
+
+## When called as script (not run if imported as module):
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Show what changed in the most recent pseudonymization run. Exits with 3 if nothing changed.")
+    parser.add_argument('--manifest', required=True, help='The delta manifest (SQLite file).')
+    parser.add_argument('--changes', action='store_true', help='List each added, changed and removed entry.')
+    args = parser.parse_args()
+
+    summary = last_run_summary(args.manifest)
+    if summary is None:
+        logger.error("No finished run recorded in '%s'", args.manifest)
+        sys.exit(1)
+    print(f"Run finished {summary['finished']}: {summary['added']} added, {summary['changed']} changed, {summary['removed']} removed, {summary['unchanged']} unchanged")
+    if args.changes:
+        for change, resource_type, id in last_run_changes(args.manifest):
+            print(f"{change}\t{resource_type}\t{id}")
+    if summary['added'] + summary['changed'] + summary['removed'] == 0:
+        sys.exit(3)
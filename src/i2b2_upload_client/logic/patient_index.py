@@ -0,0 +1,147 @@
+#!/usr/bin/env python3
+"""
+Description: Compact index of original Patient id -> pseudonym, spilling to disk past a memory budget
+stderr: for logs
+
+Usage: imported by stream_pseudonymization.py (rewrite_patient_references), no script mode
+Explainer: Ids are kept as 8 byte digests in an open addressing table (array of slots), the pseudonyms back to back
+in one bytearray, so a patient costs about 100 bytes instead of the ~300 of a dict of strings. Once the index uses
+more than its budget, everything is moved to a temporary SQLite database and the arrays start again empty.
+Lookups check memory first, then the database. The first pseudonym added for an id is kept.
+NOTE: Two ids with the same 64 bit digest would share a pseudonym, unlikely below billions of patients
+"""
+
+## Import built-ins
+from array import array
+import hashlib
+import sqlite3
+
+## Import third party libraries
+import logging
+from pydantic_settings import BaseSettings
+
+## ---------------- ##
+## Create  settings ##
+## ---------------- ##
+class Settings(BaseSettings):
+    """ The variables defined here will be taken from env vars if available and matching the type hint """
+    log_level: str = "WARNING"
+    log_format: str = "[%(asctime)s] {%(name)s/%(module)s:%(lineno)d (%(funcName)s)} %(levelname)s - %(message)s"
+    ## MB the index may use before it spills to disk
+    patient_index_memory_mb: int = 256
+settings = Settings()
+
+## Load logger for this file/script
+formatter = logging.Formatter(settings.log_format)
+logging.basicConfig(format=settings.log_format)
+## Set app's logger level and format...
+logger = logging.getLogger(__name__)
+logger.setLevel(settings.log_level)
+
+def _digest(id:bytes) -> int:
+    """ Signed 64 bit digest of an id (signed, so SQLite can use it as the key) """
+    return int.from_bytes(hashlib.blake2b(id, digest_size=8).digest(), signed=True)
+
+class PatientIndex():
+    """ Original patient id -> pseudonym (both bytes), see the module description """
+    def __init__(self, memory_mb:None|int = None):
+        self.budget = (settings.patient_index_memory_mb if memory_mb is None else memory_mb) << 20
+        self.count:int = 0
+        self.spilled:int = 0
+        self.spill:None|sqlite3.Connection = None
+        ## Entries usually refer to the same Patient as the one before
+        self.last:tuple[None|bytes, None|bytes] = (None, None)
+        self._clear()
+
+    def _clear(self):
+        ## Slot -> entry number + 1 (0: empty), entry -> digest and end of its pseudonym in values
+        self.slots = array('q', bytes(8 * 1024))
+        self.keys = array('q')
+        self.ends = array('Q')
+        self.values = bytearray()
+
+    @property
+    def memoryBytes(self) -> int:
+        """ What the arrays take (roughly what the index uses) """
+        return 8 * len(self.slots) + 16 * len(self.keys) + len(self.values)
+
+    def _slot(self, digest:int) -> int:
+        """ Slot of the digest, or the empty slot where it would go """
+        slots, keys = self.slots, self.keys
+        mask = len(slots) - 1
+        slot = digest & mask
+        while slots[slot] and keys[slots[slot] - 1] != digest:
+            slot = (slot + 1) & mask
+        return slot
+
+    def _grow(self):
+        """ Double the slots (kept at most half full) """
+        self.slots = array('q', bytes(16 * len(self.slots)))
+        mask = len(self.slots) - 1
+        for entry, digest in enumerate(self.keys):
+            slot = digest & mask
+            while self.slots[slot]:
+                slot = (slot + 1) & mask
+            self.slots[slot] = entry + 1
+
+    def _memoryLookup(self, digest:int) -> None|bytes:
+        entry = self.slots[self._slot(digest)] - 1
+        if entry < 0:
+            return None
+        return bytes(self.values[self.ends[entry - 1] if entry else 0:self.ends[entry]])
+
+    def _spillLookup(self, digest:int) -> None|bytes:
+        if self.spill is None:
+            return None
+        row = self.spill.execute("SELECT pseudonym FROM patients WHERE digest = ?", (digest,)).fetchone()
+        return None if row is None else row[0]
+
+    def add(self, id:bytes, pseudonym:bytes) -> bool:
+        """ Remember the pseudonym of the id, False if the id was already known (the first pseudonym is kept) """
+        digest = _digest(id)
+        slot = self._slot(digest)
+        if self.slots[slot] or self._spillLookup(digest) is not None:
+            return False
+        self.keys.append(digest)
+        self.values += pseudonym
+        self.ends.append(len(self.values))
+        self.slots[slot] = len(self.keys)
+        self.count += 1
+        if 2 * len(self.keys) > len(self.slots):
+            self._grow()
+        if self.memoryBytes > self.budget:
+            self._spill()
+        return True
+
+    def get(self, id:bytes) -> None|bytes:
+        """ Pseudonym of the id, None if it isn't known """
+        if id == self.last[0]:
+            return self.last[1]
+        digest = _digest(id)
+        pseudonym = self._memoryLookup(digest)
+        if pseudonym is None:
+            pseudonym = self._spillLookup(digest)
+        if pseudonym is not None:
+            self.last = (id, pseudonym)
+        return pseudonym
+
+    def _spill(self):
+        """ Move the index to the (temporary) database, freeing the arrays """
+        if self.spill is None:
+            ## An empty path is a private, temporary database on disk, removed when closed
+            self.spill = sqlite3.connect("")
+            self.spill.execute("CREATE TABLE patients (digest INTEGER PRIMARY KEY, pseudonym BLOB NOT NULL)")
+        values, ends = self.values, self.ends
+        self.spill.executemany("INSERT OR IGNORE INTO patients (digest, pseudonym) VALUES (?, ?)",
+            ((digest, bytes(values[ends[entry - 1] if entry else 0:ends[entry]])) for entry, digest in enumerate(self.keys)))
+        self.spill.commit()
+        self.spilled += len(self.keys)
+        logger.info("Patient index went over %s MB, %s patients moved to disk (%s so far)", self.budget >> 20, len(self.keys), self.spilled)
+        self._clear()
+
+    def close(self):
+        """ Free the index (and remove its database) """
+        if self.spill is not None:
+            self.spill.close()
+            self.spill = None
+        self._clear()
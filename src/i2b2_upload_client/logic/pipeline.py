@@ -0,0 +1,178 @@
+#!/usr/bin/env python3
+"""
+Description: Generate, pseudonymize, compress and upload a source in one pass, without intermediate files
+stderr: for logs
+
+Usage: src/i2b2_upload_client/logic/pipeline.py --datasource-config datasource.xml --ds-name my_source [--keep-raw fhir-bundle-raw.xml] [--keep-dwh fhir-bundle-dwh.xml]
+Explainer: ExportFHIR's stdout is pseudonymized as it arrives, gzipped and sent as the body of the upload (chunked).
+The raw and/or pseudonymized bundle are only written to disk when asked for. If any step fails, the upload
+is aborted before it completes, so the server never receives a partial bundle.
+"""
+
+## Import built-ins
+import gzip
+import os
+import subprocess
+import sys
+import threading
+
+## Import third party libraries
+import logging
+from pydantic_settings import BaseSettings
+
+## Run directly as a file (not as part of the installed package)? Then make the package importable
+if __package__ in (None, ""):
+    sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..')))
+from i2b2_upload_client.logic import api_processing
+from i2b2_upload_client.logic import stream_pseudonymization
+
+## ---------------- ##
+## Create  settings ##
+## ---------------- ##
+class Settings(BaseSettings):
+    """ The variables defined here will be taken from env vars if available and matching the type hint """
+    log_level: str = "WARNING"
+    log_format: str = "[%(asctime)s] {%(name)s/%(module)s:%(lineno)d (%(funcName)s)} %(levelname)s - %(message)s"
+    secret_key: None|str = None
+    compatible_java: str = "java"
+    stage1_libs_dir: str = os.path.abspath(os.path.join(getattr(sys, '_MEIPASS', os.path.join(os.path.dirname(__file__), '..', '..', '..')), 'resources', 'lib'))
+    pipeline_compress: bool = True
+    pipeline_chunk_size: int = 1 << 20
+settings = Settings()
+
+## Load logger for this file/script
+formatter = logging.Formatter(settings.log_format)
+logging.basicConfig(format=settings.log_format)
+## Set app's logger level and format...
+logger = logging.getLogger(__name__)
+logger.setLevel(settings.log_level)
+
+def exportfhir_command(datasource_config:str, java:None|str = None, libs_dir:None|str = None, heap_mb:None|int = None) -> list[str]:
+    """ The stage 1 (ExportFHIR) java call, which writes the raw fhir bundle to stdout
+    heap_mb: maximum java heap (-Xmx), default the JVM's own (a share of the machine's memory)
+    """
+    if java is None:
+        java = settings.compatible_java
+    if libs_dir is None:
+        libs_dir = settings.stage1_libs_dir
+    libs = [os.path.join(libs_dir, file) for file in next(os.walk(libs_dir), (None, None, []))[2] if file.endswith(".jar")] # [] if no file
+    ## Windows class path separator is ';'
+    javaCp = (';' if os.name == 'nt' else ':').join(libs)
+    heap = [f'-Xmx{heap_mb}m'] if heap_mb else []
+    return [java, *heap, '-Dfile.encoding=UTF-8', '-cp', javaCp, 'de.sekmi.histream.etl.ExportFHIR', datasource_config]
+
+class _TeeReader():
+    """ Binary reader which also writes everything read to a copy """
+    def __init__(self, source, copy):
+        self.source = source
+        self.copy = copy
+    def read(self, size:int = -1) -> bytes:
+        data = self.source.read(size)
+        self.copy.write(data)
+        return data
+    def seekable(self) -> bool:
+        """ Reading again would copy it twice """
+        return False
+    def close(self):
+        self.source.close()
+
+class _TeeWriter():
+    """ Binary writer which writes to several file objects """
+    def __init__(self, *outputs):
+        self.outputs = outputs
+    def write(self, data:bytes) -> int:
+        for output in self.outputs:
+            output.write(data)
+        return len(data)
+
+def run_pipeline(datasource_config:str, source_id:str, salt:None|str = None, keep_raw:None|str = None, keep_dwh:None|str = None, compress:None|bool = None, engine:None|str = None, workers:None|int = None) -> tuple[bool, str]:
+    """ Run stages 1 and 2 and upload the result as one stream, returns (success, message for the user)
+    keep_raw/keep_dwh: also write the raw/pseudonymized bundle to these files
+    compress: gzip the upload (default settings.pipeline_compress)
+    """
+    if compress is None:
+        compress = settings.pipeline_compress
+    if salt is None:
+        salt = settings.secret_key
+    if not salt:
+        logger.error("No secret key set! Cannot continue.")
+        return False, "No secret key set"
+
+    ## ExportFHIR -> (raw copy) -> pseudonymizer thread -> (dwh copy) -> gzip -> pipe -> upload body
+    logger.info("Running java subprocess.Popen to generate fhir (streamed)")
+    proc = subprocess.Popen(exportfhir_command(datasource_config), stdout=subprocess.PIPE)
+    pipeRead, pipeWrite = os.pipe()
+    failures:list = []
+    keptFiles:list = []
+
+    def pseudonymize():
+        """ Runs in its own thread, writing into the pipe until the bundle has been processed """
+        try:
+            with open(pipeWrite, 'wb') as pipe_f:
+                out_f = gzip.GzipFile(fileobj=pipe_f, mode='wb') if compress else pipe_f
+                in_f = proc.stdout
+                if keep_raw:
+                    keptFiles.append(open(keep_raw, 'wb'))
+                    in_f = _TeeReader(in_f, keptFiles[-1])
+                dwh_f = out_f
+                if keep_dwh:
+                    keptFiles.append(open(keep_dwh, 'wb'))
+                    dwh_f = _TeeWriter(out_f, keptFiles[-1])
+                if not stream_pseudonymization.pseudonymize_stream(in_f, dwh_f, salt, engine=engine, workers=workers):
+                    raise RuntimeError("Pseudonymization could not start")
+                if compress:
+                    out_f.close()
+        except BaseException as err:
+            logger.error("Pseudonymization failed: %s", err, exc_info=True)
+            failures.append(err)
+            ## Don't leave java blocked writing to a pipe no one reads
+            proc.kill()
+        finally:
+            for kept_f in keptFiles:
+                kept_f.close()
+
+    def body():
+        """ Upload data as it arrives, raising (which aborts the upload) if any stage failed """
+        while chunk := upload_f.read(settings.pipeline_chunk_size):
+            yield chunk
+        worker.join()
+        proc.wait()
+        if failures:
+            raise RuntimeError("Pseudonymization failed") from failures[0]
+        if proc.returncode != 0:
+            raise RuntimeError(f"Fhir generation had errors (return code: {proc.returncode})")
+
+    upload_f = open(pipeRead, 'rb')
+    worker = threading.Thread(target=pseudonymize, name="pipeline-pseudonymize", daemon=True)
+    worker.start()
+    try:
+        response = api_processing.uploadSourceStream(source_id, body(), "upload.gz" if compress else "fhir-bundle.xml")
+    except Exception as err:
+        logger.error("Pipeline failed, upload aborted: %s", err)
+        proc.kill()
+        ## Closing our end of the pipe stops the pseudonymizer if it is still writing
+        upload_f.close()
+        worker.join()
+        proc.wait()
+        return False, f"Pipeline failed, upload aborted: {err}"
+    finally:
+        upload_f.close()
+        proc.stdout.close()
+    logger.info("Pipeline complete: %s", response)
+    return not response.startswith("Error"), response
+
+## When called as script (not run if imported as module):
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Generate, pseudonymize and upload a datasource in one pass. Uses secret_key, dwh_api_key and DWH_API_ENDPOINT env vars.")
+    parser.add_argument('--datasource-config', required=True, help='The datasource.xml for stage 1.')
+    parser.add_argument('-n', '--ds-name', required=True, help='Name of datasource.')
+    parser.add_argument('--keep-raw', required=False, help='Also write the raw fhir bundle to this file.')
+    parser.add_argument('--keep-dwh', required=False, help='Also write the pseudonymized fhir bundle to this file.')
+    parser.add_argument('--no-compress', action='store_true', help='Upload the bundle uncompressed.')
+    args = parser.parse_args()
+
+    success, message = run_pipeline(args.datasource_config, args.ds_name, keep_raw=args.keep_raw, keep_dwh=args.keep_dwh, compress=not args.no_compress)
+    print(f"Response from server: {message}")
+    if not success:
+        sys.exit(1)
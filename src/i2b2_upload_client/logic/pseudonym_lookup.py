@@ -0,0 +1,295 @@
+#!/usr/bin/env python3
+"""
+Description: Look up patients in the pseudonym mapping (psn-cache.tsv), from pseudonym to demographics and back
+stderr: for logs
+
+Usage: src/i2b2_upload_client/logic/pseudonym_lookup.py --pseudonym 3f2a... | --patient "Hans" "Muller" 1970-01-01 | --queries clinic-request.tsv [--output found.tsv]
+Explainer: The first lookup copies the mapping into an index (SQLite, next to the TSV as psn-cache.tsv.index.sqlite),
+indexed by pseudonym and by (surname, given names, birthdate), so each lookup is a B-tree search instead of a scan of
+the TSV. Later lookups only add the rows appended to the TSV since (as with the pseudonym store), and rebuild the
+index if the TSV was rewritten. Names are matched ignoring case and extra spaces, the birthdate (and given names) can
+be left out to list every match. A queries file is a TSV with a 'pseudonym' column, or 'given-names', 'surname' and
+'birthdate' columns (as in psn-cache.tsv), the matches are written as TSV with the query's line number.
+With a pseudonym store (user_mapping_store), the index is built from the store instead, for the pseudonyms of your
+secret_key: the store always has every patient, the TSV may not (eg if it was moved, or written under another key).
+NOTE: The index holds the same names as the TSV, keep it (and its output) as safe as the TSV itself
+"""
+
+## Import built-ins
+import csv
+import hashlib
+import io
+import os
+import sqlite3
+import sys
+
+## Import third party libraries
+import logging
+from pydantic_settings import BaseSettings
+
+## Run directly as a file (not as part of the installed package)? Then make the package importable
+if __package__ in (None, ""):
+    sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..')))
+from i2b2_upload_client.logic.pseudonym_store import TSV_HEADINGS, PseudonymStore, salt_fingerprint
+
+## ---------------- ##
+## Create  settings ##
+## ---------------- ##
+class Settings(BaseSettings):
+    """ The variables defined here will be taken from env vars if available and matching the type hint """
+    log_level: str = "WARNING"
+    log_format: str = "[%(asctime)s] {%(name)s/%(module)s:%(lineno)d (%(funcName)s)} %(levelname)s - %(message)s"
+    user_mapping_filename: str = "psn-cache.tsv"
+    user_mapping_separator: str = "\t"
+    ## Pseudonym store, used instead of the TSV if set ("" = none)
+    user_mapping_store: str = ""
+    secret_key: None|str = None
+    ## Index of the mapping ("" = the mapping's (or store's) path + ".index.sqlite")
+    lookup_index_filename: str = ""
+settings = Settings()
+
+## Load logger for this file/script
+formatter = logging.Formatter(settings.log_format)
+logging.basicConfig(format=settings.log_format)
+## Set app's logger level and format...
+logger = logging.getLogger(__name__)
+logger.setLevel(settings.log_level)
+
+## Bytes at the start of the TSV compared to tell whether it was only appended to
+PREFIX_BYTES:int = 1 << 16
+## Rows inserted at once while indexing
+BATCH_ROWS:int = 10000
+
+def _normalize(value:str) -> str:
+    """ Match names regardless of case and spacing """
+    return " ".join(value.split()).casefold()
+
+def _prefix_hash(path:str, size:int) -> str:
+    with open(path, 'rb') as tsv_f:
+        return hashlib.sha256(tsv_f.read(min(size, PREFIX_BYTES))).hexdigest()
+
+class PseudonymLookup():
+    """ Indexed lookups in the mapping TSV (or pseudonym store), see the module description """
+    def __init__(self, mapping_tsv:None|str = None, index_path:None|str = None, separator:None|str = None, rebuild:bool = False,
+                 store_path:None|str = None, salt:None|str = None):
+        """ Open the index, bringing it up to date with the store (if one is set, else the TSV) first """
+        self.mapping_tsv = mapping_tsv or settings.user_mapping_filename
+        self.store_path = settings.user_mapping_store if store_path is None else store_path
+        self.salt = salt or settings.secret_key
+        if self.store_path and not self.salt:
+            raise ValueError(f"The pseudonym store '{self.store_path}' can only be searched with the secret_key it was written with")
+        self.index_path = index_path or settings.lookup_index_filename or (self.store_path or self.mapping_tsv) + ".index.sqlite"
+        self.separator = settings.user_mapping_separator if separator is None else separator
+        self.connection = sqlite3.connect(self.index_path)
+        self.connection.executescript("""
+            CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value) WITHOUT ROWID;
+            CREATE TABLE IF NOT EXISTS mapping (given_names TEXT NOT NULL, surname TEXT NOT NULL, birthdate TEXT NOT NULL, pseudonym TEXT NOT NULL,
+                given_key TEXT NOT NULL, surname_key TEXT NOT NULL);
+        """)
+        self.update(rebuild)
+
+    def _meta(self) -> dict:
+        return dict(self.connection.execute("SELECT key, value FROM meta"))
+
+    def _source(self) -> str:
+        """ What the index was built from, another source means indexing from the start """
+        if self.store_path:
+            return f"store:{os.path.abspath(self.store_path)}:{salt_fingerprint(self.salt)}"
+        return f"tsv:{os.path.abspath(self.mapping_tsv)}"
+
+    def _clear(self, name:str):
+        logger.info("Indexing '%s' from the start", name)
+        self.connection.executescript("""
+            DROP INDEX IF EXISTS mapping_by_pseudonym;
+            DROP INDEX IF EXISTS mapping_by_patient;
+            DELETE FROM mapping;
+            DELETE FROM meta;
+        """)
+
+    def _finish(self, meta:list[tuple]):
+        """ Create the indexes and remember how far the source was indexed """
+        ## Creating the indexes after a full (re)load is quicker than keeping them up to date row by row
+        self.connection.executescript("""
+            CREATE INDEX IF NOT EXISTS mapping_by_pseudonym ON mapping (pseudonym);
+            CREATE INDEX IF NOT EXISTS mapping_by_patient ON mapping (surname_key, given_key, birthdate);
+        """)
+        self.connection.executemany("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", [("source", self._source())] + meta)
+        self.connection.commit()
+
+    def update(self, rebuild:bool = False) -> int:
+        """ Index the rows added to the store or TSV since the last update (all of them if the TSV was rewritten), returns how many """
+        meta = self._meta()
+        rebuild = rebuild or meta.get("source") != self._source()
+        if self.store_path:
+            return self._update_from_store(meta, rebuild)
+        return self._update_from_tsv(meta, rebuild)
+
+    def _update_from_store(self, meta:dict, rebuild:bool) -> int:
+        if not os.path.isfile(self.store_path):
+            raise ValueError(f"Pseudonym store '{self.store_path}' not found")
+        store = PseudonymStore(self.store_path, self.salt, readonly=True)
+        try:
+            end = store.lastRowid()
+            offset = 0 if rebuild else meta.get("offset", 0)
+            if not rebuild and offset == end:
+                return 0
+            ## Pseudonyms are only ever added to the store, fewer means it was replaced
+            if rebuild or end < offset:
+                self._clear(self.store_path)
+                offset = 0
+            added = 0
+            batch:list = []
+            for row in store.rows(offset, end):
+                batch.append((row["given-names"], row["surname"], row["birthdate"], row["pseudonym"], _normalize(row["given-names"]), _normalize(row["surname"])))
+                if len(batch) >= BATCH_ROWS:
+                    added += self._insert(batch)
+            added += self._insert(batch)
+        finally:
+            store.close()
+        self._finish([("offset", end)])
+        logger.info("Indexed %s pseudonyms of '%s'", added, self.store_path)
+        return added
+
+    def _update_from_tsv(self, meta:dict, rebuild:bool) -> int:
+        info = os.stat(self.mapping_tsv)
+        offset = meta.get("offset", 0)
+        if not rebuild and meta.get("size") == info.st_size and meta.get("mtime_ns") == info.st_mtime_ns:
+            return 0
+        if rebuild or not offset or info.st_size < offset or meta.get("prefix") != _prefix_hash(self.mapping_tsv, offset):
+            self._clear(self.mapping_tsv)
+            offset = 0
+        added = 0
+        with open(self.mapping_tsv, 'rb') as tsv_f:
+            tsv_f.seek(offset)
+            reader = csv.reader(io.TextIOWrapper(tsv_f, encoding='UTF-8', newline=''), delimiter=self.separator, quotechar='"')
+            columns = meta.get("columns")
+            if offset == 0:
+                header = next(reader, None)
+                if header is None or not set(TSV_HEADINGS) <= set(header):
+                    raise ValueError(f"'{self.mapping_tsv}' is not a pseudonym mapping, expected the columns {TSV_HEADINGS}")
+                columns = ",".join(str(header.index(heading)) for heading in TSV_HEADINGS)
+            positions = [int(position) for position in columns.split(",")]
+            batch:list = []
+            for row in reader:
+                if len(row) <= max(positions):
+                    continue
+                given_names, surname, birthdate, pseudonym = (row[position] for position in positions)
+                batch.append((given_names, surname, birthdate, pseudonym, _normalize(given_names), _normalize(surname)))
+                if len(batch) >= BATCH_ROWS:
+                    added += self._insert(batch)
+            added += self._insert(batch)
+            ## The TSV could have grown while we read it, what we read is what counts
+            end = tsv_f.tell()
+        self._finish([
+            ("offset", end), ("size", info.st_size), ("mtime_ns", info.st_mtime_ns), ("columns", columns), ("prefix", _prefix_hash(self.mapping_tsv, end)),
+        ])
+        logger.info("Indexed %s rows of '%s'", added, self.mapping_tsv)
+        return added
+
+    def _insert(self, batch:list) -> int:
+        self.connection.executemany("INSERT INTO mapping (given_names, surname, birthdate, pseudonym, given_key, surname_key) VALUES (?, ?, ?, ?, ?, ?)", batch)
+        count = len(batch)
+        batch.clear()
+        return count
+
+    def _rows(self, where:str, params:tuple) -> list[dict]:
+        return [dict(zip(TSV_HEADINGS, row)) for row in self.connection.execute(
+            f"SELECT DISTINCT given_names, surname, birthdate, pseudonym FROM mapping WHERE {where} ORDER BY rowid", params)]
+
+    def by_pseudonym(self, pseudonym:str) -> list[dict]:
+        """ Mapping rows (TSV_HEADINGS keys) of the pseudonym, usually one """
+        return self._rows("pseudonym = ?", (pseudonym.strip(),))
+
+    def by_patient(self, given_names:str, surname:str, birthdate:str = "") -> list[dict]:
+        """ Mapping rows of the patient, names ignoring case and spacing. Without birthdate (or given names) every match is listed """
+        where, params = "surname_key = ?", [_normalize(surname)]
+        if given_names.strip():
+            where += " AND given_key = ?"
+            params.append(_normalize(given_names))
+        if birthdate.strip():
+            where += " AND birthdate = ?"
+            params.append(birthdate.strip())
+        return self._rows(where, tuple(params))
+
+    def lookup(self, query:dict) -> list[dict]:
+        """ by_pseudonym or by_patient, depending on the query's keys (TSV_HEADINGS) """
+        if query.get("pseudonym"):
+            return self.by_pseudonym(query["pseudonym"])
+        return self.by_patient(query.get("given-names") or "", query.get("surname") or "", query.get("birthdate") or "")
+
+    def batch(self, queries):
+        """ (query, matches) of each query (dict with TSV_HEADINGS keys) """
+        for query in queries:
+            yield query, self.lookup(query)
+
+    def close(self):
+        self.connection.close()
+
+def read_queries(path:str, separator:None|str = None):
+    """ Queries from a TSV with a 'pseudonym' column, or 'given-names', 'surname' (and 'birthdate') columns ('-' for stdin) """
+    separator = settings.user_mapping_separator if separator is None else separator
+    query_f = sys.stdin if path == "-" else open(path, newline='', encoding='UTF-8')
+    try:
+        reader = csv.DictReader(query_f, delimiter=separator, quotechar='"')
+        if not ("pseudonym" in (reader.fieldnames or []) or {"given-names", "surname"} <= set(reader.fieldnames or [])):
+            raise ValueError(f"'{path}' needs a 'pseudonym' column, or 'given-names', 'surname' (and 'birthdate') columns")
+        yield from reader
+    finally:
+        if query_f is not sys.stdin:
+            query_f.close()
+
+## When called as script (not run if imported as module):
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Find patients in the pseudonym mapping, by pseudonym or by name and birthdate. Exits with 3 if a query had no match.")
+    parser.add_argument('--mapping', default=settings.user_mapping_filename, help=f'The mapping TSV (default {settings.user_mapping_filename}).')
+    parser.add_argument('--store', default=settings.user_mapping_store, help='Search this pseudonym store instead of the mapping, with your secret_key (env var) (default user_mapping_store).')
+    parser.add_argument('--index', help='The index file (default: the mapping\'s or store\'s path + .index.sqlite).')
+    parser.add_argument('--rebuild', action='store_true', help='Index the mapping from the start.')
+    query = parser.add_mutually_exclusive_group(required=True)
+    query.add_argument('--pseudonym', help='Find the patient with this pseudonym.')
+    query.add_argument('--patient', nargs='+', metavar=('GIVEN_NAMES SURNAME', 'BIRTHDATE'), help='Find the pseudonym(s) of this patient ("" for any given names, birthdate optional).')
+    query.add_argument('--queries', help='TSV of queries, see the module description (- for stdin).')
+    query.add_argument('--update', action='store_true', help='Only bring the index up to date.')
+    parser.add_argument('--output', help='Write the matches to this TSV file (default stdout).')
+    args = parser.parse_args()
+
+    if not args.store and not os.path.isfile(args.mapping):
+        logger.error("Pseudonym mapping '%s' not found", args.mapping)
+        sys.exit(1)
+    if args.patient is not None and len(args.patient) not in (2, 3):
+        parser.error("--patient takes GIVEN_NAMES SURNAME [BIRTHDATE]")
+    try:
+        lookup = PseudonymLookup(args.mapping, args.index, rebuild=args.rebuild, store_path=args.store)
+    except ValueError as err:
+        logger.error("%s", err)
+        sys.exit(1)
+    if args.update:
+        print(f"Index '{lookup.index_path}' is up to date ({lookup.connection.execute('SELECT count(*) FROM mapping').fetchone()[0]:,} rows)")
+        sys.exit(0)
+    if args.pseudonym is not None:
+        queries = [{"pseudonym": args.pseudonym}]
+    elif args.patient is not None:
+        queries = [dict(zip(["given-names", "surname", "birthdate"], args.patient))]
+    else:
+        queries = read_queries(args.queries)
+    out_f = open(args.output, 'w', newline='\n', encoding='UTF-8') if args.output else sys.stdout
+    writer = csv.DictWriter(out_f, delimiter=settings.user_mapping_separator, quotechar='"', quoting=csv.QUOTE_MINIMAL, fieldnames=["query"] + TSV_HEADINGS, lineterminator='\n')
+    writer.writeheader()
+    missing = 0
+    try:
+        for number, (query, matches) in enumerate(lookup.batch(queries), start=1):
+            if not matches:
+                missing += 1
+                logger.warning("No match for query %s: %s", number, query)
+            for match in matches:
+                writer.writerow({"query": number, **match})
+    except ValueError as err:
+        logger.error("%s", err)
+        sys.exit(1)
+    finally:
+        if out_f is not sys.stdout:
+            out_f.close()
+        lookup.close()
+    if missing:
+        sys.exit(3)
@@ -0,0 +1,184 @@
+#!/usr/bin/env python3
+"""
+Description: Persistent (SQLite) cache of the pseudonyms created during pseudonymization, reused across runs
+stderr: for logs
+
+Usage: src/i2b2_upload_client/logic/pseudonym_store.py --export-tsv psn-cache.tsv
+Explainer: Pseudonyms are stored per salt (as a fingerprint, never the salt itself) and demographic tuple.
+Known patients are a lookup, new ones are added and (optionally) appended to the TSV mapping file.
+The store remembers which TSV it last completed (per salt, with its size and modification time): a TSV that is
+missing, was changed since or was written under another salt is rewritten in full, so it never lacks patients.
+The store is also the source for a full TSV export, compatible with the psn-cache.tsv written by earlier versions.
+NOTE: The store holds the same names as the TSV, keep it as safe as the TSV itself. It is off unless user_mapping_store is set
+"""
+
+## Import built-ins
+import csv
+import hashlib
+import os
+import sqlite3
+import sys
+
+## Import third party libraries
+import logging
+from pydantic_settings import BaseSettings
+
+## ---------------- ##
+## Create  settings ##
+## ---------------- ##
+class Settings(BaseSettings):
+    """ The variables defined here will be taken from env vars if available and matching the type hint """
+    log_level: str = "WARNING"
+    log_format: str = "[%(asctime)s] {%(name)s/%(module)s:%(lineno)d (%(funcName)s)} %(levelname)s - %(message)s"
+    secret_key: None|str = None
+    ## Off by default ("" = no store), eg "psn-cache.sqlite"
+    user_mapping_store: str = ""
+    user_mapping_separator: str = "\t"
+settings = Settings()
+
+## Load logger for this file/script
+formatter = logging.Formatter(settings.log_format)
+logging.basicConfig(format=settings.log_format)
+## Set app's logger level and format...
+logger = logging.getLogger(__name__)
+logger.setLevel(settings.log_level)
+
+## Columns of the TSV mapping file
+TSV_HEADINGS:list[str] = ["given-names", "surname", "birthdate", "pseudonym"]
+## Columns of the source patient id -> pseudonym file written by tabular_pseudonymization.py
+SOURCE_TSV_HEADINGS:list[str] = ["source-id", "pseudonym"]
+
+def salt_fingerprint(salt:str) -> str:
+    """ Identify the salt without storing it """
+    return hashlib.sha3_256(f"i2b2-upload-client|{salt}".encode('UTF-8')).hexdigest()[:16]
+
+class PseudonymStore():
+    """ Pseudonyms indexed by (salt fingerprint, given-names, surname, birthdate)
+    Can be used in place of the mapping csv.DictWriter: writerow() adds the patient (if new) and passes
+    new patients on to tsv_output, so the TSV only grows by the patients it hasn't seen before.
+    """
+    commit_every:int = 10000
+    def __init__(self, path:str, salt:str, readonly:bool = False, tsv_output: None|csv.DictWriter = None):
+        """ Open (or create) the store for the given salt """
+        self.path = path
+        self.fingerprint = salt_fingerprint(salt)
+        self.tsv_output = tsv_output
+        self._uncommitted:int = 0
+        if readonly:
+            self.connection = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+        else:
+            self.connection = sqlite3.connect(path)
+            ## WAL lets readers (eg pseudonymization worker processes) continue while we write
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            self.connection.execute("""CREATE TABLE IF NOT EXISTS pseudonyms (
+                salt_fingerprint TEXT NOT NULL,
+                given_names TEXT NOT NULL,
+                surname TEXT NOT NULL,
+                birthdate TEXT NOT NULL,
+                pseudonym TEXT NOT NULL,
+                first_seen TEXT NOT NULL DEFAULT CURRENT_TIMESTAMP,
+                PRIMARY KEY (salt_fingerprint, given_names, surname, birthdate)
+            )""")
+            ## The TSV files completed by this store: written under which salt, and how they looked afterwards
+            self.connection.execute("""CREATE TABLE IF NOT EXISTS tsv_files (
+                path TEXT PRIMARY KEY,
+                salt_fingerprint TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                mtime_ns INTEGER NOT NULL
+            )""")
+            self.connection.commit()
+
+    def knowsSalt(self) -> bool:
+        """ Whether any pseudonyms were stored with this salt """
+        return self.connection.execute("SELECT 1 FROM pseudonyms WHERE salt_fingerprint = ? LIMIT 1", (self.fingerprint,)).fetchone() is not None
+
+    def tsvIsCurrent(self, path:str) -> bool:
+        """ Whether the TSV is the one this store last completed for this salt (and unchanged since), so new patients can be appended """
+        if not os.path.isfile(path):
+            return False
+        row = self.connection.execute("SELECT salt_fingerprint, size, mtime_ns FROM tsv_files WHERE path = ?", (os.path.abspath(path),)).fetchone()
+        info = os.stat(path)
+        return row is not None and tuple(row) == (self.fingerprint, info.st_size, info.st_mtime_ns)
+
+    def recordTsv(self, path:str):
+        """ Remember the TSV as complete for this salt (once it is closed) """
+        info = os.stat(path)
+        self.connection.execute("INSERT OR REPLACE INTO tsv_files (path, salt_fingerprint, size, mtime_ns) VALUES (?, ?, ?, ?)",
+            (os.path.abspath(path), self.fingerprint, info.st_size, info.st_mtime_ns))
+        self.commit()
+
+    def lookup(self, given_name:str, surname:str, birthdate:str) -> None|str:
+        """ The stored pseudonym, or None if the patient is not known (for this salt) """
+        row = self.connection.execute(
+            "SELECT pseudonym FROM pseudonyms WHERE salt_fingerprint = ? AND given_names = ? AND surname = ? AND birthdate = ?",
+            (self.fingerprint, given_name, surname, birthdate)).fetchone()
+        return None if row is None else row[0]
+
+    def writerow(self, row:dict) -> bool:
+        """ Add a mapping row (with TSV_HEADINGS keys), returns whether the patient was new """
+        cursor = self.connection.execute(
+            "INSERT OR IGNORE INTO pseudonyms (salt_fingerprint, given_names, surname, birthdate, pseudonym) VALUES (?, ?, ?, ?, ?)",
+            (self.fingerprint, row["given-names"], row["surname"], row["birthdate"], row["pseudonym"]))
+        isNew = cursor.rowcount == 1
+        if isNew:
+            if self.tsv_output is not None:
+                self.tsv_output.writerow(row)
+            self._uncommitted += 1
+            if self._uncommitted >= self.commit_every:
+                self.commit()
+        return isNew
+
+    def commit(self):
+        """ Persist what was added so far """
+        self.connection.commit()
+        self._uncommitted = 0
+
+    def close(self):
+        """ Commit and close the database """
+        self.commit()
+        self.connection.close()
+
+    def lastRowid(self) -> int:
+        """ Position of the latest stored pseudonym (of any salt), rows() up to it are the ones stored so far """
+        return self.connection.execute("SELECT coalesce(max(rowid), 0) FROM pseudonyms").fetchone()[0]
+
+    def rows(self, after:int = 0, until:None|int = None):
+        """ All mapping rows (TSV_HEADINGS keys) stored for this salt, in the order they were added (only those after / until a lastRowid()) """
+        for row in self.connection.execute(
+                "SELECT given_names, surname, birthdate, pseudonym FROM pseudonyms WHERE salt_fingerprint = ? AND rowid > ? AND rowid <= ? ORDER BY rowid",
+                (self.fingerprint, after, self.lastRowid() if until is None else until)):
+            yield dict(zip(TSV_HEADINGS, row))
+
+    def export_tsv(self, out_file:str, separator:str = "\t") -> int:
+        """ Write all pseudonyms for this salt in the psn-cache.tsv format, returns the number of rows """
+        count = 0
+        with open(out_file, 'w', newline='\n') as map_f:
+            mapping_writer = csv.DictWriter(map_f, delimiter=separator, quotechar='"', quoting=csv.QUOTE_MINIMAL, fieldnames=TSV_HEADINGS, lineterminator='\n')
+            mapping_writer.writeheader()
+            for row in self.rows():
+                mapping_writer.writerow(row)
+                count += 1
+        return count
+
+def read_source_pseudonyms(path:str, separator:str = "\t") -> dict:
+    """ Source patient id -> pseudonym, as written by tabular_pseudonymization.py """
+    with open(path, newline='') as source_f:
+        return {row["source-id"]: row["pseudonym"] for row in csv.DictReader(source_f, delimiter=separator, quotechar='"')}
+
+## When called as script (not run if imported as module):
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Export the pseudonyms stored for your secret_key (env var) as TSV.")
+    parser.add_argument('--store', default=settings.user_mapping_store or None, required=not settings.user_mapping_store, help='The pseudonym store (SQLite file, default user_mapping_store).')
+    parser.add_argument('--export-tsv', required=True, help='TSV file to write.')
+    args = parser.parse_args()
+
+    if not settings.secret_key:
+        logger.error("No secret key set! Cannot continue.")
+        sys.exit(1)
+    if not os.path.isfile(args.store):
+        logger.error("Pseudonym store '%s' not found", args.store)
+        sys.exit(1)
+    store = PseudonymStore(args.store, settings.secret_key, readonly=True)
+    print(f"Exported {store.export_tsv(args.export_tsv, settings.user_mapping_separator)} pseudonyms to '{args.export_tsv}'")
+    store.close()
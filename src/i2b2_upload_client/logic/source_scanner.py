@@ -0,0 +1,260 @@
+#!/usr/bin/env python3
+"""
+Description: Find the local sources whose fhir bundles are out of date, and (re)generate them, several at once
+stderr: for logs
+
+Usage: src/i2b2_upload_client/logic/source_scanner.py --root /datasources [--list] [--workers 2] [--only my_source] [--force]
+Explainer: Each directory of root with a datasource.xml is a source. When it is processed, the size, modification time
+and content hash of datasource.xml, every local file it references (<url>) and the outputs in client-output/ are
+recorded in client-output/scan-manifest.json. On the next scan a source is stale if any of these was added, removed
+or changed (only files whose size or time changed are hashed again, so touching a file doesn't count), or if the
+secret key changed. Stale sources run stages 1 and 2 in their own processes, in the source's directory as before,
+with the java heaps of stage 1 sharing stage1_max_heap_mb (see stage1_scheduler).
+"""
+
+## Import built-ins
+from concurrent.futures import ThreadPoolExecutor
+import datetime
+import hashlib
+import json
+import os
+import subprocess
+import sys
+import time
+import urllib.parse
+import urllib.request
+
+## Import third party libraries
+import logging
+import lxml.etree
+from pydantic_settings import BaseSettings
+
+## Run directly as a file (not as part of the installed package)? Then make the package importable
+if __package__ in (None, ""):
+    sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..')))
+from i2b2_upload_client.logic import stage1_scheduler
+
+## ---------------- ##
+## Create  settings ##
+## ---------------- ##
+class Settings(BaseSettings):
+    """ The variables defined here will be taken from env vars if available and matching the type hint """
+    log_level: str = "WARNING"
+    log_format: str = "[%(asctime)s] {%(name)s/%(module)s:%(lineno)d (%(funcName)s)} %(levelname)s - %(message)s"
+    secret_key: None|str = None
+    ## Sources processed at once (each runs a java and a python process), their java heaps share stage1_max_heap_mb (see stage1_scheduler)
+    scan_workers: int = 2
+settings = Settings()
+
+## Load logger for this file/script
+formatter = logging.Formatter(settings.log_format)
+logging.basicConfig(format=settings.log_format)
+## Set app's logger level and format...
+logger = logging.getLogger(__name__)
+logger.setLevel(settings.log_level)
+
+DATASOURCE_CONFIG:str = "datasource.xml"
+OUTPUT_DIR:str = "client-output"
+RAW_BUNDLE:str = "fhir-bundle-raw.xml"
+DWH_BUNDLE:str = "fhir-bundle-dwh.xml"
+SCAN_MANIFEST:str = "scan-manifest.json"
+LOG_FILE:str = "processing.log"
+## Where the package is, so the stage 2 process can import it
+_packageParent = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..'))
+
+def _file_hash(path:str) -> str:
+    """ sha256 of the file's content """
+    digest = hashlib.sha256()
+    with open(path, 'rb') as in_f:
+        while chunk := in_f.read(1 << 20):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def file_record(path:str, previous:None|dict = None) -> dict:
+    """ Size, modification time and content hash of path, the hash is taken from previous if size and time are unchanged """
+    stat = os.stat(path)
+    if previous is not None and previous.get('size') == stat.st_size and previous.get('mtime_ns') == stat.st_mtime_ns:
+        return previous
+    return {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "sha256": _file_hash(path)}
+
+def _key_fingerprint(salt:str) -> str:
+    """ Tells whether the secret key changed, without keeping it """
+    return hashlib.sha256(salt.encode()).hexdigest()[:16]
+
+def referenced_files(datasource_config:str) -> list[str]:
+    """ Local files the datasource.xml refers to (<url>, relative to the datasource.xml), other urls are skipped """
+    base_dir = os.path.dirname(os.path.abspath(datasource_config))
+    files = []
+    for url in lxml.etree.parse(datasource_config).getroot().iter('{*}url'):
+        if not (url.text or "").strip():
+            continue
+        parsed = urllib.parse.urlparse(url.text.strip())
+        if parsed.scheme == 'file':
+            path = urllib.request.url2pathname(parsed.path)
+        elif parsed.scheme and len(parsed.scheme) > 1:
+            logger.debug("Not a local file, not checked for changes: %s", url.text.strip())
+            continue
+        else:
+            ## No scheme, or a windows drive letter
+            path = os.path.join(base_dir, url.text.strip())
+        if os.path.normpath(path) not in files:
+            files.append(os.path.normpath(path))
+    return files
+
+def _relative(path:str, source_dir:str) -> str:
+    """ Paths are recorded relative to the source (absolute if outside it), so a moved /datasources stays valid """
+    relative = os.path.relpath(path, source_dir)
+    return path if relative.startswith(os.pardir) else relative
+
+def record_inputs(source_dir:str, previous:None|dict = None) -> dict:
+    """ file_record of datasource.xml and the files it references, by path. Missing files are recorded as None """
+    previous = previous or {}
+    config = os.path.join(source_dir, DATASOURCE_CONFIG)
+    records = {}
+    for path in [config] + referenced_files(config):
+        name = _relative(path, source_dir)
+        records[name] = file_record(path, previous.get(name)) if os.path.isfile(path) else None
+    return records
+
+def read_scan_manifest(source_dir:str) -> None|dict:
+    """ What was recorded when the source was last processed (None if never, or unreadable) """
+    try:
+        with open(os.path.join(source_dir, OUTPUT_DIR, SCAN_MANIFEST)) as manifest_f:
+            return json.load(manifest_f)
+    except (OSError, ValueError):
+        return None
+
+def check_source(source_dir:str, salt:None|str = None) -> list[str]:
+    """ Why the source needs processing, empty if its outputs are up to date """
+    manifest = read_scan_manifest(source_dir)
+    if manifest is None:
+        return ["not processed yet"]
+    reasons = []
+    if salt and manifest.get('key') != _key_fingerprint(salt):
+        reasons.append("secret key changed")
+    try:
+        inputs = record_inputs(source_dir, manifest.get('inputs'))
+    except (OSError, lxml.etree.XMLSyntaxError) as err:
+        return [f"{DATASOURCE_CONFIG} unreadable: {err}"]
+    recorded = manifest.get('inputs', {})
+    for name in sorted(set(inputs) | set(recorded)):
+        if name not in recorded:
+            reasons.append(f"new input {name}")
+        elif name not in inputs:
+            reasons.append(f"no longer used {name}")
+        elif inputs[name] is None:
+            reasons.append(f"missing input {name}")
+        elif recorded[name] is None or inputs[name]['sha256'] != recorded[name]['sha256']:
+            reasons.append(f"changed {name}")
+    for name, previous in manifest.get('outputs', {}).items():
+        path = os.path.join(source_dir, OUTPUT_DIR, name)
+        if not os.path.isfile(path):
+            reasons.append(f"missing output {name}")
+        elif file_record(path, previous)['sha256'] != previous['sha256']:
+            reasons.append(f"modified output {name}")
+    return reasons
+
+def scan_sources(root:str, salt:None|str = None, only:None|list[str] = None) -> list[dict]:
+    """ Each source under root (a directory with a datasource.xml), with the reasons it is stale
+    return [{name: str, dir: str, reasons: list[str]}]
+    """
+    sources = []
+    for name in sorted(os.listdir(root)):
+        source_dir = os.path.join(root, name)
+        if (only and name not in only) or not os.path.isfile(os.path.join(source_dir, DATASOURCE_CONFIG)):
+            continue
+        sources.append({"name": name, "dir": source_dir, "reasons": check_source(source_dir, salt)})
+    return sources
+
+def process_source(source_dir:str, salt:str, heap_mb:None|int = None) -> tuple[bool, str]:
+    """ Run stages 1 and 2 for the source and record it, returns (success, message)
+    Both stages log to client-output/processing.log. Each bundle is only replaced once its stage succeeded
+    heap_mb: java heap of stage 1 (default the JVM's own)
+    """
+    output_dir = os.path.join(source_dir, OUTPUT_DIR)
+    os.makedirs(output_dir, exist_ok=True)
+    ## Record the inputs before they are read, a change while processing is then seen by the next scan
+    previous = read_scan_manifest(source_dir) or {}
+    inputs = record_inputs(source_dir, previous.get('inputs'))
+    raw_file, dwh_file = os.path.join(output_dir, RAW_BUNDLE), os.path.join(output_dir, DWH_BUNDLE)
+    env = {**os.environ, "secret_key": salt, "PYTHONPATH": os.pathsep.join(filter(None, [_packageParent, os.environ.get("PYTHONPATH")]))}
+    with open(os.path.join(output_dir, LOG_FILE), 'wb') as log_f:
+        stage1 = stage1_scheduler.run_export(os.path.abspath(os.path.join(source_dir, DATASOURCE_CONFIG)), raw_file, heap_mb, cwd=source_dir, log_f=log_f)
+    if stage1['returncode'] != 0:
+        return False, f"Fhir generation failed (return code {stage1['returncode']}), see {os.path.join(OUTPUT_DIR, LOG_FILE)}"
+    with open(os.path.join(output_dir, LOG_FILE), 'ab') as log_f, open(raw_file, 'rb') as raw_f, open(dwh_file + '.part', 'wb') as dwh_f:
+        stage2 = subprocess.run([sys.executable, '-m', 'i2b2_upload_client.logic.stream_pseudonymization'],
+            stdin=raw_f, stdout=dwh_f, stderr=log_f, cwd=source_dir, env=env)
+    if stage2.returncode != 0:
+        os.remove(dwh_file + '.part')
+        return False, f"Pseudonymization failed (return code {stage2.returncode}), see {os.path.join(OUTPUT_DIR, LOG_FILE)}"
+    os.replace(dwh_file + '.part', dwh_file)
+    manifest = {
+        "processed": datetime.datetime.now().isoformat(timespec='seconds'),
+        "key": _key_fingerprint(salt),
+        "inputs": inputs,
+        "outputs": {name: file_record(os.path.join(output_dir, name)) for name in [RAW_BUNDLE, DWH_BUNDLE]},
+    }
+    with open(os.path.join(output_dir, SCAN_MANIFEST + '.part'), 'w') as manifest_f:
+        json.dump(manifest, manifest_f, indent=2)
+    os.replace(os.path.join(output_dir, SCAN_MANIFEST + '.part'), os.path.join(output_dir, SCAN_MANIFEST))
+    return True, f"{os.path.getsize(dwh_file) / 1e6:.1f} MB bundle written"
+
+def process_stale_sources(sources:list[dict], salt:str, workers:None|int = None, force:bool = False, progress = None) -> list[dict]:
+    """ process_source for each stale source (all with force), at most workers (default settings.scan_workers) at once
+    Adds success, message and seconds to each source processed, progress(source) is called as each finishes
+    """
+    todo = [source for source in sources if force or source['reasons']]
+    workers, heap_mb = stage1_scheduler.plan_heap(settings.scan_workers if workers is None else workers)
+    def run(source:dict) -> dict:
+        started = time.monotonic()
+        try:
+            source['success'], source['message'] = process_source(source['dir'], salt, heap_mb)
+        except (OSError, lxml.etree.XMLSyntaxError) as err:
+            logger.error("Processing '%s' failed: %s", source['name'], err)
+            source['success'], source['message'] = False, str(err)
+        source['seconds'] = time.monotonic() - started
+        if progress is not None:
+            progress(source)
+        return source
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="source") as executor:
+        return list(executor.map(run, todo))
+
+## When called as script (not run if imported as module):
+if __name__ == "__main__":
+    import argparse
+    from prettytable import PrettyTable
+    parser = argparse.ArgumentParser(description="Process the local sources whose fhir bundles are out of date.")
+    parser.add_argument('--root', default='/datasources', help='Directory with one directory per source (default /datasources).')
+    parser.add_argument('--list', action='store_true', help='Only show which sources are stale and why.')
+    parser.add_argument('--only', nargs='+', help='Only these sources (directory names).')
+    parser.add_argument('--force', action='store_true', help='Process the sources even if up to date.')
+    parser.add_argument('--workers', type=int, help=f'Sources processed at once (default {settings.scan_workers}).')
+    args = parser.parse_args()
+
+    sources = scan_sources(args.root, settings.secret_key, args.only)
+    if not sources:
+        print(f"No sources (directories with a {DATASOURCE_CONFIG}) found in '{args.root}'")
+        sys.exit(0 if not args.only else 1)
+    for source in sources:
+        print(f"Source '{source['name']}': " + (", ".join(source['reasons']) if source['reasons'] else "up to date"))
+    if args.list:
+        sys.exit(0)
+    if not settings.secret_key:
+        logger.error("No secret key set (secret_key)! Cannot continue.")
+        sys.exit(1)
+
+    started = time.monotonic()
+    processed = process_stale_sources(sources, settings.secret_key, args.workers, args.force,
+        progress=lambda source: print(f"[{time.strftime('%H:%M:%S')}] {source['name']}: {'done' if source['success'] else 'FAILED'} ({source['seconds']:.1f}s)", flush=True))
+    if not processed:
+        print("All sources are up to date")
+        sys.exit(0)
+    myTable = PrettyTable(["source", "seconds", "outcome", "message"])
+    myTable.align = "l"
+    for source in processed:
+        myTable.add_row([source['name'], f"{source['seconds']:.1f}", "done" if source['success'] else "failed", source['message']])
+    print(myTable)
+    print(f"{sum(source['success'] for source in processed)} of {len(processed)} stale sources processed in {time.monotonic() - started:.1f}s")
+    if not all(source['success'] for source in processed):
+        sys.exit(1)
@@ -0,0 +1,165 @@
+#!/usr/bin/env python3
+"""
+Description: Run stage 1 (ExportFHIR) for many datasources at once, within a total java heap
+stderr: for logs
+
+Usage: src/i2b2_upload_client/logic/stage1_scheduler.py a/datasource.xml b/datasource.xml [--output-dir tmp/raw] [--workers 2] [--max-heap-mb 4096]
+Explainer: Each datasource runs in its own JVM, at most stage1_workers at once. With stage1_max_heap_mb, every JVM gets an
+equal share of it as its maximum heap (-Xmx), so together they stay within it; if a share would be less than
+stage1_min_heap_mb, fewer run at once instead. Each JVM writes its bundle straight into the output file (replaced only
+if it succeeds), its exit code, duration and last lines of stderr are collected.
+"""
+
+## Import built-ins
+from concurrent.futures import ThreadPoolExecutor
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+## Import third party libraries
+import logging
+from pydantic_settings import BaseSettings
+
+## Run directly as a file (not as part of the installed package)? Then make the package importable
+if __package__ in (None, ""):
+    sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..')))
+from i2b2_upload_client.logic import pipeline
+
+## ---------------- ##
+## Create  settings ##
+## ---------------- ##
+class Settings(BaseSettings):
+    """ The variables defined here will be taken from env vars if available and matching the type hint """
+    log_level: str = "WARNING"
+    log_format: str = "[%(asctime)s] {%(name)s/%(module)s:%(lineno)d (%(funcName)s)} %(levelname)s - %(message)s"
+    stage1_workers: int = 2
+    ## Total heap (MB) of the JVMs running at once, 0: each JVM uses its default (a share of the machine's memory, each!)
+    stage1_max_heap_mb: int = 0
+    stage1_min_heap_mb: int = 256
+settings = Settings()
+
+## Load logger for this file/script
+formatter = logging.Formatter(settings.log_format)
+logging.basicConfig(format=settings.log_format)
+## Set app's logger level and format...
+logger = logging.getLogger(__name__)
+logger.setLevel(settings.log_level)
+
+## Lines of stderr kept for the result
+STDERR_TAIL:int = 5
+
+def plan_heap(workers:None|int = None, max_heap_mb:None|int = None, min_heap_mb:None|int = None) -> tuple[int, None|int]:
+    """ How many JVMs to run at once and the heap (MB, None: JVM default) of each, so together they stay within max_heap_mb
+    Defaults from settings
+    """
+    workers = max(1, settings.stage1_workers if workers is None else workers)
+    max_heap_mb = settings.stage1_max_heap_mb if max_heap_mb is None else max_heap_mb
+    min_heap_mb = settings.stage1_min_heap_mb if min_heap_mb is None else min_heap_mb
+    if not max_heap_mb:
+        return workers, None
+    if max_heap_mb // workers < min_heap_mb:
+        workers = max(1, max_heap_mb // min_heap_mb)
+        logger.info("Running %s at once, so each gets at least %s MB of the %s MB heap", workers, min_heap_mb, max_heap_mb)
+    return workers, max_heap_mb // workers
+
+def _tail(err_f, lines:int = STDERR_TAIL) -> str:
+    """ The last lines written to the (binary) file """
+    err_f.seek(max(0, err_f.seek(0, os.SEEK_END) - 8192))
+    return "\n".join(err_f.read().decode(errors='replace').splitlines()[-lines:])
+
+def run_export(datasource_config:str, output:str, heap_mb:None|int = None, cwd:None|str = None, log_f = None, cancelled = None) -> dict:
+    """ ExportFHIR for one datasource, its stdout written straight into output (which is only replaced if it succeeds)
+    log_f: binary file for its stderr (default: kept in a temporary file for the message)
+    cancelled(): checked while it runs, the JVM is stopped once it returns true
+    return {config: str, output: str, returncode: int, seconds: float, heap_mb: int|None, bytes: int, message: str}
+    """
+    result = {"config": datasource_config, "output": output, "heap_mb": heap_mb, "bytes": 0}
+    started = time.monotonic()
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output + '.part', 'wb') as out_f, tempfile.TemporaryFile() as err_f:
+        proc = subprocess.Popen(pipeline.exportfhir_command(datasource_config, heap_mb=heap_mb), stdout=out_f, stderr=log_f or err_f, cwd=cwd)
+        while True:
+            try:
+                proc.wait(timeout=0.5)
+                break
+            except subprocess.TimeoutExpired:
+                if cancelled is not None and cancelled():
+                    logger.warning("Stopping fhir generation of '%s'", datasource_config)
+                    proc.kill()
+        result["message"] = "" if log_f else _tail(err_f)
+    result["returncode"] = proc.returncode
+    result["seconds"] = time.monotonic() - started
+    if proc.returncode == 0:
+        os.replace(output + '.part', output)
+        result["bytes"] = os.path.getsize(output)
+    else:
+        os.remove(output + '.part')
+        logger.error("Fhir generation of '%s' had errors (return code: %s)", datasource_config, proc.returncode)
+    return result
+
+def run_stage1(jobs:list[tuple[str, str]], workers:None|int = None, max_heap_mb:None|int = None, progress = None, cancelled = None) -> list[dict]:
+    """ run_export for each (datasource_config, output), several at once (see plan_heap), returns the results in order
+    progress(result) is called as each finishes, once cancelled() is true the running JVMs are stopped and no more started
+    (also if interrupted, eg Ctrl-C, rather than leaving them running)
+    """
+    workers, heap_mb = plan_heap(workers, max_heap_mb)
+    stop = threading.Event()
+    stopping = lambda: stop.is_set() or (cancelled is not None and cancelled())
+    def run(job:tuple[str, str]) -> dict:
+        if stopping():
+            return {"config": job[0], "output": job[1], "heap_mb": heap_mb, "bytes": 0, "returncode": None, "seconds": 0.0, "message": "Cancelled"}
+        result = run_export(*job, heap_mb=heap_mb, cancelled=stopping)
+        if progress is not None:
+            progress(result)
+        return result
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="stage1") as executor:
+        try:
+            return list(executor.map(run, jobs))
+        except BaseException:
+            stop.set()
+            raise
+
+def default_output(datasource_config:str, output_dir:None|str = None) -> str:
+    """ client-output/fhir-bundle-raw.xml next to the datasource.xml, or in output_dir named after it (its directory, for a datasource.xml) """
+    config = os.path.abspath(datasource_config)
+    if output_dir is None:
+        return os.path.join(os.path.dirname(config), 'client-output', 'fhir-bundle-raw.xml')
+    name = os.path.splitext(os.path.basename(config))[0]
+    if name == 'datasource':
+        name = os.path.basename(os.path.dirname(config))
+    return os.path.join(output_dir, f"{name}.xml")
+
+## When called as script (not run if imported as module):
+if __name__ == "__main__":
+    import argparse
+    from prettytable import PrettyTable
+    parser = argparse.ArgumentParser(description="Generate the raw fhir bundles of many datasources at once.")
+    parser.add_argument('datasource_configs', nargs='+', help='datasource.xml files.')
+    parser.add_argument('--output-dir', help='Write the bundles here, named after each source (default: client-output/fhir-bundle-raw.xml next to each datasource.xml).')
+    parser.add_argument('--workers', type=int, help=f'JVMs run at once (default {settings.stage1_workers}).')
+    parser.add_argument('--max-heap-mb', type=int, help=f'Total heap of the JVMs run at once (default {settings.stage1_max_heap_mb or "no limit"}).')
+    args = parser.parse_args()
+
+    jobs = [(config, default_output(config, args.output_dir)) for config in args.datasource_configs]
+    outputs = [output for _, output in jobs]
+    if len(set(outputs)) < len(outputs):
+        logger.error("Several datasources would be written to the same file, use --output-dir or rename them: %s", sorted({output for output in outputs if outputs.count(output) > 1}))
+        sys.exit(2)
+    workers, heap_mb = plan_heap(args.workers, args.max_heap_mb)
+    print(f"Generating {len(jobs)} bundles, {workers} at once" + (f" with {heap_mb} MB heap each" if heap_mb else ""), file=sys.stderr)
+    started = time.monotonic()
+    results = run_stage1(jobs, args.workers, args.max_heap_mb,
+        progress=lambda result: print(f"[{time.strftime('%H:%M:%S')}] {result['config']}: {'done' if result['returncode'] == 0 else 'FAILED'} ({result['seconds']:.1f}s)", file=sys.stderr, flush=True))
+    myTable = PrettyTable(["datasource", "output", "exit code", "seconds", "MB written", "message"])
+    myTable.align = "l"
+    for result in results:
+        myTable.add_row([result['config'], result['output'], result['returncode'], f"{result['seconds']:.1f}", f"{result['bytes'] / 1e6:.1f}",
+            "" if result['returncode'] == 0 else (result['message'].splitlines() or [""])[-1]])
+    print(myTable)
+    failed = [result for result in results if result['returncode'] != 0]
+    print(f"{len(results) - len(failed)} of {len(results)} bundles generated in {time.monotonic() - started:.1f}s")
+    if failed:
+        sys.exit(1)
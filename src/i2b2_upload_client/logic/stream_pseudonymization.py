@@ -11,17 +11,36 @@ As of 27.11.25, this can be used as a module. It can accept in/out file as oppos
 """
 
 ## Import built-ins
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+import contextlib
 import csv
+import functools
 import hashlib
 import os
+import re
+import stat
 import sys
+import tempfile
+import time
+import tracemalloc
 import xml.sax
 
 ## Import third party libraries
 import logging
+import lxml.etree
 import lxml.sax
 from pydantic_settings import BaseSettings
 
+## Run directly as a file (not as part of the installed package)? Then make the package importable
+if __package__ in (None, ""):
+    sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..')))
+from i2b2_upload_client.logic.bundle_statistics import BundleStatistics, StatisticsEvents
+from i2b2_upload_client.logic.clash_detection import ClashDetector
+from i2b2_upload_client.logic.delta_manifest import DeltaManifest
+from i2b2_upload_client.logic.patient_index import PatientIndex
+from i2b2_upload_client.logic.pseudonym_store import PseudonymStore, TSV_HEADINGS, read_source_pseudonyms
+
 ## ---------------- ##
 ## Create  settings ##
 ## ---------------- ##
@@ -31,7 +50,42 @@ class Settings(BaseSettings):
     log_format: str = "[%(asctime)s] {%(name)s/%(module)s:%(lineno)d (%(funcName)s)} %(levelname)s - %(message)s"
     secret_key: None|str = None
     user_mapping_filename: str = "psn-cache.tsv"
+    ## Persistent pseudonym cache reused across runs, eg "psn-cache.sqlite" (off by default, it is a second copy of the names)
+    user_mapping_store: str = ""
     user_mapping_separator: str = "\t"
+    ## Pseudonyms by source patient id, from tabular_pseudonymization.py ("" = off): listed patients get that pseudonym instead of a hash of the bundle's names
+    source_pseudonyms_filename: str = ""
+    ## Parser engine used for the bundle, see ENGINES
+    pseudonymization_engine: str = "sax"
+    ## Processes used to pseudonymize (1 = no parallelism, 0 = all cores)
+    pseudonymization_workers: int = 1
+    ## Approximate input bytes handed to a worker at once
+    pseudonymization_shard_size: int = 8 << 20
+    ## Stylesheet of the 'xslt' engine, its f:_hash_ids calls are answered by the engine (see FhirXsltStream)
+    pseudonymization_stylesheet: str = os.path.abspath(os.path.join(getattr(sys, '_MEIPASS', os.path.join(os.path.dirname(__file__), '..', '..', '..')), 'resources', 'fhir_both-python.xslt'))
+    ## Approximate input bytes the 'xslt' engine transforms at once (0 = each entry on its own)
+    xslt_batch_size: int = 1 << 20
+    ## Compare entries with the previous run (path of the manifest, "" = off) and optionally write only what changed
+    delta_manifest: str = ""
+    delta_bundle_filename: str = ""
+    ## Write the counts and checks of the bundle (see bundle_statistics.py) to this JSON file ("" = off)
+    statistics_report: str = ""
+    ## Replace the original Patient ids (each Patient's id and every 'Patient/<id>' reference) with the pseudonym
+    rewrite_patient_references: bool = False
+    ## Entries referring to a Patient not seen yet are held (in order) until it comes, on disk past this many MB
+    reference_defer_memory_mb: int = 64
+    ## Check for pseudonyms given to more than 1 patient, and patients pseudonymized twice (see clash_detection.py)
+    clash_detection: bool = False
+    ## Seconds between progress reports (progress hook, and stderr in script mode if pseudonymization_progress)
+    progress_interval: float = 2.0
+    pseudonymization_progress: bool = True
+    ## Output is collected and written in blocks of about this many bytes
+    output_buffer_size: int = 1 << 20
+    ## Fail the run once this process uses more memory (MB of RSS, 0 = no limit), checked every memory_sample_interval seconds
+    memory_ceiling_mb: int = 0
+    memory_sample_interval: float = 0.5
+    ## Also trace the python heap (with tracemalloc, which slows the run down) and log a memory report at the end
+    memory_instrumentation: bool = False
 settings = Settings()
 
 ## Load logger for this file/script
@@ -45,21 +99,124 @@ logger.warning("Logging loaded with default configuration")
 def is_stdin_piped():
     return not os.isatty(0)
 
-class FhirStream(xml.sax.ContentHandler):
-    """ SAX ContentHandler to help build each <Entry> by informing an lxml class """
+class EntryPseudonymizer():
+    """ Pseudonymize one complete Bundle child (usually an <entry>), independent of how it was parsed """
     entryResourceTypes:list[str] = ["Patient", "Encounter"]
-    def __init__(self, target, mapping_output: None|csv.DictWriter = None):
+    ## Only needed for the statistics, compiled once
+    _patientId = lxml.etree.XPath("//resource/Patient/id/@value")
+    _encounterId = lxml.etree.XPath("//resource/Encounter/id/@value")
+    _encounterSubject = lxml.etree.XPath("//resource/Encounter/subject/reference/@value")
+    def __init__(self, target, mapping_output: None|csv.DictWriter = None, statistics: None|BundleStatistics = None):
         """ Ensure the XML definition is written
-        Also setup the monitoring dict to detect clashes
+        Clashes are detected on the mapping output (see _ClashCheckingWriter)
+        mapping_output: csv.DictWriter like, if it also has lookup() (eg PseudonymStore) known patients are looked up instead of hashed
+        statistics: BundleStatistics like, told about each Patient and Encounter
         """
         self.currentEntryResourceType:str = None
-        self.currentSubElement = lxml.sax.ElementTreeContentHandler()
-        self.currentDepth:int = 0
         self.currentPatient:int = None
         self.currentEncounter:int = None
         self.mapping_output = mapping_output
+        self.statistics = statistics
         self.target = target
 
+    def _prepareEntry(self, entry):
+        """ Match the SAX engine's view of a parsed element (no namespace, no whitespace-only text) and track the entry's ids """
+        for elem in entry.iter():
+            tag = elem.tag
+            if tag[0] == "{":
+                tag = tag.split("}", 1)[1]
+                elem.tag = tag
+            if elem.text is not None and not elem.text.strip():
+                elem.text = None
+            if elem.tail is not None and not elem.tail.strip():
+                elem.tail = None
+            if tag in self.entryResourceTypes:
+                self.currentEntryResourceType = tag
+            if tag == "id":
+                if self.currentEntryResourceType == "Patient":
+                    self.currentPatient = elem.get('value')
+                elif self.currentEntryResourceType == "Encounter":
+                    self.currentEncounter = elem.get('value')
+
+    def _processEntry(self, entryTree):
+        """ Pseudonymize the entry (if relevant) and write it """
+        if self.currentEntryResourceType == "Patient":
+            #logger.debug("Pseudonymising patient...")
+            self._pseudonymizePatient(entryTree)
+        elif self.currentEntryResourceType == "Encounter":
+            #logger.debug("Using basic sequence for encounter id...")
+            self._cleanEncounterId(entryTree)
+        self._writeCurrentElement(entryTree)
+        self.currentEntryResourceType = None
+
+    def _writeCurrentElement(self, entryTree):
+        """ Write the sub-element (as the bytes lxml serialised it, non-ascii characters are escaped) """
+        ## Slightly hacky, we've already constructed a sub-element, so just write it
+        self.target.send(('data', lxml.etree.tostring(entryTree.getroot(), pretty_print=False)))
+
+    def _cleanEncounterId(self, entryTree):
+        """ Use fhir id as identifier value """
+        ##TODO: Should this reset per patient?
+        ## Reference elements with xpath; reasonably robust
+        identifiers = entryTree.xpath("//resource/Encounter/identifier/value")
+        if len(identifiers) > 1:
+            logger.warning("Encounter element has more than 1 'identifier/value' element (will update only the 1st):\n%s", lxml.etree.tostring(entryTree.xpath("//resource/Encounter")[0], pretty_print=True).decode('UTF-8'))
+        if self.statistics is not None:
+            reference = self._encounterSubject(entryTree)
+            self.statistics.encounter(self._validAttrib(self._encounterId(entryTree)) or None, reference[0] if reference else None, len(identifiers))
+        identifiers[0].attrib['value'] = self.currentEncounter
+
+    def _pseudonymizePatient(self, entryTree):
+        """ Hash (with salt) the PID and remove other name information """
+        pseudonym = None
+        if hasattr(self.mapping_output, 'lookupSourceId'):
+            ## Pseudonymized from the source tables already (and mapped there), the names never reached the bundle
+            pseudonym = self.mapping_output.lookupSourceId(self._validAttrib(entryTree.xpath("//resource/Patient/identifier/value/@value")))
+        if pseudonym is not None:
+            entryTree.xpath("//resource/Patient/identifier/value")[0].attrib['value'] = pseudonym
+        else:
+            ## Reference elements with xpath
+            given_names = self._validAttrib(entryTree.xpath("//resource/Patient/name/given/@value"))
+            surname = self._validAttrib(entryTree.xpath("//resource/Patient/name/family/@value"))
+            birthdate = self._validAttrib(entryTree.xpath("//resource/Patient/birthDate/@value"))
+            if hasattr(self.mapping_output, 'lookup'):
+                pseudonym = self.mapping_output.lookup(given_names, surname, birthdate)
+            if pseudonym is None:
+                pseudonym = _hash_ids(given_names, surname, birthdate)
+            entryTree.xpath("//resource/Patient/identifier/value")[0].attrib['value'] = pseudonym
+            mapped_patient = {
+                "given-names": given_names,
+                "surname": surname,
+                "birthdate": birthdate,
+                "pseudonym": self._validAttrib(entryTree.xpath("//resource/Patient/identifier/value/@value")),
+            }
+            self.mapping_output.writerow(mapped_patient)
+        names = entryTree.xpath("//resource/Patient/name")
+        if len(names) > 1:
+            logger.warning("Patient '%s' has more than 1 'name' entry, removing all, 1st occurance used for pseudonymization", self.currentPatient)
+        if self.statistics is not None:
+            self.statistics.patient(self._validAttrib(self._patientId(entryTree)) or None, len(names))
+        for nameElem in names:
+            entryTree.xpath("//resource/Patient")[0].remove(nameElem)
+
+    def _validAttrib(self, xpathAttrib) -> str:
+        """ Clean up the attribute in case its got multiple or zero elements."""
+        if len(xpathAttrib) == 1:
+            return xpathAttrib[0]
+        elif len(xpathAttrib) > 1:
+            logger.warning("There are multiple matching attributes (returning 1st)! '%s'", xpathAttrib)
+            return xpathAttrib[0]
+        else:
+            return ""
+
+class FhirStream(xml.sax.ContentHandler, EntryPseudonymizer):
+    """ SAX ContentHandler to help build each <Entry> by informing an lxml class """
+    def __init__(self, target, mapping_output: None|csv.DictWriter = None, statistics: None|BundleStatistics = None):
+        """ Prepare the lxml builder for the first entry """
+        EntryPseudonymizer.__init__(self, target, mapping_output, statistics)
+        self.currentSubElement = lxml.sax.ElementTreeContentHandler()
+        self.currentDepth:int = 0
+
         ## Share the xml declaration (to target)
         self.target.send(('init', ('xml', {'version': '1.0'}))) ## '<?xml version="1.0" ?>'
 
@@ -85,6 +242,7 @@ class FhirStream(xml.sax.ContentHandler):
 
     def characters(self, cdata):
         """ Future proof in case we have cData in our bundle in the future """
+        ## NOTE: expat hands text over in pieces (split at line breaks and entities), whitespace-only pieces inside a text are dropped too
         txt_str = cdata.strip()
         if len(txt_str) > 0:
             self.currentSubElement.characters(cdata)
@@ -97,60 +255,337 @@ class FhirStream(xml.sax.ContentHandler):
         else:
             self.currentSubElement.endElementNS((None, name), name)
             if self.currentDepth == 1:
-                if self.currentEntryResourceType == "Patient":
-                    #logger.debug("Pseudonymising patient...")
-                    self._pseudonymizePatient()
-                elif self.currentEntryResourceType == "Encounter":
-                    #logger.debug("Using basic sequence for encounter id...")
-                    self._cleanEncounterId()
-                self._writeCurrentElement()
+                self._processEntry(self.currentSubElement.etree)
                 #logger.debug('Clearing lxml element "%s"...', name)
-                self.currentEntryResourceType = None
                 self.currentSubElement = lxml.sax.ElementTreeContentHandler()
 
-    def _writeCurrentElement(self):
-        """ Write the sub-element """
-        treeXml = lxml.etree.tostring(self.currentSubElement.etree.getroot(), pretty_print=False).decode('UTF-8')
-        ## Slightly hacky, we've already constructed a sub-element, so just write it
-        self.target.send(('data', treeXml))
+class FhirIterStream(EntryPseudonymizer):
+    """ lxml iterparse engine: libxml2 builds each <entry> in C, python only sees finished entries
+    Produces the same output as FhirStream (namespaces, comments and whitespace-only text are dropped), except within
+    text: it is kept as it is, while FhirStream also drops the whitespace-only pieces expat splits it into (line breaks,
+    spaces between an entity and an element), eg 'line1\n  line2' there becomes 'line1  line2'
+    """
+    def parse(self, in_f):
+        """ Process each Bundle child once it is complete, then remove it so memory stays flat """
+        ## Share the xml declaration (to target)
+        self.target.send(('init', ('xml', {'version': '1.0'}))) ## '<?xml version="1.0" ?>'
+        ## huge_tree: single entries can be larger than libxml2's default limits (eg long free text)
+        context = lxml.etree.iterparse(in_f, events=('end',), tag='{*}entry', remove_comments=True, remove_pis=True, huge_tree=True)
+        bundle = None
+        for _, entry in context:
+            parent = entry.getparent()
+            if parent is None or parent.getparent() is not None:
+                ## Nested entry (eg a contained Bundle), handled with its top level entry
+                continue
+            if bundle is None:
+                bundle = parent
+                self.target.send(('start', ('Bundle', _bundle_attributes(bundle))))
+            ## iterparse reads ahead, so only flush what precedes this entry (non-entry children like <type>)
+            for sibling in reversed(list(entry.itersiblings(preceding=True))):
+                self._processChild(bundle, sibling)
+            self._processChild(bundle, entry)
+        if bundle is None:
+            bundle = context.root
+            self.target.send(('start', ('Bundle', _bundle_attributes(bundle))))
+        for child in list(bundle):
+            self._processChild(bundle, child)
+        self.target.send(('end', 'Bundle'))
 
-    def _cleanEncounterId(self):
-        """ Use fhir id as identifier value """
-        ##TODO: Should this reset per patient?
-        ## Reference elements with xpath; reasonably robust
-        if len(self.currentSubElement.etree.xpath("//resource/Encounter/identifier/value")) > 1:
-            logger.warning("Encounter element has more than 1 'identifier/value' element (will update only the 1st):\n%s", lxml.etree.tostring(self.currentSubElement.etree.xpath("//resource/Encounter")[0], pretty_print=True).decode('UTF-8'))
-        self.currentSubElement.etree.xpath("//resource/Encounter/identifier/value")[0].attrib['value'] = self.currentEncounter
+    def _processChild(self, bundle, child):
+        """ Process a finished child of the Bundle, then release it """
+        self._prepareEntry(child)
+        ## Detaching also drops the (now unused) namespace declarations inherited from <Bundle>
+        bundle.remove(child)
+        child.tail = None
+        self._processEntry(lxml.etree.ElementTree(child))
 
-    def _pseudonymizePatient(self):
-        """ Hash (with salt) the PID and remove other name information """
-        ## Reference elements with xpath
-        self.currentSubElement.etree.xpath("//resource/Patient/identifier/value")[0].attrib['value'] = _hash_ids(
-            self._validAttrib(self.currentSubElement.etree.xpath("//resource/Patient/name/given/@value")),
-            self._validAttrib(self.currentSubElement.etree.xpath("//resource/Patient/name/family/@value")),
-            self._validAttrib(self.currentSubElement.etree.xpath("//resource/Patient/birthDate/@value")),
-        )
-        mapped_patient = {
-            "given-names": self._validAttrib(self.currentSubElement.etree.xpath("//resource/Patient/name/given/@value")),
-            "surname": self._validAttrib(self.currentSubElement.etree.xpath("//resource/Patient/name/family/@value")),
-            "birthdate": self._validAttrib(self.currentSubElement.etree.xpath("//resource/Patient/birthDate/@value")),
-            "pseudonym": self._validAttrib(self.currentSubElement.etree.xpath("//resource/Patient/identifier/value/@value")),
-        }
-        self.mapping_output.writerow(mapped_patient)
-        if len(self.currentSubElement.etree.xpath("//resource/Patient/name")) > 1:
-            logger.warning("Patient '%s' has more than 1 'name' entry, removing all, 1st occurance used for pseudonymization", self.currentPatient)
-        for nameElem in self.currentSubElement.etree.xpath("//resource/Patient/name"):
-            self.currentSubElement.etree.xpath("//resource/Patient")[0].remove(nameElem)
+class FhirPassthroughStream(EntryPseudonymizer):
+    """ Byte level engine: only entries of entryResourceTypes are parsed (with lxml), everything else is
+    copied from the input bytes unchanged. Pseudonymized entries and the mapping match the other engines,
+    but the untouched parts keep their original formatting (whitespace, comments, xml declaration).
+    """
+    parser = lxml.etree.XMLParser(remove_comments=True, remove_pis=True, huge_tree=True)
+    def parse(self, in_f):
+        """ Split the input at entry boundaries, only materialising the entries we need to change """
+        self.processSegments(_iter_bundle_segments(in_f))
 
-    def _validAttrib(self, xpathAttrib) -> str:
-        """ Clean up the attribute in case its got multiple or zero elements."""
-        if len(xpathAttrib) == 1:
-            return xpathAttrib[0]
-        elif len(xpathAttrib) > 1:
-            logger.warning("There are multiple matching attributes (returning 1st)! '%s'", xpathAttrib)
-            return xpathAttrib[0]
-        else:
-            return ""
+    def processSegments(self, segments):
+        """ Process (isEntry, bytes) segments as produced by _iter_bundle_segments """
+        for isEntry, chunk in segments:
+            if isEntry and _entry_resource_type(chunk) in self.entryResourceTypes:
+                entry = lxml.etree.fromstring(chunk, self.parser)
+                self._prepareEntry(entry)
+                self._processEntry(lxml.etree.ElementTree(entry))
+            else:
+                self.target.send(('raw', chunk))
+
+    def _writeCurrentElement(self, entryTree):
+        """ Write the sub-element as bytes, in place of the original entry """
+        self.target.send(('raw', lxml.etree.tostring(entryTree.getroot(), pretty_print=False)))
+
+## Namespace of FHIR xml, the stylesheet only matches elements in it
+FHIR_NAMESPACE:str = "http://hl7.org/fhir"
+## Namespace of the stylesheet's extension functions (xmlns:f="CustomXSLTfns")
+XSLT_FUNCTIONS_NAMESPACE:str = "CustomXSLTfns"
+
+class FhirXsltStream(FhirPassthroughStream):
+    """ XSLT engine: the bundle is split like the passthrough engine, but the Patient and Encounter entries are
+    rewritten by libxslt with the stylesheet (settings.pseudonymization_stylesheet), about xslt_batch_size bytes
+    of entries at a time. The stylesheet's f:_hash_ids calls come back to _xsltHashIds for the lookup, hash and
+    mapping row, so the pseudonyms, mapping and output match the passthrough engine.
+    NOTE: Another stylesheet has to keep to the 1st identifier/value of each Patient and Encounter, as the shipped one does
+    """
+    _namespaces = {'f': FHIR_NAMESPACE}
+    ## Only needed for the statistics, on the (still namespaced) entries
+    _xsltPatientId = lxml.etree.XPath("f:resource/f:Patient/f:id/@value", namespaces = _namespaces)
+    _xsltPatientNames = lxml.etree.XPath("f:resource/f:Patient/f:name", namespaces = _namespaces)
+    _xsltEncounterId = lxml.etree.XPath("f:resource/f:Encounter/f:id/@value", namespaces = _namespaces)
+    _xsltEncounterSubject = lxml.etree.XPath("f:resource/f:Encounter/f:subject/f:reference/@value", namespaces = _namespaces)
+    _xsltEncounterIdentifiers = lxml.etree.XPath("f:resource/f:Encounter/f:identifier/f:value", namespaces = _namespaces)
+    def __init__(self, target, mapping_output: None|csv.DictWriter = None, statistics: None|BundleStatistics = None, stylesheet: None|str = None, batch_size: None|int = None):
+        """ Compile the stylesheet with _xsltHashIds as its f:_hash_ids """
+        EntryPseudonymizer.__init__(self, target, mapping_output, statistics)
+        self.transform = lxml.etree.XSLT(lxml.etree.parse(stylesheet or settings.pseudonymization_stylesheet),
+            extensions = {(XSLT_FUNCTIONS_NAMESPACE, '_hash_ids'): self._xsltHashIds})
+        self.batchSize:int = settings.xslt_batch_size if batch_size is None else batch_size
+        ## <Bundle> start tag (each batch is parsed inside it, for its namespaces) and its namespace declarations as serialized
+        self.bundleTag:None|bytes = None
+        self.declarations:list[bytes] = []
+
+    def processSegments(self, segments):
+        """ Process (isEntry, bytes) segments as produced by _iter_bundle_segments, transforming the relevant entries in batches """
+        pending:list[tuple[None|str, bytes]] = [] ## (resource type if transformed, chunk) in order
+        size:int = 0
+        for isEntry, chunk in segments:
+            resourceType = _entry_resource_type(chunk) if isEntry else None
+            if resourceType not in self.entryResourceTypes:
+                if self.bundleTag is None and not isEntry and (match := _bundle_tag_pattern.search(chunk)) is not None:
+                    self._setBundleTag(match.group(0))
+                if not pending:
+                    self.target.send(('raw', chunk))
+                    continue
+                resourceType = None
+            pending.append((resourceType, chunk))
+            size += len(chunk)
+            if size >= self.batchSize:
+                self._flush(pending)
+                pending, size = [], 0
+        self._flush(pending)
+
+    def _setBundleTag(self, tag:bytes):
+        """ Remember the <Bundle> start tag, checking the stylesheet can match its entries """
+        bundle = lxml.etree.fromstring(tag + b"</Bundle>")
+        if bundle.nsmap.get(None) != FHIR_NAMESPACE:
+            raise ValueError(f"The 'xslt' engine needs a Bundle in the FHIR namespace (xmlns=\"{FHIR_NAMESPACE}\"), the stylesheet doesn't match anything else")
+        self.bundleTag = tag
+        self.declarations = [f' xmlns{"" if prefix is None else ":" + prefix}="{uri}"'.encode('UTF-8') for prefix, uri in bundle.nsmap.items()]
+
+    def _flush(self, pending:list):
+        """ Transform the pending entries in one go and write everything pending in order """
+        if not any(resourceType for resourceType, _ in pending):
+            for _, chunk in pending:
+                self.target.send(('raw', chunk))
+            return
+        if self.bundleTag is None:
+            raise ValueError("No <Bundle> start tag before the first entry")
+        batch = lxml.etree.fromstring(self.bundleTag + b"".join(chunk for resourceType, chunk in pending if resourceType) + b"</Bundle>", self.parser)
+        if self.statistics is not None:
+            for entry, resourceType in zip(batch, (resourceType for resourceType, _ in pending if resourceType)):
+                self._entryStatistics(entry, resourceType)
+        rewritten = iter(self.transform(batch).getroot())
+        for resourceType, chunk in pending:
+            self.target.send(('raw', self._serialize(next(rewritten)) if resourceType else chunk))
+
+    def _serialize(self, entry) -> bytes:
+        """ The entry as bytes, without the namespace declarations it repeats from <Bundle> (as the passthrough engine writes it) """
+        chunk = lxml.etree.tostring(entry, pretty_print=False)
+        end = chunk.index(b">")
+        startTag = chunk[:end]
+        for declaration in self.declarations:
+            startTag = startTag.replace(declaration, b"", 1)
+        return startTag + chunk[end:]
+
+    def _entryStatistics(self, entry, resourceType:str):
+        """ Tell the statistics about a Patient or Encounter entry (before it is transformed) """
+        if resourceType == "Patient":
+            self.statistics.patient(self._validAttrib(self._xsltPatientId(entry)) or None, len(self._xsltPatientNames(entry)))
+        elif resourceType == "Encounter":
+            reference = self._xsltEncounterSubject(entry)
+            self.statistics.encounter(self._validAttrib(self._xsltEncounterId(entry)) or None, reference[0] if reference else None, len(self._xsltEncounterIdentifiers(entry)))
+
+    def _xsltHashIds(self, context, given_names:str, surname:str, birthdate:str) -> str:
+        """ f:_hash_ids of the stylesheet, called for the 1st identifier/value of each Patient (the context node):
+        the patient's pseudonym (from the source ids, looked up or hashed) and its mapping row
+        """
+        pseudonym = None
+        if hasattr(self.mapping_output, 'lookupSourceId'):
+            ## Pseudonymized from the source tables already (and mapped there)
+            pseudonym = self.mapping_output.lookupSourceId(context.context_node.get('value') or "")
+        if pseudonym is None:
+            if hasattr(self.mapping_output, 'lookup'):
+                pseudonym = self.mapping_output.lookup(given_names, surname, birthdate)
+            if pseudonym is None:
+                pseudonym = _hash_ids(given_names, surname, birthdate)
+            self.mapping_output.writerow({
+                "given-names": given_names,
+                "surname": surname,
+                "birthdate": birthdate,
+                "pseudonym": pseudonym,
+            })
+        return pseudonym
+
+## Opening or closing <entry> tag (the lookahead stops us matching a tag cut off at the end of a block)
+_entry_tag_pattern = re.compile(rb'<entry(?=[\s/>])|</entry\s*>')
+## First element inside <resource>, skipping comments
+_resource_type_pattern = re.compile(rb'<resource[^>]*>\s*(?:<!--.*?-->\s*)*<([A-Za-z]+)', re.DOTALL)
+## Start tag of the Bundle (in the segment before the first entry)
+_bundle_tag_pattern = re.compile(rb'<Bundle\b[^>]*>')
+## Resource type and the id (always its first child in FHIR xml)
+_resource_id_pattern = re.compile(rb'<resource[^>]*>\s*(?:<!--.*?-->\s*)*<([A-Za-z]+)[^>]*>\s*(?:<!--.*?-->\s*)*<id\s+value=["\']([^"\']*)', re.DOTALL)
+
+def _iter_bundle_segments(in_f, block_size:int = 1 << 20):
+    """ Split the raw bundle bytes at top level <entry> boundaries, without parsing
+    Yields (isEntry, bytes) tuples which, concatenated, reproduce the input exactly
+    NOTE: Assumes entries are not namespace prefixed and that '<entry' does not appear in comments/CDATA
+    """
+    buffer = bytearray()
+    depth:int = 0
+    start:int = 0 ## Start of the segment not yet yielded
+    scan:int = 0 ## Where to continue searching for entry tags
+    while True:
+        block = in_f.read(block_size)
+        buffer += block
+        for match in _entry_tag_pattern.finditer(buffer, scan):
+            if buffer[match.start() + 1] != ord('/'):
+                if block and len(buffer) < match.end() + 2:
+                    ## Can't tell yet if this is an empty <entry/>, wait for the next block
+                    break
+                scan = match.end()
+                if depth == 0:
+                    if match.start() > start:
+                        yield False, bytes(buffer[start:match.start()])
+                    start = match.start()
+                if buffer[match.end():match.end() + 2] == b'/>':
+                    ## Empty <entry/>
+                    scan = match.end() + 2
+                    if depth == 0:
+                        yield True, bytes(buffer[start:scan])
+                        start = scan
+                    continue
+                depth += 1
+            else:
+                scan = match.end()
+                depth -= 1
+                if depth == 0:
+                    yield True, bytes(buffer[start:match.end()])
+                    start = match.end()
+        if not block:
+            if depth != 0:
+                logger.error("Bundle ended inside an <entry>, copying the remainder unchanged")
+            if len(buffer) > start:
+                yield False, bytes(buffer[start:])
+            return
+        ## A tag can be split over two blocks, re-check from the last tag opening on the next pass
+        scan = max(scan, buffer.rfind(b'<', scan))
+        del buffer[:start]
+        scan -= start
+        start = 0
+
+## Patient id (as written), and the value of its first identifier (the pseudonym, once pseudonymized)
+_patient_id_pattern = re.compile(rb'(<Patient\b[^>]*>\s*(?:<!--.*?-->\s*)*<id\s+value=["\'])([^"\']*)', re.DOTALL)
+## Value of the Patient's first identifier, never looking past its </identifier> or the </Patient>
+_patient_identifier_pattern = re.compile(rb'<Patient\b(?:(?!</Patient>).)*?<identifier\b[^>]*(?<!/)>(?:(?!</identifier>|</Patient>).)*?<value\s+value=["\']([^"\']*)', re.DOTALL)
+## Patient id of a reference (also absolute, eg 'http://server/fhir/Patient/123', or versioned)
+_patient_reference_pattern = re.compile(rb'(<reference\s+value=["\'][^"\']*?\bPatient/)([^"\'/]*)')
+
+def _entry_key(chunk:bytes) -> None|tuple[str, str]:
+    """ (resource type, id) of a serialized <entry>, without parsing it """
+    match = _resource_id_pattern.search(chunk)
+    if match is None:
+        return None
+    return match.group(1).decode('ascii'), match.group(2).decode('UTF-8')
+
+def _entry_resource_type(chunk:bytes) -> None|str:
+    """ Resource type of a raw <entry>, without parsing it """
+    match = _resource_type_pattern.search(chunk)
+    if match is None:
+        return None
+    return match.group(1).decode('ascii')
+
+class _MappingRows(list):
+    """ Stand-in for the mapping csv.DictWriter which keeps the rows, eg to return them from a worker process """
+    def __init__(self, store: None|PseudonymStore = None, source_pseudonyms: None|dict = None):
+        super().__init__()
+        if store is not None:
+            self.lookup = store.lookup
+        if source_pseudonyms is not None:
+            self.lookupSourceId = source_pseudonyms.get
+
+    def writerow(self, row:dict):
+        self.append(row)
+
+class _SourcePseudonymMapping():
+    """ Mapping output which also knows the pseudonyms of source patient ids (see settings.source_pseudonyms_filename) """
+    def __init__(self, writer, source_pseudonyms:dict):
+        self.writer = writer
+        self.lookupSourceId = source_pseudonyms.get
+        if hasattr(writer, 'lookup'):
+            self.lookup = writer.lookup
+    def writerow(self, row:dict):
+        return self.writer.writerow(row)
+
+## Read-only pseudonym store (and source pseudonyms) of a worker process
+_worker_store: None|PseudonymStore = None
+_worker_source_pseudonyms: None|dict = None
+
+def _collect_xml_target(chunks:list):
+    """ Collects each 'raw' chunk of xml as its received. """
+    while True:
+        action = yield
+        if action is not None:
+            chunks.append(action[1])
+
+def _init_shard_worker(salt:str, store_path:str, source_pseudonyms_path:str = ""):
+    """ Worker processes may not inherit the (runtime) settings, so pass on the salt (and store to look up known patients) """
+    global _worker_store, _worker_source_pseudonyms
+    settings.secret_key = salt
+    if store_path and os.path.isfile(store_path):
+        _worker_store = PseudonymStore(store_path, salt, readonly=True)
+    if source_pseudonyms_path:
+        _worker_source_pseudonyms = read_source_pseudonyms(source_pseudonyms_path, settings.user_mapping_separator)
+
+def _pseudonymize_entries(entries:list[bytes], statistics:bool = False, engine:str = 'passthrough', bundle_tag:None|bytes = None) -> tuple[list[bytes], list[dict], None|list]:
+    """ Worker process task: pseudonymize raw entries with the engine (one of PARALLEL_ENGINES), returning the new entries,
+    mapping rows and (if wanted) statistics events in the same order. bundle_tag: the <Bundle> start tag (for 'xslt')
+    """
+    chunks:list = []
+    target = _collect_xml_target(chunks)
+    next(target)  # Prime the generator
+    rows = _MappingRows(_worker_store, _worker_source_pseudonyms)
+    events = StatisticsEvents() if statistics else None
+    ## NOTE: Each shard starts with fresh state, ids are not carried over from entries processed elsewhere
+    if engine == 'xslt':
+        stream = FhirXsltStream(target = target, mapping_output = rows, statistics = events)
+        if bundle_tag is not None:
+            stream._setBundleTag(bundle_tag)
+    else:
+        stream = FhirPassthroughStream(target = target, mapping_output = rows, statistics = events)
+    stream.processSegments((True, entry) for entry in entries)
+    return chunks, list(rows), None if events is None else list(events)
+
+def _bundle_attributes(bundle) -> dict:
+    """ Attributes of the <Bundle> element as the (non-namespace aware) SAX parser reports them """
+    attrs:dict = {}
+    for prefix, uri in bundle.nsmap.items():
+        attrs['xmlns' if prefix is None else f'xmlns:{prefix}'] = uri
+    prefixes = {uri: prefix for prefix, uri in bundle.nsmap.items() if prefix is not None}
+    prefixes["http://www.w3.org/XML/1998/namespace"] = "xml"
+    for key, value in bundle.attrib.items():
+        qname = lxml.etree.QName(key)
+        if qname.namespace in prefixes:
+            key = f'{prefixes[qname.namespace]}:{qname.localname}'
+        attrs[key] = value
+    return attrs
 
 def _hash_ids(given_name:str, surname:str, birthdate:str, salt:None|str = None, sep:str = "|") -> str:
     """ Hash the combination of:
@@ -173,21 +608,477 @@ def _hash_ids(given_name:str, surname:str, birthdate:str, salt:None|str = None,
             ).encode('UTF-8')
         ).hexdigest()
 
+def _hash_ids_batch(demographics, salt:None|str = None, sep:str = "|") -> list[str]:
+    """ _hash_ids of many (given_name, surname, birthdate) tuples, formatting the salt only once """
+    if not salt:
+        salt = settings.secret_key
+    prefix = "{salt}{sep}".format(sep=sep, salt=salt.encode('UTF-8'))
+    sha3_256 = hashlib.sha3_256
+    return [sha3_256(f"{prefix}{given_name}{sep}{surname}{sep}{birthdate}".encode('UTF-8')).hexdigest() for given_name, surname, birthdate in demographics]
+
+def _binary_xml_target(out_f, buffer_size:None|int = None):
+    """ Writes each element/chunk of xml as bytes to a binary file object, collecting them into writes of about buffer_size bytes
+    The rest is written when the target is closed, out_f is left open (and not flushed)
+    """
+    if buffer_size is None:
+        buffer_size = settings.output_buffer_size
+    pending:list[bytes] = []
+    size:int = 0
+    try:
+        while True:
+            action = yield
+            if action is not None:
+                chunk = _xml_snippet_bytes(action)
+                pending.append(chunk)
+                size += len(chunk)
+                if size >= buffer_size:
+                    out_f.write(b"".join(pending))
+                    pending.clear()
+                    size = 0
+    finally:
+        if pending:
+            out_f.write(b"".join(pending))
+
 def _print_xml_target():
-    """ Prints (so stdout) each element/chunk of xml as its received. """
-    while True:
-        action = yield
-        if action is not None:
-            print(_xml_snippet_builder(action))
+    """ Writes (so stdout) each element/chunk of xml, as bytes in large blocks """
+    try:
+        yield from _binary_xml_target(sys.stdout.buffer)
+    finally:
+        sys.stdout.buffer.flush()
 
 def _write_xml_target(out_file:str):
-    """ Writes each element/chunk of xml as its received to a specified file. """
-    with open(out_file, 'w', newline='\n') as xml_out:
+    """ Writes each element/chunk of xml to a specified file, as bytes in large blocks """
+    with open(out_file, 'wb') as xml_out:
+        yield from _binary_xml_target(xml_out)
+
+def _stream_xml_target(out_f):
+    """ Writes each element/chunk of xml to a binary file object, as bytes in large blocks """
+    yield from _binary_xml_target(out_f)
+
+def _delta_target(manifest:DeltaManifest, target, delta_target = None):
+    """ Records each written entry in the manifest before passing it on to the target.
+    Everything except unchanged entries is also sent to delta_target (if given), making a bundle of only the changes.
+    NOTE: Entries are hashed as written, so changing the engine (or salt) can change every entry
+    """
+    try:
         while True:
             action = yield
             if action is not None:
-                xml_out.write(_xml_snippet_builder(action)+"\n")
+                change = None
+                if action[0] in ('data', 'raw'):
+                    chunk = action[1]
+                    if chunk.startswith(b'<entry') and (key := _entry_key(chunk)) is not None:
+                        change = manifest.record(*key, chunk)
+                target.send(action)
+                if delta_target is not None and change != 'unchanged':
+                    delta_target.send(action)
+    finally:
+        target.close()
+        if delta_target is not None:
+            delta_target.close()
+
+class _Progress():
+    """ Counts for the progress hook, reported at most every interval seconds (and once when done) """
+    def __init__(self, callback, total_bytes:None|int = None, interval:None|float = None):
+        self.callback = callback
+        self.total_bytes = total_bytes
+        self.interval = settings.progress_interval if interval is None else interval
+        self.bytes_read:int = 0
+        self.entries:int = 0
+        self.patients:int = 0
+        self.clashes:None|ClashDetector = None
+        self.started = time.monotonic()
+        self.next_report = self.started + self.interval
+
+    def tick(self):
+        """ Report if it is time to """
+        if time.monotonic() >= self.next_report:
+            self.report()
+
+    def report(self, done:bool = False):
+        """ Call the hook with the counts so far """
+        now = time.monotonic()
+        self.next_report = now + self.interval
+        elapsed = max(now - self.started, 1e-9)
+        bytes_per_second = self.bytes_read / elapsed
+        eta = None
+        if self.total_bytes and bytes_per_second > 0:
+            eta = max(self.total_bytes - self.bytes_read, 0) / bytes_per_second
+        self.callback({
+            "bytes_read": self.bytes_read,
+            "total_bytes": self.total_bytes,
+            "entries": self.entries,
+            "patients": self.patients,
+            "elapsed": elapsed,
+            "bytes_per_second": bytes_per_second,
+            "entries_per_second": self.entries / elapsed,
+            "eta": 0.0 if done else eta,
+            "done": done,
+            "pseudonym_clashes": 0 if self.clashes is None else self.clashes.clashes,
+            "duplicate_patients": 0 if self.clashes is None else self.clashes.duplicates,
+        })
+
+class _ProgressReader():
+    """ Binary reader counting the bytes read """
+    def __init__(self, source, progress:_Progress):
+        self.source = source
+        self.progress = progress
+    def read(self, size:int = -1) -> bytes:
+        data = self.source.read(size)
+        self.progress.bytes_read += len(data)
+        return data
+    def close(self):
+        self.source.close()
+
+class _ProgressMappingWriter():
+    """ Mapping output counting the pseudonymized patients (each has a mapping row) """
+    def __init__(self, writer, progress:_Progress):
+        self.writer = writer
+        self.progress = progress
+        if hasattr(writer, 'lookup'):
+            self.lookup = writer.lookup
+        if hasattr(writer, 'lookupSourceId'):
+            self.lookupSourceId = writer.lookupSourceId
+    def writerow(self, row:dict):
+        self.progress.patients += 1
+        return self.writer.writerow(row)
+
+def _statistics_target(statistics:BundleStatistics, target):
+    """ Counts each written entry (by resource type and size) before passing it on to the target """
+    try:
+        while True:
+            action = yield
+            if action is not None:
+                if action[0] in ('data', 'raw') and action[1].startswith(b'<entry'):
+                    statistics.entry(_entry_resource_type(action[1]), len(action[1]))
+                target.send(action)
+    finally:
+        target.close()
+
+class _DeferredEntries():
+    """ Actions held back, first in first out (in memory, then a temporary file past max_mb) """
+    def __init__(self, max_mb:int):
+        self.file = tempfile.SpooledTemporaryFile(max_size=max_mb << 20)
+        self.count:int = 0
+        self.readOffset:int = 0
+        self.writeOffset:int = 0
+    def add(self, action:tuple):
+        self.file.seek(self.writeOffset)
+        self.file.write(len(action[1]).to_bytes(8, 'little') + (b'd' if action[0] == 'data' else b'r') + action[1])
+        self.writeOffset = self.file.tell()
+        self.count += 1
+    def first(self) -> tuple[str, bytes]:
+        """ The oldest held (kind, chunk) action """
+        self.file.seek(self.readOffset)
+        header = self.file.read(9)
+        return ('data' if header[8:] == b'd' else 'raw'), self.file.read(int.from_bytes(header[:8], 'little'))
+    def pop(self) -> tuple[str, bytes]:
+        """ Remove and return the oldest held action """
+        action = self.first()
+        self.readOffset = self.file.tell()
+        self.count -= 1
+        if not self.count:
+            self.file.seek(0)
+            self.file.truncate()
+            self.readOffset = self.writeOffset = 0
+        return action
+    def close(self):
+        self.file.close()
+
+def _rewrite_patient_references(chunk:bytes, index:PatientIndex, expected:None|PatientIndex = None) -> tuple[bytes, int, int]:
+    """ The entry with each 'Patient/<id>' reference pointing to the pseudonym instead, the number of references to
+    Patients not in the index (yet), which are left as they were, and how many of those may still be added to it:
+    the ones in expected (the Patients of the whole bundle), all of them if that isn't known
+    """
+    unknown:int = 0
+    waiting:int = 0
+    if b'Patient/' not in chunk:
+        return chunk, 0, 0
+    def replace(match):
+        nonlocal unknown, waiting
+        pseudonym = index.get(match.group(2))
+        if pseudonym is None:
+            unknown += 1
+            waiting += expected is None or expected.get(match.group(2)) is not None
+            return match.group(0)
+        return match.group(1) + pseudonym
+    return _patient_reference_pattern.sub(replace, chunk), unknown, waiting
+
+def _scan_patient_ids(in_f) -> None|PatientIndex:
+    """ The original ids of every Patient in the bundle (as index keys), reading it once without parsing
+    None if the input can't be read twice (eg a pipe, or a reader without seekable()), in_f is left where it was
+    """
+    if not getattr(in_f, 'seekable', lambda: False)():
+        return None
+    position = in_f.tell()
+    expected = PatientIndex()
+    for isEntry, chunk in _iter_bundle_segments(in_f):
+        if isEntry and _entry_resource_type(chunk) == 'Patient' and (id_match := _patient_id_pattern.search(chunk)) is not None:
+            expected.add(id_match.group(2), b"")
+    in_f.seek(position)
+    logger.info("Found %s Patients to rewrite references to", expected.count)
+    return expected
+
+def _reference_target(index:PatientIndex, target, defer_mb:None|int = None, expected:None|PatientIndex = None):
+    """ Rewrites the original Patient ids (see settings.rewrite_patient_references) before passing each entry on to the target
+    Patient entries add their id -> pseudonym to the index. An entry referring to a Patient which may still come
+    (in expected, the Patients of the whole bundle, or any if that isn't known) is held, along with everything after
+    it, until that Patient was seen, so the order never changes. References to other Patients are left as they were
+    """
+    deferred = _DeferredEntries(settings.reference_defer_memory_mb if defer_mb is None else defer_mb)
+    unresolved:int = 0
+    def send(kind:str, chunk:bytes, final:bool = False) -> bool:
+        """ Rewrite and write the chunk, unless it waits for a Patient (and it isn't the end), returns whether it was written """
+        nonlocal unresolved
+        if not chunk.startswith(b'<entry'):
+            target.send((kind, chunk))
+            return True
+        rewritten, unknown, waiting = _rewrite_patient_references(chunk, index, expected)
+        if waiting and not final:
+            return False
+        unresolved += unknown > 0
+        target.send((kind, rewritten))
+        return True
+    def drain(final:bool = False):
+        """ Write the held actions which no longer wait for a Patient (all of them at the end) """
+        if final and deferred.count:
+            logger.info("Writing the %s chunks held back for Patients which never came", deferred.count)
+        while deferred.count and send(*deferred.first(), final):
+            deferred.pop()
+    try:
+        while True:
+            action = yield
+            if action is None:
+                continue
+            if action[0] in ('data', 'raw') and action[1].startswith(b'<entry'):
+                chunk = action[1]
+                isPatient = _entry_resource_type(chunk) == 'Patient'
+                if isPatient:
+                    id_match = _patient_id_pattern.search(chunk)
+                    pseudonym_match = _patient_identifier_pattern.search(chunk)
+                    if id_match is not None and pseudonym_match is not None:
+                        index.add(id_match.group(2), pseudonym_match.group(1))
+                        chunk = chunk[:id_match.start(2)] + pseudonym_match.group(1) + chunk[id_match.end(2):]
+                if deferred.count:
+                    deferred.add((action[0], chunk))
+                    if isPatient:
+                        drain()
+                elif not send(action[0], chunk):
+                    deferred.add((action[0], chunk))
+            elif action == ('end', 'Bundle'):
+                drain(final=True)
+                target.send(action)
+            elif deferred.count and action[0] == 'raw' and (end := action[1].find(b'</Bundle')) >= 0:
+                ## The passthrough engines copy the closing tag as part of the bytes after the last entry
+                deferred.add(('raw', action[1][:end]))
+                drain(final=True)
+                target.send(('raw', action[1][end:]))
+            elif deferred.count and action[0] in ('data', 'raw'):
+                deferred.add(action)
+            else:
+                drain(final=True)
+                target.send(action)
+    except GeneratorExit:
+        ## Bundle end not seen (eg truncated input), don't lose the held entries
+        drain(final=True)
+        raise
+    finally:
+        if unresolved:
+            logger.warning("%s entries refer to Patients which are not in the bundle, those references were left unchanged", unresolved)
+        deferred.close()
+        index.close()
+        if expected is not None:
+            expected.close()
+        target.close()
+
+class _ClashCheckingWriter():
+    """ Mapping output checking each patient for a clash or duplicate (see clash_detection.py), also counted in the statistics """
+    def __init__(self, writer, detector:ClashDetector, statistics:None|BundleStatistics = None):
+        self.writer = writer
+        self.detector = detector
+        self.statistics = statistics
+        if hasattr(writer, 'lookup'):
+            self.lookup = writer.lookup
+        if hasattr(writer, 'lookupSourceId'):
+            self.lookupSourceId = writer.lookupSourceId
+    def writerow(self, row:dict):
+        kind = self.detector.check(row["given-names"], row["surname"], row["birthdate"], row["pseudonym"])
+        if kind is not None and self.statistics is not None:
+            self.statistics.issue("pseudonym_clashes" if kind == "clash" else "duplicate_patients", row["pseudonym"])
+        return self.writer.writerow(row)
+
+def _progress_target(progress:_Progress, target):
+    """ Counts each written entry before passing it on to the target, reporting progress now and then """
+    try:
+        while True:
+            action = yield
+            if action is not None:
+                if action[0] in ('data', 'raw') and action[1].startswith(b'<entry'):
+                    progress.entries += 1
+                target.send(action)
+                progress.tick()
+    finally:
+        target.close()
+
+def _input_size(in_f) -> None|int:
+    """ Size of the input if it is a regular file (eg not a pipe), for the ETA """
+    try:
+        info = os.fstat(in_f.fileno())
+    except (AttributeError, OSError, ValueError):
+        return None
+    return info.st_size if stat.S_ISREG(info.st_mode) else None
+
+def describe_progress(counts:dict) -> str:
+    """ One line summary of the progress hook's counts, eg for a status bar or stderr """
+    done = f"{counts['bytes_read'] / 1e6:,.1f} MB"
+    if counts['total_bytes']:
+        done += f" of {counts['total_bytes'] / 1e6:,.1f} MB ({100 * counts['bytes_read'] / counts['total_bytes']:.0f}%)"
+    text = f"{done}, {counts['entries']:,} entries, {counts['patients']:,} patients, {counts['bytes_per_second'] / 1e6:,.1f} MB/s ({counts['entries_per_second']:,.0f} entries/s)"
+    if counts.get('pseudonym_clashes'):
+        text += f", {counts['pseudonym_clashes']:,} PSEUDONYM CLASHES"
+    if counts.get('duplicate_patients'):
+        text += f", {counts['duplicate_patients']:,} duplicate patients"
+    if counts['done']:
+        text += f", finished in {counts['elapsed']:,.0f}s"
+    elif counts['eta'] is not None:
+        text += f", ETA {counts['eta']:,.0f}s"
+    return text
+
+def _print_progress(counts:dict):
+    """ Progress on stderr (overwriting the line on a terminal) """
+    if sys.stderr.isatty():
+        sys.stderr.write(f"\r{describe_progress(counts)}\033[K" + ("\n" if counts['done'] else ""))
+    else:
+        sys.stderr.write(describe_progress(counts) + "\n")
+    sys.stderr.flush()
+
+class MemoryCeilingExceeded(MemoryError):
+    """ The run used more memory than settings.memory_ceiling_mb, it was stopped before the system had to kill it """
+
+def _current_rss() -> None|int:
+    """ Resident memory of this process in bytes, the peak where the current value isn't available (None if neither is) """
+    try:
+        with open('/proc/self/statm', 'rb') as statm_f:
+            return int(statm_f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, AttributeError):
+        pass
+    try:
+        import resource
+    except ImportError:
+        return None
+    ## kB on linux, bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+class _MemoryMonitor():
+    """ Tracks the largest entry and samples the memory used (RSS, and the python heap if tracing) every interval seconds
+    Raises MemoryCeilingExceeded when the RSS (or the heap, if the RSS is unknown) goes over ceiling_mb (0 = no limit)
+    NOTE: Only this process is measured, not the worker processes of the parallel engine
+    """
+    def __init__(self, ceiling_mb:int = 0, trace:bool = False, interval:None|float = None):
+        self.ceiling = ceiling_mb * (1 << 20)
+        self.interval = settings.memory_sample_interval if interval is None else interval
+        self.entries:int = 0
+        self.largest_entry_bytes:int = 0
+        self.largest_entry_elements:int = 0
+        self.rss:None|int = None
+        self.rss_peak:None|int = None
+        self.heap:None|int = None
+        self.heap_peak:None|int = None
+        self.warned:bool = False
+        ## Don't stop someone else's tracing when we're done
+        self.tracing = trace and not tracemalloc.is_tracing()
+        if self.tracing:
+            tracemalloc.start()
+        self.next_sample = time.monotonic()
+
+    def entry(self, chunk:bytes):
+        """ Count a written entry, remembering the largest """
+        self.entries += 1
+        if len(chunk) > self.largest_entry_bytes:
+            self.largest_entry_bytes = len(chunk)
+            ## Every element has one '<' more than closing tags (text is escaped), so this is what a parser held for it
+            self.largest_entry_elements = chunk.count(b'<') - chunk.count(b'</')
+        self.tick()
+
+    def tick(self):
+        """ Sample if it is time to """
+        if time.monotonic() >= self.next_sample:
+            self.sample()
 
+    def sample(self):
+        """ Measure the memory now and check it against the ceiling """
+        self.next_sample = time.monotonic() + self.interval
+        self.rss = _current_rss()
+        if self.rss is not None:
+            self.rss_peak = max(self.rss_peak or 0, self.rss)
+        if tracemalloc.is_tracing():
+            self.heap, self.heap_peak = tracemalloc.get_traced_memory()
+        if not self.ceiling:
+            return
+        used = self.rss if self.rss is not None else self.heap
+        if used is None:
+            if not self.warned:
+                logger.warning("Can't measure the memory used on this system, memory_ceiling_mb is ignored (set memory_instrumentation=true to check the python heap instead)")
+                self.warned = True
+        elif used > self.ceiling:
+            raise MemoryCeilingExceeded(f"Stopped at {used / (1 << 20):,.0f} MB, over the memory ceiling of {self.ceiling / (1 << 20):,.0f} MB ({describe_memory(self.report())}). "
+                "Try pseudonymization_engine=passthrough (only Patient and Encounter entries are parsed), fewer pseudonymization_workers or a smaller pseudonymization_shard_size")
+        elif used > 0.8 * self.ceiling and not self.warned:
+            logger.warning("Memory use (%.0f MB) is close to the ceiling of %.0f MB", used / (1 << 20), self.ceiling / (1 << 20))
+            self.warned = True
+
+    def report(self) -> dict:
+        """ The measurements so far (in MB, None if not measured) """
+        mb = lambda value: None if value is None else value / (1 << 20)
+        return {
+            "entries": self.entries,
+            "largest_entry_bytes": self.largest_entry_bytes,
+            "largest_entry_elements": self.largest_entry_elements,
+            "rss_mb": mb(self.rss),
+            "rss_peak_mb": mb(self.rss_peak),
+            "heap_mb": mb(self.heap),
+            "heap_peak_mb": mb(self.heap_peak),
+            "ceiling_mb": mb(self.ceiling) or None,
+        }
+
+    def stop(self):
+        """ Stop tracing (if we started it) """
+        if self.tracing:
+            tracemalloc.stop()
+            self.tracing = False
+
+class _MemoryReader():
+    """ Binary reader sampling the memory as the input is read, so it is also checked while one large entry is built """
+    def __init__(self, source, monitor:_MemoryMonitor):
+        self.source = source
+        self.monitor = monitor
+    def read(self, size:int = -1) -> bytes:
+        self.monitor.tick()
+        return self.source.read(size)
+    def close(self):
+        self.source.close()
+
+def _memory_target(monitor:_MemoryMonitor, target):
+    """ Measures each written entry before passing it on to the target """
+    try:
+        while True:
+            action = yield
+            if action is not None:
+                if action[0] in ('data', 'raw') and action[1].startswith(b'<entry'):
+                    monitor.entry(action[1])
+                target.send(action)
+    finally:
+        target.close()
+
+def describe_memory(counts:dict) -> str:
+    """ One line summary of the memory report """
+    text = f"largest entry {counts['largest_entry_bytes'] / 1e3:,.1f} kB ({counts['largest_entry_elements']:,} elements) of {counts['entries']:,}"
+    if counts['rss_peak_mb'] is not None:
+        text += f", peak RSS {counts['rss_peak_mb']:,.0f} MB"
+    if counts['heap_peak_mb'] is not None:
+        text += f", python heap {counts['heap_mb']:,.1f} MB (peak {counts['heap_peak_mb']:,.1f} MB)"
+    return text
 
 def _xml_snippet_builder(action: tuple) -> str:
     """ Convert tuple into XML string. """
@@ -201,39 +1092,294 @@ def _xml_snippet_builder(action: tuple) -> str:
         xml_snippet = f'<{action[1][0]} {attr_text}>'
     elif action[0] == 'end':
         xml_snippet = f'</{action[1]}>'
-    elif action[0] == 'data':
-        xml_snippet = action[1]
 
     return xml_snippet
 
-def process_fhir_bundle(in_file:str, out_file:str, salt:None|str = None):
-    """ If not calling as script, use this function. """
-    logger.info("Starting fhir pseudonymization...")
+def _xml_snippet_bytes(action: tuple) -> bytes:
+    """ Convert tuple into XML bytes, as they are written ('raw' chunks unchanged, everything else on its own line). """
+    if action[0] == 'raw':
+        return action[1]
+    if action[0] == 'data':
+        return action[1] + b"\n"
+    return (_xml_snippet_builder(action) + "\n").encode('UTF-8')
+
+def _run_sax_engine(in_f, target, mapping_writer, statistics = None):
+    """ Original engine: python receives every SAX event and rebuilds each entry with lxml """
+    ## Set up the sax parser
+    sp = xml.sax.make_parser()
+    sp.setContentHandler(FhirStream(target = target, mapping_output = mapping_writer, statistics = statistics))
+    sp.setFeature(xml.sax.handler.feature_namespaces, 0)
+
+    ## sax parses by emitting events when a tag or data is found, so the response to the events is all handled in the ContentHandler class above
+    ## (In particulare, we use the target to control how we use the output)
+    sp.parse(in_f)
+
+def _run_iterparse_engine(in_f, target, mapping_writer, statistics = None):
+    """ lxml iterparse engine: same output as the SAX engine (but for whitespace within text, see FhirIterStream), libxml2 builds the entries """
+    FhirIterStream(target = target, mapping_output = mapping_writer, statistics = statistics).parse(in_f)
+
+def _run_passthrough_engine(in_f, target, mapping_writer, statistics = None):
+    """ Byte level engine: entries other than entryResourceTypes are copied unchanged """
+    FhirPassthroughStream(target = target, mapping_output = mapping_writer, statistics = statistics).parse(in_f)
+
+def _run_xslt_engine(in_f, target, mapping_writer, statistics = None):
+    """ XSLT engine: split like the passthrough engine, libxslt rewrites the Patient and Encounter entries with the stylesheet """
+    FhirXsltStream(target = target, mapping_output = mapping_writer, statistics = statistics).parse(in_f)
+
+def _run_parallel_engine(in_f, target, mapping_writer, workers:int, statistics = None, engine:str = 'passthrough'):
+    """ Split the bundle like the passthrough engine and pseudonymize shards of entries in worker processes with the engine
+    (one of PARALLEL_ENGINES). Untouched segments stay in this process, results are merged back in the original order
+    """
+    def write_shard(segments:list, future):
+        """ Fill the shard's placeholders with the worker's entries and write it all out """
+        entries, rows, events = future.result()
+        entries = iter(entries)
+        for chunk in segments:
+            target.send(('raw', next(entries) if chunk is None else chunk))
+        for row in rows:
+            mapping_writer.writerow(row)
+        if events:
+            statistics.replay(events)
+
+    entryResourceTypes = FhirPassthroughStream.entryResourceTypes
+    pending:deque = deque()
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_shard_worker, initargs=(settings.secret_key, settings.user_mapping_store, settings.source_pseudonyms_filename)) as executor:
+        segments:list = [] ## Output in order, None where a pseudonymized entry goes
+        entries:list = []
+        size:int = 0
+        bundleTag:None|bytes = None
+        for isEntry, chunk in _iter_bundle_segments(in_f):
+            if bundleTag is None and not isEntry and (match := _bundle_tag_pattern.search(chunk)) is not None:
+                bundleTag = match.group(0)
+                if engine == 'xslt':
+                    ## Fail here (before any worker starts) if the stylesheet can't apply
+                    FhirXsltStream(target = None)._setBundleTag(bundleTag)
+            if isEntry and _entry_resource_type(chunk) in entryResourceTypes:
+                segments.append(None)
+                entries.append(chunk)
+            else:
+                segments.append(chunk)
+            size += len(chunk)
+            if size >= settings.pseudonymization_shard_size:
+                pending.append((segments, executor.submit(_pseudonymize_entries, entries, statistics is not None, engine, bundleTag)))
+                segments, entries, size = [], [], 0
+                ## Bound what is held in memory, write out the oldest shard first
+                while len(pending) > 2 * workers:
+                    write_shard(*pending.popleft())
+        pending.append((segments, executor.submit(_pseudonymize_entries, entries, statistics is not None, engine, bundleTag)))
+        while pending:
+            write_shard(*pending.popleft())
+
+## Engine name -> runner, each reads a binary input stream
+ENGINES:dict = {
+    'sax': _run_sax_engine,
+    'iterparse': _run_iterparse_engine,
+    'passthrough': _run_passthrough_engine,
+    'xslt': _run_xslt_engine,
+}
+## Engines whose output the parallel runner reproduces (it splits the bundle like them)
+PARALLEL_ENGINES:list[str] = ['passthrough', 'xslt']
+
+@contextlib.contextmanager
+def _mapping_output(salt:None|str = None):
+    """ Where the mapping of demographics to pseudonyms goes: the TSV file, via the persistent store if configured
+    With a store, the TSV only grows by new patients if it is the one the store last completed for this salt,
+    otherwise (missing, changed or written under another salt) it is rewritten with every patient the store knows first
+    """
+    store = None
+    append = False
+    if settings.user_mapping_store:
+        store = PseudonymStore(settings.user_mapping_store, salt or settings.secret_key)
+        append = store.tsvIsCurrent(settings.user_mapping_filename)
+    try:
+        with open(settings.user_mapping_filename, 'a' if append else 'w', newline='\n') as map_f:
+            mapping_writer = csv.DictWriter(map_f, delimiter=settings.user_mapping_separator, quotechar='"', quoting=csv.QUOTE_MINIMAL, fieldnames=TSV_HEADINGS, lineterminator='\n')
+            if not append:
+                mapping_writer.writeheader()
+            if store is None:
+                yield mapping_writer
+            else:
+                if not append and store.knowsSalt():
+                    logger.warning("'%s' is missing, was changed or was written under another key, rewriting it with every patient of the pseudonym store", settings.user_mapping_filename)
+                    for row in store.rows():
+                        mapping_writer.writerow(row)
+                store.tsv_output = mapping_writer
+                yield store
+        if store is not None:
+            ## Only a run that finished leaves a TSV which can be appended to next time
+            store.recordTsv(settings.user_mapping_filename)
+    finally:
+        if store is not None:
+            store.close()
+
+def _choose_engine(engine:str, workers:None|int = None):
+    """ Engine runner, switching to the parallel runner when more than 1 worker is wanted
+    Returns None if the engine can't run in parallel (its output would change), see PARALLEL_ENGINES
+    """
+    if workers is None:
+        workers = settings.pseudonymization_workers
+    if workers <= 0:
+        workers = os.cpu_count() or 1
+    if workers > 1:
+        if engine not in PARALLEL_ENGINES:
+            logger.error("The '%s' engine can't use %s workers, choose one of %s (or 1 worker)", engine, workers, ", ".join(PARALLEL_ENGINES))
+            return None
+        return functools.partial(_run_parallel_engine, workers=workers, engine=engine)
+    return ENGINES[engine]
+
+def _open_targets(target, manifest_path:str, delta_file:str) -> tuple:
+    """ Wrap the target to track changes against the previous run, if a manifest is configured
+    Returns the target to use and the manifest (or None)
+    """
+    if not manifest_path:
+        return target, None
+    manifest = DeltaManifest(manifest_path)
+    delta_target = None
+    if delta_file:
+        delta_target = _write_xml_target(delta_file)
+        next(delta_target)  # Prime the generator
+    target = _delta_target(manifest, target, delta_target)
+    next(target)  # Prime the generator
+    return target, manifest
+
+def _prepare_run(salt:None|str, engine:None|str, workers:None|int):
+    """ Check the salt and engine, returns the engine runner or None if we can't continue """
+    if engine is None:
+        engine = settings.pseudonymization_engine
+    if engine not in ENGINES:
+        logger.error("Unknown pseudonymization engine '%s' (available: %s)", engine, ", ".join(ENGINES))
+        return None
     ## TODO: This is hacky
     if salt:
         settings.secret_key = salt
     else:
         if not settings.secret_key:
             logger.error("No secret key set! Cannot continue.")
-            return False
+            return None
+    return _choose_engine(engine, workers)
+
+def _run(run_engine, in_f, target, manifest:None|str, delta_file:None|str, progress = None, memory_report = None, statistics:None|str = None, rewrite_references:None|bool = None):
+    """ Run the engine with the mapping output and (if configured) change tracking, reference rewriting, statistics, progress reports and memory checks """
+    delta = None
+    ## The Patient indexes, freed even if the run fails before the reference target started
+    indexes:list[PatientIndex] = []
+    monitor = None
+    try:
+        target, delta = _open_targets(target,
+            settings.delta_manifest if manifest is None else manifest,
+            settings.delta_bundle_filename if delta_file is None else delta_file)
+        if settings.rewrite_patient_references if rewrite_references is None else rewrite_references:
+            indexes.append(PatientIndex())
+            expected = _scan_patient_ids(in_f)
+            if expected is not None:
+                indexes.append(expected)
+            ## Before the delta manifest, which should see (and the delta bundle get) the rewritten entries
+            target = _reference_target(indexes[0], target, expected=expected)
+            next(target)  # Prime the generator
+        statistics_report = settings.statistics_report if statistics is None else statistics
+        statistics = None
+        if statistics_report:
+            statistics = BundleStatistics()
+            target = _statistics_target(statistics, target)
+            next(target)  # Prime the generator
+        if progress is not None:
+            progress = _Progress(progress, _input_size(in_f))
+            in_f = _ProgressReader(in_f, progress)
+            target = _progress_target(progress, target)
+            next(target)  # Prime the generator
+        clashes = ClashDetector() if settings.clash_detection else None
+        if progress is not None:
+            progress.clashes = clashes
+        if settings.memory_ceiling_mb or settings.memory_instrumentation or memory_report is not None:
+            monitor = _MemoryMonitor(settings.memory_ceiling_mb, settings.memory_instrumentation)
+            in_f = _MemoryReader(in_f, monitor)
+            target = _memory_target(monitor, target)
+            next(target)  # Prime the generator
+        with _mapping_output() as mapping_writer:
+            if settings.source_pseudonyms_filename:
+                mapping_writer = _SourcePseudonymMapping(mapping_writer, read_source_pseudonyms(settings.source_pseudonyms_filename, settings.user_mapping_separator))
+            if clashes is not None:
+                mapping_writer = _ClashCheckingWriter(mapping_writer, clashes, statistics)
+            run_engine(in_f, target, mapping_writer if progress is None else _ProgressMappingWriter(mapping_writer, progress), statistics=statistics)
+        target.close()
+    except BaseException:
+        if delta is not None:
+            delta.abort()
+        raise
+    finally:
+        if monitor is not None:
+            monitor.stop()
+        ## If the run failed: each target closes the one it wraps, down to the output (and delta bundle) writer
+        target.close()
+        for index in indexes:
+            index.close()
+    if monitor is not None:
+        monitor.sample()
+        logger.info("Memory: %s", describe_memory(monitor.report()))
+        if memory_report is not None:
+            memory_report(monitor.report())
+    if clashes is not None:
+        summary = clashes.summary()
+        if summary["pseudonym_clashes"] or summary["duplicate_patients"]:
+            logger.warning("%s pseudonym clashes (eg %s), %s duplicate patients (eg %s), see pseudonym_lookup.py --pseudonym to find them",
+                summary["pseudonym_clashes"], summary["clash_examples"][:3], summary["duplicate_patients"], summary["duplicate_examples"][:3])
+        else:
+            logger.info("No pseudonym clashes or duplicate patients among %s patients", summary["patients"])
+    if statistics is not None:
+        statistics.write(statistics_report)
+    if progress is not None:
+        progress.report(done=True)
+    if delta is not None:
+        counts = delta.finish()
+        logger.info("Compared to the previous run: %s added, %s changed, %s removed", counts['added'], counts['changed'], counts['removed'])
+
+def process_fhir_bundle(in_file:str, out_file:str, salt:None|str = None, engine:None|str = None, workers:None|int = None, manifest:None|str = None, delta_file:None|str = None, progress = None, memory_report = None, statistics:None|str = None, rewrite_references:None|bool = None):
+    """ If not calling as script, use this function.
+    engine: one of ENGINES (default from settings.pseudonymization_engine), all produce the same pseudonyms
+        and mapping. 'sax' and 'iterparse' write the same XML, except that 'sax' drops line breaks (and other
+        whitespace-only pieces) within text, see FhirIterStream. 'passthrough' keeps untouched entries as they were,
+        'xslt' too but rewrites the others with settings.pseudonymization_stylesheet (which needs the FHIR namespace)
+    workers: number of processes (default from settings.pseudonymization_workers, 0 = all cores). More than 1
+        needs one of PARALLEL_ENGINES ('passthrough' or 'xslt'), the bundle is then split and merged like those engines
+    manifest: path of a delta manifest (default settings.delta_manifest) to compare the entries with the previous
+        run; added/changed/removed entries are logged and can be listed with delta_manifest.py
+    delta_file: (with manifest) also write a bundle with only the added and changed entries
+    progress: called with a dict of counts (bytes_read, total_bytes, entries, patients, elapsed, bytes_per_second,
+        entries_per_second, eta, done) every settings.progress_interval seconds and once when done, see describe_progress
+    memory_report: called once done with a dict (entries, largest_entry_bytes, largest_entry_elements, rss_mb, rss_peak_mb,
+        heap_mb, heap_peak_mb, ceiling_mb), see describe_memory. The heap is only measured with settings.memory_instrumentation
+    statistics: path of a JSON report (default settings.statistics_report, "" = none) of the entries per resource type and
+        their sizes, duplicate patient ids, encounters without their patient etc, see bundle_statistics.py
+    rewrite_references: (default settings.rewrite_patient_references) replace the original Patient ids, each Patient's
+        id and every 'Patient/<id>' reference, with the pseudonym. Entries referring to a Patient later in the bundle
+        are held back (with the ones after them, keeping the order) until that Patient is written
+    Raises MemoryCeilingExceeded if settings.memory_ceiling_mb is set and this process goes over it
+    """
+    logger.info("Starting fhir pseudonymization...")
+    run_engine = _prepare_run(salt, engine, workers)
+    if run_engine is None:
+        return False
     target = _write_xml_target(out_file)
     next(target)  # Prime the generator
 
-    with open(in_file, 'r', newline='\n') as in_f:
-        mapping_headings = ["given-names","surname","birthdate","pseudonym"]
-        with open(settings.user_mapping_filename, 'w', newline='\n') as map_f:
-            mapping_writer = csv.DictWriter(map_f, delimiter=settings.user_mapping_separator, quotechar='"', quoting=csv.QUOTE_MINIMAL, fieldnames=mapping_headings, lineterminator='\n')
-            mapping_writer.writeheader()
+    with open(in_file, 'rb') as in_f:
+        _run(run_engine, in_f, target, manifest, delta_file, progress, memory_report, statistics, rewrite_references)
 
-            ## Set up the sax parser
-            sp = xml.sax.make_parser()
-            sp.setContentHandler(FhirStream(target = target, mapping_output = mapping_writer))
-            sp.setFeature(xml.sax.handler.feature_namespaces, 0)
+    logger.info("Module call complete")
+    return True
+
+def pseudonymize_stream(in_f, out_f, salt:None|str = None, engine:None|str = None, workers:None|int = None, manifest:None|str = None, delta_file:None|str = None, progress = None, memory_report = None, statistics:None|str = None, rewrite_references:None|bool = None):
+    """ As process_fhir_bundle, but reading from and writing to binary file objects (eg pipes), out_f is left open """
+    logger.info("Starting fhir pseudonymization...")
+    run_engine = _prepare_run(salt, engine, workers)
+    if run_engine is None:
+        return False
+    target = _stream_xml_target(out_f)
+    next(target)  # Prime the generator
 
-            ## sax parses by emitting events when a tag or data is found, so the response to the events is all handled in the ContentHandler class above
-            sp.parse(in_f)
+    _run(run_engine, in_f, target, manifest, delta_file, progress, memory_report, statistics, rewrite_references)
 
-    logger.info("Module call complete")
+    logger.info("Stream pseudonymization complete")
     return True
 
 ## When called as script (not run if imported as module):
@@ -245,21 +1391,18 @@ if __name__ == "__main__":
         logger.error("This script demands piped input data from an xml fhir bundle, eg cat fhir.xml | this-script.py")
         sys.exit(1)
 
+    run_engine = _choose_engine(settings.pseudonymization_engine) if settings.pseudonymization_engine in ENGINES else None
+    if run_engine is None:
+        logger.error("Can't run the '%s' engine (available: %s)", settings.pseudonymization_engine, ", ".join(ENGINES))
+        sys.exit(1)
     target = _print_xml_target()
     next(target)  # Prime the generator
-
-    mapping_headings = ["given-names","surname","birthdate","pseudonym"]
-    with open(settings.user_mapping_filename, 'w', newline='\n') as f:
-        mapping_writer = csv.DictWriter(f, delimiter=settings.user_mapping_separator, quotechar='"', quoting=csv.QUOTE_MINIMAL, fieldnames=mapping_headings, lineterminator='\n')
-        mapping_writer.writeheader()
-
-        ## Set up the sax parser
-        sp = xml.sax.make_parser()
-        sp.setContentHandler(FhirStream(target = target, mapping_output = mapping_writer))
-        sp.setFeature(xml.sax.handler.feature_namespaces, 0)
-
-        ## sax parses by emitting events when a tag or data is found, so the response to the events is all handled in the ContentHandler class above
-        ## (In particulare, we use the target to control how we use the output)
-        sp.parse(sys.stdin)
+    try:
+        _run(run_engine, sys.stdin.buffer, target, None, None,
+            _print_progress if settings.pseudonymization_progress else None,
+            (lambda counts: sys.stderr.write(f"Memory: {describe_memory(counts)}\n")) if settings.memory_instrumentation else None)
+    except MemoryCeilingExceeded as err:
+        logger.error("%s", err)
+        sys.exit(1)
 
     logger.info("Script run completed!")
@@ -0,0 +1,273 @@
+#!/usr/bin/env python3
+"""
+Description: Pseudonymize the patient table (csv) of a datasource before stage 1, so names never enter the fhir bundle
+stderr: for logs
+
+Usage: src/i2b2_upload_client/logic/tabular_pseudonymization.py --datasource-config datasource.xml [--check-bundle fhir-bundle-raw.xml]
+Explainer: The patient table and its identifying columns (given-name, surname, birthdate) are read from the datasource.xml.
+Rows are read in batches and hashed like stage 2 does (same salt, same pseudonyms), the name columns are emptied and
+the table is written next to the original, with a copy of the datasource.xml using it. The mapping goes to the usual
+psn-cache.tsv (and pseudonym store, if configured), and a source patient id -> pseudonym file (source_pseudonyms_filename) is written.
+Run stage 1 with the new datasource.xml, and stage 2 with source_pseudonyms_filename set: it then uses these
+pseudonyms, so the pseudonymized bundle is the same as without this step.
+"""
+
+## Import built-ins
+import csv
+import itertools
+import os
+import re
+import sys
+import urllib.parse
+import urllib.request
+
+## Import third party libraries
+import logging
+import lxml.etree
+from pydantic_settings import BaseSettings
+
+## Run directly as a file (not as part of the installed package)? Then make the package importable
+if __package__ in (None, ""):
+    sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..')))
+from i2b2_upload_client.logic import stream_pseudonymization
+from i2b2_upload_client.logic.pseudonym_store import SOURCE_TSV_HEADINGS, read_source_pseudonyms
+
+## ---------------- ##
+## Create  settings ##
+## ---------------- ##
+class Settings(BaseSettings):
+    """ The variables defined here will be taken from env vars if available and matching the type hint """
+    log_level: str = "WARNING"
+    log_format: str = "[%(asctime)s] {%(name)s/%(module)s:%(lineno)d (%(funcName)s)} %(levelname)s - %(message)s"
+    secret_key: None|str = None
+    user_mapping_separator: str = "\t"
+    source_pseudonyms_filename: str = "psn-source-ids.tsv"
+    ## Rows read, hashed and written at once
+    tabular_batch_size: int = 50000
+settings = Settings()
+
+## Load logger for this file/script
+formatter = logging.Formatter(settings.log_format)
+logging.basicConfig(format=settings.log_format)
+## Set app's logger level and format...
+logger = logging.getLogger(__name__)
+logger.setLevel(settings.log_level)
+
+## The <idat> columns we need (the names are emptied, the birthdate is kept: stage 2 keeps it too)
+IDAT_COLUMNS:list[str] = ["patient-id", "given-name", "surname", "birthdate"]
+## java DateTimeFormatter letters we can read (numeric only)
+_JAVA_DATE_FIELDS:dict = {'u': 'year', 'y': 'year', 'M': 'month', 'd': 'day', 'H': 'hour', 'm': 'minute', 's': 'second'}
+
+def java_date_pattern(pattern:str) -> re.Pattern:
+    """ Regex for a java DateTimeFormatter pattern as used in datasource.xml (eg 'd.M.u[ H[:m[:s]]]')
+    Only numeric fields, 'quoted' literals and [optional] sections are supported, anything else raises ValueError
+    """
+    regex = ""
+    index = 0
+    while index < len(pattern):
+        char = pattern[index]
+        if char == '[':
+            regex += "(?:"
+            index += 1
+        elif char == ']':
+            regex += ")?"
+            index += 1
+        elif char == "'":
+            end = pattern.find("'", index + 1)
+            if end < 0:
+                raise ValueError(f"Unterminated quote in date format '{pattern}'")
+            regex += re.escape(pattern[index + 1:end] or "'")
+            index = end + 1
+        elif char.isalpha():
+            end = index
+            while end < len(pattern) and pattern[end] == char:
+                end += 1
+            count = end - index
+            field = _JAVA_DATE_FIELDS.get(char)
+            if field is None or count > 4 or (field != 'year' and count > 2) or (field == 'year' and count == 2):
+                raise ValueError(f"Unsupported date format '{pattern}' ('{pattern[index:end]}'), only numeric day/month/year/time fields can be read")
+            if f"(?P<{field}>" in regex:
+                raise ValueError(f"Date format '{pattern}' has more than one {field}")
+            regex += f"(?P<{field}>\\d{{1,{4 if field == 'year' else 2}}})"
+            index = end
+        else:
+            regex += re.escape(char)
+            index += 1
+    return re.compile(regex)
+
+def iso_birthdate(value:str, pattern: None|re.Pattern) -> str:
+    """ The birthdate as the fhir bundle has it (yyyy[-MM[-dd]]), which is what stage 2 hashes """
+    if pattern is None or not value:
+        return value
+    match = pattern.fullmatch(value.strip())
+    if match is None:
+        raise ValueError(f"Birthdate '{value}' doesn't match the format in datasource.xml")
+    fields = match.groupdict()
+    birthdate = f"{int(fields['year']):04d}"
+    if fields.get('month'):
+        birthdate += f"-{int(fields['month']):02d}"
+        if fields.get('day'):
+            birthdate += f"-{int(fields['day']):02d}"
+    return birthdate
+
+def _source_path(url:str, base_dir:str) -> str:
+    """ Local path of a datasource.xml <url> (relative urls are relative to the datasource.xml) """
+    parsed = urllib.parse.urlparse(url)
+    if parsed.scheme == 'file':
+        return urllib.request.url2pathname(parsed.path)
+    if parsed.scheme and len(parsed.scheme) > 1:
+        raise ValueError(f"Only local patient tables can be pseudonymized, not '{url}'")
+    return os.path.join(base_dir, url)
+
+def read_patient_table(datasource_config:str) -> dict:
+    """ Where the patient table of a datasource.xml is and which of its columns hold the identifying data
+    Returns a dict: path, separator, encoding, columns (idat name -> column), na (idat name -> missing value), birthdate_format
+    """
+    root = lxml.etree.parse(datasource_config).getroot()
+    source = root.find('{*}patient-table/{*}source')
+    idat = root.find('{*}patient-table/{*}idat')
+    if source is None or idat is None or source.findtext('{*}url') is None:
+        raise ValueError(f"No patient-table with a source url and idat in '{datasource_config}'")
+    separator = source.findtext('{*}separator') or ","
+    table:dict = {
+        "path": _source_path(source.findtext('{*}url').strip(), os.path.dirname(os.path.abspath(datasource_config))),
+        ## Often written as \t
+        "separator": "\t" if separator == "\\t" else separator,
+        "encoding": (source.findtext('{*}encoding') or "UTF-8").strip(),
+        "columns": {},
+        "na": {},
+        "birthdate_format": None,
+    }
+    for name in IDAT_COLUMNS:
+        elem = idat.find(f'{{*}}{name}')
+        if elem is None or not elem.get('column'):
+            if name == "patient-id":
+                raise ValueError(f"The patient-table in '{datasource_config}' has no patient-id column")
+            continue
+        table["columns"][name] = elem.get('column')
+        table["na"][name] = elem.get('na')
+        if name == "birthdate" and elem.get('format'):
+            table["birthdate_format"] = elem.get('format')
+    return table
+
+def pseudonymize_table(table:dict, out_file:str, salt:str, mapping_writer, source_writer:csv.DictWriter, batch_size:None|int = None) -> int:
+    """ Write the patient table with empty name columns, adding each patient to the mapping and the source pseudonyms
+    Returns the number of patients (rows)
+    """
+    if batch_size is None:
+        batch_size = settings.tabular_batch_size
+    pattern = java_date_pattern(table["birthdate_format"]) if table["birthdate_format"] else None
+    count = 0
+    with open(table["path"], newline='', encoding=table["encoding"]) as in_f, open(out_file, 'w', newline='', encoding=table["encoding"]) as out_f:
+        reader = csv.reader(in_f, delimiter=table["separator"], quotechar='"')
+        writer = csv.writer(out_f, delimiter=table["separator"], quotechar='"', quoting=csv.QUOTE_MINIMAL, lineterminator='\n')
+        header = next(reader)
+        writer.writerow(header)
+        index:dict = {}
+        for name, column in table["columns"].items():
+            if column not in header:
+                raise ValueError(f"Column '{column}' ({name}) not found in '{table['path']}'")
+            index[name] = header.index(column)
+        def value(row:list, name:str) -> str:
+            """ The cell, '' if missing (as stage 1 sees it) """
+            if name not in index or index[name] >= len(row) or row[index[name]] == table["na"][name]:
+                return ""
+            return row[index[name]]
+        while batch := [row for row in itertools.islice(reader, batch_size) if row]:
+            demographics = [(value(row, "given-name"), value(row, "surname"), iso_birthdate(value(row, "birthdate"), pattern)) for row in batch]
+            pseudonyms = stream_pseudonymization._hash_ids_batch(demographics, salt)
+            for row, (given_names, surname, birthdate), pseudonym in zip(batch, demographics, pseudonyms):
+                mapping_writer.writerow({"given-names": given_names, "surname": surname, "birthdate": birthdate, "pseudonym": pseudonym})
+                source_writer.writerow({"source-id": value(row, "patient-id"), "pseudonym": pseudonym})
+                for name in ("given-name", "surname"):
+                    if name in index and index[name] < len(row):
+                        row[index[name]] = table["na"][name] or ""
+            writer.writerows(batch)
+            count += len(batch)
+            logger.info("%s patients pseudonymized", count)
+    return count
+
+def write_datasource(datasource_config:str, out_config:str, table_file:str):
+    """ Copy the datasource.xml, reading the patient table from table_file """
+    tree = lxml.etree.parse(datasource_config)
+    url = tree.getroot().find('{*}patient-table/{*}source/{*}url')
+    try:
+        url.text = os.path.relpath(table_file, os.path.dirname(os.path.abspath(out_config)))
+    except ValueError:
+        ## Another drive (windows)
+        url.text = os.path.abspath(table_file)
+    tree.write(out_config, xml_declaration=True, encoding='UTF-8')
+
+def pseudonymize_datasource(datasource_config:str, out_config:None|str = None, out_table:None|str = None, salt:None|str = None, source_pseudonyms:None|str = None) -> tuple[str, int]:
+    """ Pseudonymize the patient table of a datasource, returns the datasource.xml to use for stage 1 and the number of patients
+    out_config/out_table: default to the originals with '-psn' added to the name
+    source_pseudonyms: where the source patient id -> pseudonym file goes (default settings.source_pseudonyms_filename)
+    """
+    if salt is None:
+        salt = settings.secret_key
+    if not salt:
+        raise ValueError("No secret key set")
+    table = read_patient_table(datasource_config)
+    if out_table is None:
+        stem, ext = os.path.splitext(table["path"])
+        out_table = f"{stem}-psn{ext}"
+    if out_config is None:
+        stem, ext = os.path.splitext(datasource_config)
+        out_config = f"{stem}-psn{ext}"
+    if source_pseudonyms is None:
+        source_pseudonyms = settings.source_pseudonyms_filename
+    with stream_pseudonymization._mapping_output(salt) as mapping_writer, open(source_pseudonyms, 'w', newline='\n') as source_f:
+        source_writer = csv.DictWriter(source_f, delimiter=settings.user_mapping_separator, quotechar='"', quoting=csv.QUOTE_MINIMAL, fieldnames=SOURCE_TSV_HEADINGS, lineterminator='\n')
+        source_writer.writeheader()
+        count = pseudonymize_table(table, out_table, salt, mapping_writer, source_writer)
+    write_datasource(datasource_config, out_config, out_table)
+    return out_config, count
+
+def check_bundle(bundle_file:str, source_pseudonyms:str, salt:None|str = None) -> tuple[int, list[str]]:
+    """ Compare the pseudonyms with those stage 2 makes from a raw bundle (of the original datasource.xml)
+    Returns the number of patients compared and the source ids which differ (eg a birthdate stage 1 formats differently)
+    """
+    pseudonyms = read_source_pseudonyms(source_pseudonyms, settings.user_mapping_separator)
+    checked = 0
+    differ:list[str] = []
+    first = lambda elem, path: next(iter(elem.xpath(path)), "")
+    for _, patient in lxml.etree.iterparse(bundle_file, events=('end',), tag='{*}Patient', huge_tree=True):
+        sourceId = first(patient, "*[local-name()='identifier']/*[local-name()='value']/@value")
+        if sourceId in pseudonyms:
+            checked += 1
+            expected = stream_pseudonymization._hash_ids(
+                first(patient, "*[local-name()='name']/*[local-name()='given']/@value"),
+                first(patient, "*[local-name()='name']/*[local-name()='family']/@value"),
+                first(patient, "*[local-name()='birthDate']/@value"),
+                salt or settings.secret_key)
+            if expected != pseudonyms[sourceId]:
+                differ.append(sourceId)
+        patient.clear()
+    return checked, differ
+
+## When called as script (not run if imported as module):
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Pseudonymize the patient table of a datasource before stage 1. Uses the secret_key env var.")
+    parser.add_argument('--datasource-config', required=True, help='The datasource.xml of the source.')
+    parser.add_argument('--output-config', help='The datasource.xml to write (default: the original with -psn added).')
+    parser.add_argument('--output-table', help='The patient table to write (default: the original with -psn added).')
+    parser.add_argument('--check-bundle', help='Instead, check the pseudonyms against a raw fhir bundle of the original datasource.xml.')
+    args = parser.parse_args()
+
+    if not settings.secret_key:
+        logger.error("No secret key set! Cannot continue.")
+        sys.exit(1)
+    if args.check_bundle:
+        checked, differ = check_bundle(args.check_bundle, settings.source_pseudonyms_filename)
+        print(f"{checked - len(differ)} of {checked} patients have the same pseudonym as stage 2 gives them")
+        if differ:
+            print(f"Different (source ids): {', '.join(differ[:20])}{' ...' if len(differ) > 20 else ''}")
+            sys.exit(1)
+        sys.exit(0)
+    try:
+        out_config, count = pseudonymize_datasource(args.datasource_config, args.output_config, args.output_table)
+    except (OSError, ValueError) as err:
+        logger.error("%s", err)
+        sys.exit(1)
+    print(f"Pseudonymized {count} patients. Run stage 1 with '{out_config}', then stage 2 with source_pseudonyms_filename={settings.source_pseudonyms_filename}")
@@ -0,0 +1,59 @@
+""" Shared fixtures: a small fhir bundle with the cases the pseudonymization engines have to agree on """
+
+## Import built-ins
+import os
+
+## Import third party libraries
+import pytest
+
+SALT:str = "test-secret-key"
+
+def _patient(number:int, names:str, birthdate:str) -> str:
+    ## Some with a narrative, whose text spans lines
+    narrative = f"""<text><status value="generated"/><div xmlns="http://www.w3.org/1999/xhtml"><p>Seen at
+    the clinic &amp; <b>ward {number}</b>
+  </p></div></text>""" if number % 3 == 0 else ""
+    return f"""<entry><fullUrl value="urn:uuid:p{number}"/><resource><Patient>
+  <!-- patient {number} -->
+  <id value="P{number}"/>
+  {narrative}
+  <identifier><system value="urn:local"/><value value="local-{number}"/></identifier>
+  {names}
+  <gender value="{'female' if number % 2 else 'male'}"/>
+  <birthDate value="{birthdate}"/>
+</Patient></resource></entry>
+"""
+
+def _encounter(number:int, patient:int, identifiers:int = 1) -> str:
+    identifier = "".join(f'<identifier><value value="enc-{number}-{index}"/></identifier>' for index in range(identifiers))
+    return f"""<entry><resource><Encounter><id value="E{number}"/>{identifier}<status value="finished"/><subject><reference value="Patient/P{patient}"/></subject></Encounter></resource></entry>
+"""
+
+def _observation(number:int, patient:int, encounter:int) -> str:
+    code = f"<code><text>Note {number}\n  second line</text></code>" if number % 4 == 0 else ""
+    return f"""<entry><resource><Observation><id value="O{number}"/><status value="final"/>{code}<subject><reference value="Patient/P{patient}"/></subject><encounter><reference value="Encounter/E{encounter}"/></encounter><valueString value="Wert &amp; Größe {number}"/></Observation></resource></entry>
+"""
+
+def write_bundle(path:str, patients:int = 40) -> str:
+    """ Patients with encounters and observations, and the odd ones: several names, several encounter identifiers,
+    an encounter before its patient, a reference to a patient which isn't there, non-ASCII names and text over several lines """
+    entries = [_encounter(0, 3), _encounter(999, 9999)]
+    for number in range(1, patients + 1):
+        names = f'<name><family value="Müller{number}"/><given value="Anna"/><given value="Lena"/></name>'
+        if number % 7 == 0:
+            names += f'<name><family value="Alias{number}"/><given value="Other"/></name>'
+        entries.append(_patient(number, names, f"19{50 + number % 50}-0{1 + number % 9}-1{number % 10}"))
+        for encounter in range(2):
+            encounterNumber = number * 10 + encounter
+            entries.append(_encounter(encounterNumber, number, identifiers=2 if number % 5 == 0 else 1))
+            entries += [_observation(encounterNumber * 10 + observation, number, encounterNumber) for observation in range(3)]
+    with open(path, 'w', encoding='UTF-8', newline='\n') as bundle_f:
+        bundle_f.write('<?xml version="1.0" encoding="UTF-8"?>\n<Bundle xmlns="http://hl7.org/fhir">\n<type value="collection"/>\n')
+        bundle_f.writelines(entries)
+        bundle_f.write('</Bundle>\n')
+    return path
+
+@pytest.fixture
+def bundle(tmp_path) -> str:
+    """ Path of the test bundle """
+    return write_bundle(os.path.join(tmp_path, "fhir-bundle-raw.xml"))
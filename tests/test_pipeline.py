@@ -0,0 +1,42 @@
+""" pipeline: generate, pseudonymize, compress and upload in one pass """
+
+## Import built-ins
+import gzip
+import os
+import sys
+
+## Import third party libraries
+import pytest
+
+from conftest import SALT
+from i2b2_upload_client.logic import pipeline, stream_pseudonymization
+
+def _read(path:str) -> bytes:
+    with open(path, 'rb') as read_f:
+        return read_f.read()
+
+@pytest.fixture
+def uploads(monkeypatch, bundle) -> list:
+    """ Stage 1 is a process writing the test bundle to its stdout, the uploads' bodies are collected instead of sent """
+    monkeypatch.setattr(pipeline, "exportfhir_command", lambda datasource_config, heap_mb = None: [sys.executable, "-c",
+        "import shutil, sys; shutil.copyfileobj(open(sys.argv[1], 'rb'), sys.stdout.buffer)", bundle])
+    bodies = []
+    def upload(source_id, chunks, filename = "upload.gz"):
+        bodies.append(b"".join(chunks))
+        return "Uploading..."
+    monkeypatch.setattr(pipeline.api_processing, "uploadSourceStream", upload)
+    return bodies
+
+@pytest.mark.parametrize("engine", ["sax", "passthrough"])
+def test_keep_raw_with_rewritten_references(tmp_path, monkeypatch, bundle, uploads, engine):
+    monkeypatch.setattr(stream_pseudonymization.settings, "user_mapping_filename", os.path.join(tmp_path, "psn-cache.tsv"))
+    monkeypatch.setattr(stream_pseudonymization.settings, "rewrite_patient_references", True)
+    raw, dwh = os.path.join(tmp_path, "raw.xml"), os.path.join(tmp_path, "dwh.xml")
+    success, message = pipeline.run_pipeline("datasource.xml", "clinic", SALT, keep_raw=raw, keep_dwh=dwh, engine=engine)
+    assert success, message
+    assert _read(raw) == _read(bundle)
+    assert gzip.decompress(uploads[0]) == _read(dwh)
+    ## The same as pseudonymizing the file (which is read twice, to find its Patients first)
+    expected = os.path.join(tmp_path, "expected.xml")
+    assert stream_pseudonymization.process_fhir_bundle(bundle, expected, SALT, engine=engine)
+    assert _read(dwh) == _read(expected)
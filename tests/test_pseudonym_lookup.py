@@ -0,0 +1,88 @@
+""" pseudonym_lookup: the index follows the TSV, or the pseudonym store when there is one """
+
+## Import built-ins
+import csv
+import os
+
+## Import third party libraries
+import pytest
+
+from conftest import SALT
+from i2b2_upload_client.logic import pseudonym_lookup
+from i2b2_upload_client.logic.pseudonym_lookup import PseudonymLookup
+from i2b2_upload_client.logic.pseudonym_store import TSV_HEADINGS, PseudonymStore
+
+def _row(number:int) -> dict:
+    return {"given-names": "Anna Lena", "surname": f"Müller {number}", "birthdate": f"1970-01-{number:02}", "pseudonym": f"psn-{number}"}
+
+def _write_tsv(path:str, rows:list[dict], append:bool = False):
+    with open(path, 'a' if append else 'w', newline='\n', encoding='UTF-8') as map_f:
+        writer = csv.DictWriter(map_f, delimiter="\t", fieldnames=TSV_HEADINGS, lineterminator='\n')
+        if not append:
+            writer.writeheader()
+        writer.writerows(rows)
+
+def _store(path:str, rows:list[dict], salt:str = SALT):
+    store = PseudonymStore(path, salt)
+    for row in rows:
+        store.writerow(row)
+    store.close()
+
+@pytest.fixture
+def mapping(tmp_path) -> str:
+    path = os.path.join(tmp_path, "psn-cache.tsv")
+    _write_tsv(path, [_row(number) for number in range(1, 4)])
+    return path
+
+def test_lookups(mapping):
+    lookup = PseudonymLookup(mapping, store_path="")
+    assert lookup.by_pseudonym(" psn-2 ") == [_row(2)]
+    assert lookup.by_patient("anna  LENA", "müller 2", "1970-01-02") == [_row(2)]
+    assert lookup.by_patient("", "Müller 3") == [_row(3)]
+    assert lookup.lookup({"pseudonym": "psn-9"}) == []
+    lookup.close()
+
+def test_appended_rows_are_indexed(mapping):
+    PseudonymLookup(mapping, store_path="").close()
+    _write_tsv(mapping, [_row(4)], append=True)
+    lookup = PseudonymLookup(mapping, store_path="")
+    assert lookup.by_pseudonym("psn-4") == [_row(4)]
+    assert lookup.update() == 0
+    lookup.close()
+
+def test_rewritten_tsv_is_indexed_from_the_start(mapping):
+    PseudonymLookup(mapping, store_path="").close()
+    _write_tsv(mapping, [_row(5)])
+    lookup = PseudonymLookup(mapping, store_path="")
+    assert lookup.by_pseudonym("psn-1") == []
+    assert lookup.by_pseudonym("psn-5") == [_row(5)]
+    lookup.close()
+
+def test_store_is_used_instead_of_the_tsv(tmp_path, mapping):
+    store = os.path.join(tmp_path, "psn-cache.sqlite")
+    ## The TSV lacks patient 4 and has patient 1, which the store has under another key only
+    _store(store, [_row(number) for number in range(2, 5)])
+    _store(store, [_row(1)], salt="another key")
+    lookup = PseudonymLookup(mapping, store_path=store, salt=SALT)
+    assert lookup.by_pseudonym("psn-4") == [_row(4)]
+    assert lookup.by_pseudonym("psn-1") == []
+    _store(store, [_row(5)])
+    assert lookup.update() == 1
+    assert lookup.by_patient("Anna Lena", "Müller 5") == [_row(5)]
+    lookup.close()
+
+def test_index_follows_a_change_of_key(tmp_path):
+    store = os.path.join(tmp_path, "psn-cache.sqlite")
+    _store(store, [_row(1)])
+    _store(store, [_row(2)], salt="another key")
+    index = os.path.join(tmp_path, "index.sqlite")
+    PseudonymLookup(index_path=index, store_path=store, salt=SALT).close()
+    lookup = PseudonymLookup(index_path=index, store_path=store, salt="another key")
+    assert lookup.by_pseudonym("psn-1") == []
+    assert lookup.by_pseudonym("psn-2") == [_row(2)]
+    lookup.close()
+
+def test_store_needs_the_key(tmp_path, monkeypatch):
+    monkeypatch.setattr(pseudonym_lookup.settings, "secret_key", None)
+    with pytest.raises(ValueError):
+        PseudonymLookup(store_path=os.path.join(tmp_path, "psn-cache.sqlite"))
@@ -0,0 +1,121 @@
+""" The pseudonym store: patients are added once, and the TSV next to it is appended to or rewritten complete """
+
+## Import built-ins
+import csv
+import os
+
+## Import third party libraries
+import pytest
+
+from conftest import SALT, write_bundle
+from i2b2_upload_client.logic import stream_pseudonymization
+from i2b2_upload_client.logic.pseudonym_store import TSV_HEADINGS, PseudonymStore
+
+def _row(number:int, pseudonym:str = "") -> dict:
+    return {"given-names": "Anna", "surname": f"Müller{number}", "birthdate": "1970-01-01", "pseudonym": pseudonym or f"psn-{number}"}
+
+class _Rows(list):
+    """ Collects the rows written, in place of a csv.DictWriter """
+    writerow = list.append
+
+def _tsv(path:str) -> list[dict]:
+    with open(path, newline='', encoding='UTF-8') as map_f:
+        return list(csv.DictReader(map_f, delimiter="\t"))
+
+def test_writerow_adds_each_patient_once(tmp_path):
+    written = _Rows()
+    store = PseudonymStore(os.path.join(tmp_path, "psn-cache.sqlite"), SALT, tsv_output=written)
+    assert store.writerow(_row(1))
+    assert store.writerow(_row(2))
+    assert not store.writerow(_row(1, "other"))
+    assert written == [_row(1), _row(2)]
+    assert store.lookup("Anna", "Müller1", "1970-01-01") == "psn-1"
+    store.close()
+
+def test_pseudonyms_are_kept_per_salt(tmp_path):
+    path = os.path.join(tmp_path, "psn-cache.sqlite")
+    store = PseudonymStore(path, SALT)
+    store.writerow(_row(1))
+    store.close()
+    other = PseudonymStore(path, "another key")
+    assert not other.knowsSalt()
+    assert other.lookup("Anna", "Müller1", "1970-01-01") is None
+    other.close()
+    reopened = PseudonymStore(path, SALT, readonly=True)
+    assert reopened.knowsSalt()
+    assert list(reopened.rows()) == [_row(1)]
+    reopened.close()
+
+def test_rows_since_a_position(tmp_path):
+    store = PseudonymStore(os.path.join(tmp_path, "psn-cache.sqlite"), SALT)
+    for number in range(3):
+        store.writerow(_row(number))
+    position = store.lastRowid()
+    store.writerow(_row(3))
+    assert list(store.rows(after=position)) == [_row(3)]
+    assert list(store.rows(until=position)) == [_row(number) for number in range(3)]
+    store.close()
+
+def test_export_tsv(tmp_path):
+    store = PseudonymStore(os.path.join(tmp_path, "psn-cache.sqlite"), SALT)
+    for number in range(3):
+        store.writerow(_row(number))
+    assert store.export_tsv(os.path.join(tmp_path, "export.tsv")) == 3
+    store.close()
+    assert _tsv(os.path.join(tmp_path, "export.tsv")) == [_row(number) for number in range(3)]
+
+class TestRuns():
+    """ process_fhir_bundle with a store, run after run """
+    @pytest.fixture(autouse=True)
+    def workdir(self, tmp_path, monkeypatch):
+        self.mapping = os.path.join(tmp_path, "psn-cache.tsv")
+        monkeypatch.setattr(stream_pseudonymization.settings, "user_mapping_filename", self.mapping)
+        monkeypatch.setattr(stream_pseudonymization.settings, "user_mapping_store", os.path.join(tmp_path, "psn-cache.sqlite"))
+        self.bundles = {patients: write_bundle(os.path.join(tmp_path, f"bundle-{patients}.xml"), patients) for patients in (40, 45)}
+        self.output = os.path.join(tmp_path, "out.xml")
+
+    def run(self, patients:int, salt:str = SALT) -> list[dict]:
+        """ Pseudonymize the bundle of that many patients, returns the TSV's rows """
+        assert stream_pseudonymization.process_fhir_bundle(self.bundles[patients], self.output, salt, engine="passthrough")
+        return _tsv(self.mapping)
+
+    def test_known_patients_are_not_written_again(self):
+        first = self.run(40)
+        assert len(first) == 40
+        with open(self.mapping, 'rb') as map_f:
+            before = map_f.read()
+        assert self.run(40) == first
+        with open(self.mapping, 'rb') as map_f:
+            assert map_f.read() == before
+
+    def test_new_patients_are_appended(self):
+        first = self.run(40)
+        both = self.run(45)
+        assert both[:40] == first
+        assert len(both) == 45
+
+    def test_missing_tsv_is_rewritten_complete(self):
+        complete = self.run(45)
+        os.remove(self.mapping)
+        assert self.run(40) == complete
+
+    def test_changed_tsv_is_rewritten_complete(self):
+        complete = self.run(45)
+        with open(self.mapping, 'a', encoding='UTF-8') as map_f:
+            map_f.write("someone\telse\t2000-01-01\tedited\n")
+        assert self.run(40) == complete
+
+    def test_other_salt_gets_its_own_tsv(self):
+        complete = self.run(45)
+        other = self.run(40, "another key")
+        assert len(other) == 40
+        assert not {row["pseudonym"] for row in other} & {row["pseudonym"] for row in complete}
+        ## Back to the first key: the TSV was written under another one, so it is rewritten with all of the first key's patients
+        assert self.run(40) == complete
+
+    def test_pseudonyms_match_a_run_without_store(self, monkeypatch):
+        withStore = self.run(40)
+        os.remove(self.mapping)
+        monkeypatch.setattr(stream_pseudonymization.settings, "user_mapping_store", "")
+        assert self.run(40) == withStore
+        assert list(withStore[0]) == TSV_HEADINGS
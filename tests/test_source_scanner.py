@@ -0,0 +1,87 @@
+""" source_scanner: which sources are stale, and why """
+
+## Import built-ins
+import os
+import shutil
+
+## Import third party libraries
+import pytest
+
+from conftest import SALT, write_bundle
+from i2b2_upload_client.logic import source_scanner
+from i2b2_upload_client.logic.source_scanner import DATASOURCE_CONFIG, DWH_BUNDLE, OUTPUT_DIR, RAW_BUNDLE, check_source, scan_sources
+
+def _datasource(urls:list[str]) -> str:
+    return '<?xml version="1.0" encoding="UTF-8"?>\n<datasource>\n' + "".join(f"  <source><url>{url}</url></source>\n" for url in urls) + "</datasource>\n"
+
+def _write(path:str, content:str):
+    with open(path, 'w', encoding='UTF-8') as write_f:
+        write_f.write(content)
+
+@pytest.fixture
+def source(tmp_path, monkeypatch) -> str:
+    """ A processed source: datasource.xml referencing patients.csv (and a remote url, which isn't checked) """
+    bundle = write_bundle(os.path.join(tmp_path, "bundle.xml"), patients=5)
+    def export(datasource_config, output, heap_mb = None, cwd = None, log_f = None, cancelled = None):
+        """ Stage 1 without java: the test bundle is the source's raw bundle """
+        shutil.copyfile(bundle, output)
+        return {"config": datasource_config, "output": output, "returncode": 0}
+    monkeypatch.setattr(source_scanner.stage1_scheduler, "run_export", export)
+    source_dir = os.path.join(tmp_path, "sources", "clinic")
+    os.makedirs(source_dir)
+    _write(os.path.join(source_dir, DATASOURCE_CONFIG), _datasource(["patients.csv", "https://example.org/visits.csv"]))
+    _write(os.path.join(source_dir, "patients.csv"), "id;name\n1;Anna\n")
+    assert check_source(source_dir, SALT) == ["not processed yet"]
+    success, message = source_scanner.process_source(source_dir, SALT)
+    assert success, message
+    return source_dir
+
+def test_processed_source_is_up_to_date(source):
+    assert check_source(source, SALT) == []
+    assert os.path.isfile(os.path.join(source, OUTPUT_DIR, DWH_BUNDLE))
+
+def test_secret_key_changed(source):
+    assert check_source(source, "another key") == ["secret key changed"]
+    ## Without a key to compare, only the files count
+    assert check_source(source) == []
+
+def test_touching_a_file_is_no_change(source):
+    os.utime(os.path.join(source, "patients.csv"), ns=(0, 0))
+    assert check_source(source, SALT) == []
+
+def test_changed_input(source):
+    _write(os.path.join(source, "patients.csv"), "id;name\n1;Anna\n2;Lena\n")
+    assert check_source(source, SALT) == ["changed patients.csv"]
+
+def test_changed_datasource_config(source):
+    with open(os.path.join(source, DATASOURCE_CONFIG), 'a', encoding='UTF-8') as config_f:
+        config_f.write("<!-- edited -->\n")
+    assert check_source(source, SALT) == [f"changed {DATASOURCE_CONFIG}"]
+
+def test_missing_input(source):
+    os.remove(os.path.join(source, "patients.csv"))
+    assert check_source(source, SALT) == ["missing input patients.csv"]
+
+def test_new_and_dropped_inputs(source):
+    _write(os.path.join(source, "visits.csv"), "id\n1\n")
+    _write(os.path.join(source, DATASOURCE_CONFIG), _datasource(["visits.csv"]))
+    assert check_source(source, SALT) == [f"changed {DATASOURCE_CONFIG}", "no longer used patients.csv", "new input visits.csv"]
+
+def test_modified_and_missing_outputs(source):
+    with open(os.path.join(source, OUTPUT_DIR, DWH_BUNDLE), 'ab') as dwh_f:
+        dwh_f.write(b"\n")
+    os.remove(os.path.join(source, OUTPUT_DIR, RAW_BUNDLE))
+    assert sorted(check_source(source, SALT)) == [f"missing output {RAW_BUNDLE}", f"modified output {DWH_BUNDLE}"]
+
+def test_unreadable_datasource_config(source):
+    _write(os.path.join(source, DATASOURCE_CONFIG), "<datasource>")
+    reasons = check_source(source, SALT)
+    assert len(reasons) == 1 and reasons[0].startswith(f"{DATASOURCE_CONFIG} unreadable")
+
+def test_scan_sources(source):
+    root = os.path.dirname(source)
+    os.makedirs(os.path.join(root, "not-a-source"))
+    os.makedirs(os.path.join(root, "new"))
+    _write(os.path.join(root, "new", DATASOURCE_CONFIG), _datasource([]))
+    assert [(found["name"], found["reasons"]) for found in scan_sources(root, SALT)] == [("clinic", []), ("new", ["not processed yet"])]
+    assert [found["name"] for found in scan_sources(root, SALT, only=["new"])] == ["new"]
@@ -0,0 +1,148 @@
+""" The engines and worker counts of stream_pseudonymization must agree on the output and the mapping """
+
+## Import built-ins
+import csv
+import os
+
+## Import third party libraries
+import lxml.etree
+import pytest
+
+from conftest import SALT, write_bundle
+from i2b2_upload_client.logic import stream_pseudonymization
+from i2b2_upload_client.logic.stream_pseudonymization import ENGINES, PARALLEL_ENGINES
+
+## (engine, workers) of every run compared
+CASES:list[tuple] = [(engine, 1) for engine in ENGINES] + [(engine, 3) for engine in PARALLEL_ENGINES]
+
+## (given names, surname, birthdate) hashed both ways
+DEMOGRAPHICS:list[tuple] = [
+    ("Anna Lena", "Müller", "1970-01-02"),
+    ("", "", ""),
+    ("Jörg", "O'Brien", "1983-08-16"),
+    ("a|b", "c|d", "1999"),
+    ("  spaced ", "名前", "2001-12-31"),
+]
+
+def _pseudonymize(workdir, bundle:str, engine:str, workers:int, **options) -> tuple[str, str]:
+    """ Run process_fhir_bundle, returns the paths of the output and the mapping """
+    name = f"{engine}-{workers}{'-rewritten' if options.get('rewrite_references') else ''}"
+    output, mapping = os.path.join(workdir, f"{name}.xml"), os.path.join(workdir, f"{name}.tsv")
+    with pytest.MonkeyPatch.context() as monkeypatch:
+        monkeypatch.setattr(stream_pseudonymization.settings, "user_mapping_filename", mapping)
+        monkeypatch.setattr(stream_pseudonymization.settings, "user_mapping_store", "")
+        ## Small shards, so the workers get many of them
+        monkeypatch.setattr(stream_pseudonymization.settings, "pseudonymization_shard_size", 4096)
+        assert stream_pseudonymization.process_fhir_bundle(bundle, output, SALT, engine=engine, workers=workers, **options)
+    return output, mapping
+
+def _canonical(path:str, text_whitespace:bool = True) -> bytes:
+    """ The XML regardless of declaration, character references, comments and indentation (and whitespace within text) """
+    parser = lxml.etree.XMLParser(remove_comments=True, remove_blank_text=True)
+    tree = lxml.etree.parse(path, parser)
+    if not text_whitespace:
+        for elem in tree.iter():
+            elem.text = None if elem.text is None else "".join(elem.text.split())
+            elem.tail = None if elem.tail is None else "".join(elem.tail.split())
+    return lxml.etree.tostring(tree, method='c14n')
+
+def _read(path:str) -> bytes:
+    with open(path, 'rb') as read_f:
+        return read_f.read()
+
+@pytest.fixture(scope="module")
+def runs(tmp_path_factory) -> dict:
+    """ (engine, workers) -> (output, mapping) of the test bundle """
+    workdir = tmp_path_factory.mktemp("engines")
+    bundle = write_bundle(os.path.join(workdir, "fhir-bundle-raw.xml"))
+    return {case: _pseudonymize(workdir, bundle, *case) for case in CASES}
+
+@pytest.mark.parametrize("case", CASES[1:])
+def test_mapping_is_the_same(runs, case):
+    assert _read(runs[case][1]) == _read(runs[("sax", 1)][1])
+
+@pytest.mark.parametrize("case", CASES[2:])
+def test_output_is_the_same(runs, case):
+    assert _canonical(runs[case][0]) == _canonical(runs[("iterparse", 1)][0])
+
+def test_sax_output_differs_only_within_text(runs):
+    """ The sax engine drops the line breaks (and other whitespace-only pieces) within text, see FhirIterStream """
+    sax, iterparse = runs[("sax", 1)][0], runs[("iterparse", 1)][0]
+    assert _canonical(sax, text_whitespace=False) == _canonical(iterparse, text_whitespace=False)
+    assert b"Note 100\n  second line" in _read(iterparse)
+    assert b"Note 100  second line" in _read(sax)
+
+@pytest.mark.parametrize("case, same_as", [
+    (("xslt", 1), ("passthrough", 1)),
+    (("passthrough", 3), ("passthrough", 1)),
+    (("xslt", 3), ("xslt", 1)),
+])
+def test_output_is_byte_identical(runs, case, same_as):
+    assert _read(runs[case][0]) == _read(runs[same_as][0])
+
+def test_patients_are_pseudonymized(runs):
+    output, mapping = runs[("sax", 1)]
+    with open(mapping, newline='', encoding='UTF-8') as map_f:
+        rows = list(csv.DictReader(map_f, delimiter="\t"))
+    assert len(rows) == 40
+    assert len({row["pseudonym"] for row in rows}) == 40
+    pseudonyms = {row["surname"]: row["pseudonym"] for row in rows}
+    namespaces = {"f": "http://hl7.org/fhir"}
+    tree = lxml.etree.parse(output)
+    patient, = tree.xpath("//f:Patient[f:id/@value='P7']", namespaces=namespaces)
+    assert patient.find("f:identifier/f:value", namespaces).get("value") == pseudonyms["Müller7"]
+    assert patient.find("f:name", namespaces) is None
+    assert b"Alias7" not in _read(output)
+
+@pytest.mark.parametrize("salt", [SALT, "ünïcode|salt"])
+def test_hash_ids_batch_is_hash_ids(salt):
+    assert stream_pseudonymization._hash_ids_batch(DEMOGRAPHICS, salt) == [stream_pseudonymization._hash_ids(*demographics, salt) for demographics in DEMOGRAPHICS]
+
+def test_hash_ids_batch_defaults_to_the_secret_key(monkeypatch):
+    monkeypatch.setattr(stream_pseudonymization.settings, "secret_key", SALT)
+    assert stream_pseudonymization._hash_ids_batch(DEMOGRAPHICS) == stream_pseudonymization._hash_ids_batch(DEMOGRAPHICS, SALT)
+    assert stream_pseudonymization._hash_ids_batch([]) == []
+
+def test_parallel_needs_a_parallel_engine(tmp_path, bundle):
+    with pytest.MonkeyPatch.context() as monkeypatch:
+        monkeypatch.setattr(stream_pseudonymization.settings, "user_mapping_filename", os.path.join(tmp_path, "psn-cache.tsv"))
+        assert not stream_pseudonymization.process_fhir_bundle(bundle, os.path.join(tmp_path, "out.xml"), SALT, engine="sax", workers=2)
+
+@pytest.mark.parametrize("engine", list(ENGINES))
+def test_rewritten_references_keep_the_order(tmp_path, bundle, engine):
+    output, _ = _pseudonymize(tmp_path, bundle, engine, 1, rewrite_references=True)
+    namespaces = {"f": "http://hl7.org/fhir"}
+    before = lxml.etree.parse(bundle).xpath("f:entry/f:resource/*", namespaces=namespaces)
+    after = lxml.etree.parse(output).xpath("f:entry/f:resource/*", namespaces=namespaces)
+    assert [lxml.etree.QName(resource).localname for resource in after] == [lxml.etree.QName(resource).localname for resource in before]
+    patientIds = {original.find("f:id", namespaces).get("value"): resource.find("f:id", namespaces).get("value")
+        for original, resource in zip(before, after) if lxml.etree.QName(resource).localname == "Patient"}
+    assert all(original != pseudonymized for original, pseudonymized in patientIds.items())
+    for original, resource in zip(before, after):
+        reference = original.find("f:subject/f:reference", namespaces)
+        if reference is not None:
+            ## Patient/P9999 isn't in the bundle and stays as it is
+            patient = reference.get("value").removeprefix("Patient/")
+            assert resource.find("f:subject/f:reference", namespaces).get("value") == f"Patient/{patientIds.get(patient, patient)}"
+
+def test_failed_run_closes_the_targets(tmp_path, bundle, monkeypatch):
+    """ An engine failing mid-bundle still leaves the output (and delta bundle) written so far and frees the Patient indexes """
+    def failing_engine(in_f, target, mapping_writer, statistics = None):
+        target.send(('raw', b'<Bundle xmlns="http://hl7.org/fhir">'))
+        raise RuntimeError("engine failed")
+    closed = []
+    class RecordedIndex(stream_pseudonymization.PatientIndex):
+        def close(self):
+            closed.append(self)
+            super().close()
+    monkeypatch.setitem(stream_pseudonymization.ENGINES, "failing", failing_engine)
+    monkeypatch.setattr(stream_pseudonymization, "PatientIndex", RecordedIndex)
+    monkeypatch.setattr(stream_pseudonymization.settings, "user_mapping_filename", os.path.join(tmp_path, "psn-cache.tsv"))
+    output, delta = os.path.join(tmp_path, "out.xml"), os.path.join(tmp_path, "delta.xml")
+    ## Holding on to the error (and so its frames), the targets aren't closed by being freed either
+    with pytest.raises(RuntimeError, match="engine failed") as failure:
+        stream_pseudonymization.process_fhir_bundle(bundle, output, SALT, engine="failing", workers=1,
+            manifest=os.path.join(tmp_path, "manifest.sqlite"), delta_file=delta, rewrite_references=True)
+    assert _read(output) == _read(delta) == b'<Bundle xmlns="http://hl7.org/fhir">'
+    ## The index of the pseudonyms and the one of the Patients expected
+    assert len(set(map(id, closed))) == 2